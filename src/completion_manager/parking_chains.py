@@ -10,6 +10,11 @@ import aiohttp
 import traceback
 
 logger = BotLog('sql-paring-chains')
+# (url, params) -> (ETag, response) from the parking API, revalidated with If-None-Match
+etag_cache = {}
+ETAG_CACHE_SIZE = 1000
+# The campus whose parking the bot answers about; see the parking API's /campuses
+PARKING_CAMPUS = getenv('PARKING_CAMPUS', 'sjsu')
 chat = ChatOpenAI(
     openai_api_key=getenv('OPENAI_API_KEY'),
     temperature=0.7
@@ -155,47 +160,78 @@ async def execute_commands(commands):
         if not days_list or not adjusted_time:
             logger.error(f'Error getting average data for days: {days} and time: {time} from command executor.')
             return 'There was an error executing the command'
+        # One batch call answers every day; skip days we couldn't parse and repeats
+        days_list = list(dict.fromkeys(day for day in days_list if day != 'Invalid day'))
+        logger.debug(f'Calling parking API for average data for days: {days_list} and time: {adjusted_time}.')
+        try:
+            response = await call_parking_api(endpoint="average/batch", days=days_list, time=adjusted_time)
+        except Exception as e:
+            response = None
+            logger.critical(f'Error getting average data for days: {days} and time: {time} from command executor: {e}')
+        if not response:
+            logger.error(f'No average data for days: {days} and time: {time} from command executor.')
+            return 'There was an error executing the command'
+        logger.debug(f'Got response from parking API: {response}')
         for day in days_list:
-            logger.debug(f'Calling parking API for average data for day: {day} and time: {adjusted_time}.')
+            output.append(list(response.get(day, [])))
+
+        # Later today, a forecast from the live readings beats the weekday average
+        if datetime.now().strftime('%A') in days_list and adjusted_time > datetime.now().strftime('%H:%M:%S'):
+            logger.info(f'Calling parking API for a forecast at {adjusted_time}.')
             try:
-                response = await call_parking_api(endpoint="average", day=day, time=adjusted_time)
+                forecast = await call_parking_api(endpoint="forecast", time=adjusted_time)
             except Exception as e:
-                days = commands.get("days")
-                time = commands.get("time")
-                logger.critical(f'Error getting average data for days: {days} and time: {time} from command executor: {e}')
-                return 'There was an error executing the command'
-            logger.debug(f'Got response from parking API: {response}')
-            output.append(response)
+                forecast = None
+                logger.error(f'Error getting forecast for {adjusted_time} from command executor: {e}')
+            if forecast:
+                output.append(list(forecast))
     logger.info(f'Exiting gracefully')
     return output
 
 
 @newrelic.agent.background_task()
-async def call_parking_api(endpoint=None, table='sjsu', day=None, time=None) -> list:
+async def call_parking_api(endpoint=None, campus=PARKING_CAMPUS, day=None, time=None, days=None):
     payload = {
         "api_key": getenv("PARKING_API_KEY"),
         "endpoint": endpoint,
-        "table": table
+        "campus": campus
     }
     # Make sure it's valid to get the average
-    if day and time:
+    if endpoint == "forecast" and time:
+        payload["time"] = time
+    elif days and time:
+        payload["days"] = ",".join(days)
+        payload["time"] = time
+    elif day and time:
         payload["day"] = day
         payload["time"] = time
-    elif day or time: # Only here if not and
+    elif day or time or days: # Only here if not and
         logger.error(f"Invalid day or time: {day}, {time}")
         return list('')
 
     try:
         url = f"{getenv('PARKING_API_URL')}/{endpoint}"
+        cache_key = (url, tuple(sorted((k, v) for k, v in payload.items() if k != 'api_key')))
+        cached = etag_cache.get(cache_key)
+        headers = {'If-None-Match': cached[0]} if cached else {}
         async with aiohttp.ClientSession() as session:
             parking_info = "I couldn't get any parking information. Tell the user to try and ask in a different way."
-            async with session.get(url, params=payload) as response:
+            async with session.get(url, params=payload, headers=headers) as response:
                 logger.debug(f'Called parking API endpoint: {endpoint}')
+                if response.status == 304 and cached:
+                    logger.info(f'Parking API data unchanged, using cached response.')
+                    parking_info = cached[1]
+                    return parking_info if isinstance(parking_info, dict) else list(parking_info)
                 if response.status == 200:
                     parking_info = json.loads(await response.text())
+                    if response.headers.get('ETag'):
+                        if len(etag_cache) >= ETAG_CACHE_SIZE:
+                            etag_cache.clear()
+                        etag_cache[cache_key] = (response.headers['ETag'], parking_info)
                     logger.info(f'Called parking API successfully.')
                     logger.debug(f'Got response from parking API: {parking_info}')
-                    return list(parking_info)
+                    # Batch endpoints answer with a dict keyed by day
+                    return parking_info if isinstance(parking_info, dict) else list(parking_info)
                 else:
                     traceback_str = traceback.format_exc()
                     logger.critical(f'Error calling parking API (top): {e}')
@@ -1,15 +1,94 @@
-from quart import Quart, request, jsonify
+from quart import Quart, request, jsonify, Response, websocket, g
 from api_log import BotLog
 import os
-from mariadb import Config
-from datetime import datetime
+from rollup import YESTERDAY, LAST_WEEK, day_name
+from campuses import registry, UnknownCampus
+from services import build
+from query_guard import QueryRejected
+from export import ExportBusy, FORMATS
+from asof import parse_instants
+from downsample import DEFAULT_POINTS
+from encoding import negotiate, encode_table, JSON
+from coalesce import SingleFlight
+from result_cache import ResultCache, bucket_time, average_scope, window_scope
+from shared import SharedState, NotPublished, SHARED_STATE
+from snapshot import SNAPSHOT_INTERVAL
+from metrics import REQUEST_SECONDS, METRICS_DIR, cache_lookup, collect_pools, flush, render as render_metrics
+from datetime import datetime, timedelta
+from time import time as now, perf_counter
+import asyncio
+import hashlib
 import newrelic.agent
 
 # Initialize stuff for the api
 newrelic.agent.initialize('/app/newrelic.ini')
 app = Quart(__name__)
 logger = BotLog('api')
-db = Config()
+# Identical requests that arrive together share one query
+flights = SingleFlight()
+# Aggregate results, dropped when new rows land in what they were built from
+result_cache = ResultCache()
+# Under serve.py every worker reads the snapshots and history one refresher process publishes
+shared = SharedState.attach(SHARED_STATE) if SHARED_STATE else None
+# Under serve.py, the task sharing this worker's metrics with the others' /metrics
+metrics_flush = None
+# One Storage (MariaDB, or a local SQLite copy of it, picked by STORAGE_BACKEND) per database
+# in the campus registry, and each campus' own snapshots, aggregates and subscribers
+databases, services = build(registry, flights, result_cache, shared=shared)
+
+@app.before_serving
+async def startup():
+    """
+    Create the database pools once the event loop is running
+    """
+    global metrics_flush
+    for db in databases.values():
+        await db.retry_connection()
+    for site in services.values():
+        site.start()
+        # Load history in the background; requests that arrive first load their table themselves
+        asyncio.ensure_future(site.analytics.preload(site.campus.tables))
+    if METRICS_DIR:
+        metrics_flush = asyncio.ensure_future(flush(databases.values()))
+
+@app.after_serving
+async def shutdown():
+    """
+    Close the database pools when the server stops
+    """
+    if metrics_flush:
+        metrics_flush.cancel()
+        await asyncio.gather(metrics_flush, return_exceptions=True)
+    for site in services.values():
+        await site.stop()
+    for db in databases.values():
+        await db.close()
+    if shared:
+        shared.close()
+
+@app.before_request
+async def start_timer():
+    """
+    Note when the request arrived, for the latency histogram
+    """
+    g.started = perf_counter()
+
+@app.after_request
+async def record_request(response):
+    """
+    Record the request's latency by route (the rule, so path arguments don't add series)
+    and whether a conditional request was answered from the client's cache. Under serve.py,
+    flag responses served from a state the refresher has stopped refreshing.
+    """
+    started = getattr(g, 'started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(route, request.method, str(response.status_code), value=perf_counter() - started)
+    if request.if_none_match:
+        cache_lookup('etag', response.status_code == 304)
+    if shared and shared.stale():
+        response.headers['Warning'] = '110 - "Response is Stale"'
+    return response
 
 @newrelic.agent.background_task()
 def valid_api_key(request: request) -> bool:
@@ -23,12 +102,94 @@ def valid_api_key(request: request) -> bool:
         logger.error(f'Given API key: {api_key}')
         return False
     return True
+def resolve(args) -> tuple:
+    """
+    The campus services, table and shuttle flag a request is for, from its campus, table and
+    shuttle arguments. Only registered tables are accepted, so nothing from the request is
+    ever put into SQL.
+    :param args: request.args or websocket.args
+    :return: (CampusServices, table, shuttle)
+    """
+    campus, table, shuttle = registry.resolve(args.get('campus'), args.get('table'), True if args.get('shuttle') else False)
+    return services[campus.key], table, shuttle
+
+async def make_etag(endpoint, table, shuttle, *params) -> str:
+    """
+    Build a weak ETag from the newest scrape timestamp of a table, which the latest
+    snapshot already holds in memory, so validating a request never touches the database.
+    :param endpoint: The route the ETag is for
+    :param table: The table the route reads
+    :param shuttle: Whether it's the shuttle data
+    :param params: Anything else the response depends on
+    :return: The opaque tag, without quotes
+    """
+    snapshot = await services[registry.resolve(table=table)[0].key].snapshots.get(table, shuttle=shuttle)
+    key = repr((endpoint, table, shuttle, str(snapshot.last_seen)) + params)
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+async def cached(key, table, factory, **scope):
+    """
+    An aggregate result from the result cache; misses that arrive together share one computation
+    :param key: Everything the result depends on, starting with the endpoint
+    :param table: The table it reads
+    :param factory: A callable returning the coroutine computing it
+    :param scope: averages and/or windows, the readings it's built from (see ResultCache.run)
+    :return:
+    """
+    return await result_cache.run(key, table, lambda: flights.run(key, factory), **scope)
+
+def not_modified(etag) -> Response:
+    """
+    An empty 304 carrying the ETag the client already has
+    :param etag:
+    :return:
+    """
+    response = Response('', status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept'
+    return response
+
+def not_ready(e) -> Response:
+    """
+    A 503 for a table a serve.py worker can't serve until the refresher first publishes it
+    :param e: The NotPublished
+    :return:
+    """
+    response = jsonify({"error": f"Not ready yet: {e}"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(SNAPSHOT_INTERVAL)
+    return response
+
+def with_etag(response, etag) -> Response:
+    """
+    Attach a weak ETag to a response and ask clients to revalidate every time
+    :param response:
+    :param etag:
+    :return:
+    """
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept'
+    return response
+
+def encoded(typed, mimetype) -> Response:
+    """
+    A MessagePack or Arrow response from typed (columns, meta)
+    :param typed:
+    :param mimetype:
+    :return:
+    """
+    columns, meta = typed
+    return Response(encode_table(columns, meta, mimetype), mimetype=mimetype)
+
 @newrelic.agent.background_task()
 @app.route('/latest')
-def get_latest():
+async def get_latest():
     """
     This route returns the latest data from a specified table in the database.
     :param table: The table to get the latest data from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
     :param shuttle: Whether to get the shuttle data
     :return: The latest data from the specified table
     """
@@ -37,21 +198,34 @@ def get_latest():
         pass
 
     logger.info(f'Got API request for latest data from {request.remote_addr}')
-    table = request.args.get('table')
-    shuttle = request.args.get('shuttle')
     try:
-        result = db.get_latest(table, shuttle=True if shuttle else False)
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        etag = await make_etag('latest', table, shuttle, mimetype)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        # Served from the in-memory snapshot, which refreshes itself in the background
+        snapshot = await site.snapshots.get(table, shuttle=shuttle)
+        if mimetype != JSON:
+            return with_etag(encoded(snapshot.columns(), mimetype), etag)
+        result = snapshot.render()
         logger.info(f'Got latest data from {request.remote_addr}\n{result}')
+    except NotPublished as e:
+        return not_ready(e)
     except Exception as e:
         logger.error(f'Error getting latest data: {e}')
         return jsonify({"error": f"Error getting latest data"}), 500
-    return jsonify(result)
+    return with_etag(jsonify(result), etag)
 @newrelic.agent.background_task()
 @app.route('/yesterday')
-def get_yesterday():
+async def get_yesterday():
     """
     This route returns yesterday's data from a specified table in the database.
     :param table: The table to get yesterday's data from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
     :param shuttle: Whether to get the shuttle data
     :return: Yesterday's data from the specified table
     """
@@ -60,21 +234,37 @@ def get_yesterday():
         pass
 
     logger.info(f'Got API request for latest data from {request.remote_addr}')
-    table = request.args.get('table')
-    shuttle = request.args.get('shuttle')
     try:
-        results = db.get_yesterday(table, shuttle=True if shuttle else False)
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        # The window slides with the clock, so the tag and cached result also change every five minutes
+        clock_bucket = int(now() // 300)
+        etag = await make_etag('yesterday', table, shuttle, site.analytics.watermarks.get(table), clock_bucket, mimetype)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        key = ('yesterday', table, shuttle, mimetype, clock_bucket)
+        scope = {'windows': [window_scope(*YESTERDAY)]}
+        if mimetype != JSON:
+            typed = await cached(key, table, lambda: site.analytics.typed_window(table, *YESTERDAY, shuttle=shuttle), **scope)
+            return with_etag(encoded(typed, mimetype), etag)
+        results = await cached(key, table, lambda: site.analytics.get_yesterday(table, shuttle=shuttle), **scope)
+    except NotPublished as e:
+        return not_ready(e)
     except Exception as e:
         logger.error(f'Error getting latest data: {e}')
         return jsonify({"error": f"Error getting yesterday's data"}), 500
 
-    return jsonify(results)
+    return with_etag(jsonify(results), etag)
 @newrelic.agent.background_task()
 @app.route('/lastweek')
-def get_last_week():
+async def get_last_week():
     """
     This route returns data from the last week from a specified table in the database.
     :param table: The table to get the data from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
     :param shuttle: Whether to get the shuttle data
     :return: Data from the last week from the specified table
     """
@@ -82,22 +272,37 @@ def get_last_week():
         # We have a valid API key, allow for custom SQL parameters (extract them here)
         pass
     logger.info(f'Got API request for yesterday\'s data from {request.remote_addr}')
-    table = request.args.get('table')
-    shuttle = request.args.get('shuttle')
     try:
-        results = db.get_last_week(table, shuttle=True if shuttle else False)
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        clock_bucket = int(now() // 300)
+        etag = await make_etag('lastweek', table, shuttle, site.analytics.watermarks.get(table), clock_bucket, mimetype)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        key = ('lastweek', table, shuttle, mimetype, clock_bucket)
+        scope = {'windows': [window_scope(*LAST_WEEK)]}
+        if mimetype != JSON:
+            typed = await cached(key, table, lambda: site.analytics.typed_window(table, *LAST_WEEK, shuttle=shuttle), **scope)
+            return with_etag(encoded(typed, mimetype), etag)
+        results = await cached(key, table, lambda: site.analytics.get_last_week(table, shuttle=shuttle), **scope)
+    except NotPublished as e:
+        return not_ready(e)
     except Exception as e:
         logger.error(f'Error getting latest data: {e}')
         return jsonify({"error": f"Error getting latest data"}), 500
-    return jsonify(results)
+    return with_etag(jsonify(results), etag)
 
 # TODO: Implement semesters
 @newrelic.agent.background_task()
 @app.route('/average')
-def get_average():
+async def get_average():
     """
     This route returns the average fullness of a specified day of the week for the current semester.
     :param table: The table to get the average fullness from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
     :param day: The day of the week to get the average fullness for
     :param time: The time to get the average fullness for
     :param shuttle: Whether to get the shuttle data
@@ -107,25 +312,295 @@ def get_average():
         # We have a valid API key, allow for custom SQL parameters (extract them here)
         pass
     logger.info(f'Got API request for average fullness from {request.remote_addr}')
-    table = request.args.get('table')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
     day = request.args.get('day')
     time = request.args.get('time')
-    shuttle = request.args.get('shuttle')
-    # convert time to datetime
-    time = datetime.strptime(time, '%H:%M:%S').time()
+    # convert time to datetime, rounded down to the rollup bucket so nearby times share a cached result
+    time = bucket_time(datetime.strptime(time, '%H:%M:%S').time())
+    mimetype = negotiate(request.accept_mimetypes)
     try:
-        results = db.get_average(table, day, time, shuttle=True if shuttle else False)
+        day = day_name(day or '')
+        etag = await make_etag('average', table, shuttle, site.analytics.watermarks.get(table), day, str(time), mimetype)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        key = ('average', table, shuttle, day, time, mimetype)
+        scope = {'averages': [average_scope(day, time)]}
+        if mimetype != JSON:
+            typed = await cached(key, table, lambda: site.analytics.typed_average(table, day, time, shuttle=shuttle), **scope)
+            return with_etag(encoded(typed, mimetype), etag)
+        results = await cached(key, table, lambda: site.analytics.get_average(table, day, time, shuttle=shuttle), **scope)
+    except ValueError as e:
+        logger.error(f'Invalid day for average fullness: {day}')
+        return jsonify({"error": f"Invalid day: {day}"}), 400
+    except NotPublished as e:
+        return not_ready(e)
     except Exception as e:
         logger.error(f'Error getting average fullness: {e}')
         return jsonify({"error": f"Error getting average fullness"}), 500
-    return jsonify(results)
+    return with_etag(jsonify(results), etag)
+@newrelic.agent.background_task()
+@app.route('/average/batch')
+async def get_average_batch():
+    """
+    This route returns the average fullness for several days at once, keyed by day.
+    Either give a list of days and one time, or a list of day@time pairs.
+    :param table: The table to get the average fullness from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param days: Comma separated days of the week, e.g. Monday,Wednesday,Friday
+    :param time: The time to get the average fullness for (with days)
+    :param pairs: Comma separated day@time pairs, e.g. Monday@10:00:00,Friday@12:30:00
+    :param shuttle: Whether to get the shuttle data
+    :return: {day: the /average response for that day}
+    """
+    logger.info(f'Got API request for batch average fullness from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        if request.args.get('pairs'):
+            pairs = [pair.split('@') for pair in request.args.get('pairs').split(',') if pair.strip()]
+            pairs = [(day.strip(), datetime.strptime(time.strip(), '%H:%M:%S').time()) for day, time in pairs]
+        else:
+            time = datetime.strptime(request.args.get('time'), '%H:%M:%S').time()
+            pairs = [(day.strip(), time) for day in request.args.get('days', '').split(',') if day.strip()]
+    except (TypeError, ValueError) as e:
+        logger.error(f'Invalid batch average parameters: {request.args}')
+        return jsonify({"error": "Give days and time, or day@HH:MM:SS pairs"}), 400
+    if not pairs:
+        return jsonify({"error": "Give days and time, or day@HH:MM:SS pairs"}), 400
+
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        pairs = [(day_name(day), bucket_time(time)) for day, time in pairs]
+        etag = await make_etag('average/batch', table, shuttle, site.analytics.watermarks.get(table), mimetype, *(f'{d}@{t}' for d, t in pairs))
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        key = ('average/batch', table, shuttle, tuple(pairs), mimetype)
+        scope = {'averages': [average_scope(day, time) for day, time in pairs]}
+        if mimetype != JSON:
+            typed = await cached(key, table, lambda: site.analytics.typed_average_batch(table, pairs, shuttle=shuttle), **scope)
+            return with_etag(encoded(typed, mimetype), etag)
+        results = await cached(key, table, lambda: site.analytics.get_average_batch(table, pairs, shuttle=shuttle), **scope)
+    except ValueError as e:
+        logger.error(f'Invalid days for batch average fullness: {e}')
+        return jsonify({"error": str(e)}), 400
+    except NotPublished as e:
+        return not_ready(e)
+    except Exception as e:
+        logger.error(f'Error getting batch average fullness: {e}')
+        return jsonify({"error": f"Error getting average fullness"}), 500
+    return with_etag(jsonify(results), etag)
+@newrelic.agent.background_task()
+@app.route('/distribution')
+async def get_distribution():
+    """
+    This route returns percentiles and a histogram of fullness per garage for a day of the week and time.
+    :param table: The table to get the distribution from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param day: The day of the week, e.g. Tuesday
+    :param time: The time of day the window ends at, HH:MM:SS
+    :param minutes: How long the window before the time is (default 60)
+    :param percentiles: Comma separated percentiles (default 50,90,99)
+    :param bin_width: Values per histogram bin (default 10)
+    :param shuttle: Whether to get the shuttle data
+    :return: The percentiles, sample count and histogram of every garage or stop. A shuttle percentile
+        in the top bin is only a lower bound and reads e.g. "100+ minutes" (pN_clipped in the binary encodings).
+    """
+    logger.info(f'Got API request for distribution from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    if not site.distributions:
+        return jsonify({"error": "Distributions need SERIES_ENGINE enabled"}), 503
+    day = request.args.get('day')
+    try:
+        time = datetime.strptime(request.args.get('time', ''), '%H:%M:%S').time()
+        minutes = int(request.args.get('minutes', 60))
+        points = [float(point) for point in request.args.get('percentiles', '50,90,99').split(',') if point.strip()]
+        bin_width = int(request.args.get('bin_width', 10))
+    except ValueError:
+        return jsonify({"error": "Give a day, an HH:MM:SS time and numeric minutes, percentiles and bin_width"}), 400
+
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        etag = await make_etag('distribution', table, shuttle, site.analytics.watermarks.get(table), day, str(time),
+                               minutes, tuple(points), bin_width, mimetype)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        day = day_name(day or '')
+        result = await flights.run(
+            ('distribution', table, shuttle, day, time, minutes, tuple(points), bin_width),
+            lambda: site.distributions.distribution(table, day, time, minutes=minutes, points=points,
+                                               bin_width=bin_width, shuttle=shuttle))
+    except ValueError as e:
+        logger.error(f'Invalid distribution request: {e}')
+        return jsonify({"error": str(e)}), 400
+    except NotPublished as e:
+        return not_ready(e)
+    except Exception as e:
+        logger.error(f'Error getting distribution: {e}')
+        return jsonify({"error": "Error getting distribution"}), 500
+    if mimetype != JSON:
+        return with_etag(encoded(site.distributions.columns(result, shuttle=shuttle), mimetype), etag)
+    return with_etag(jsonify(site.distributions.render(result, day, time, shuttle=shuttle)), etag)
+@newrelic.agent.background_task()
+@app.route('/forecast')
+async def get_forecast():
+    """
+    This route predicts the fullness of every garage (or shuttle ETA of every stop) at future times.
+    :param table: The table to forecast
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param time: Comma separated HH:MM:SS times, each the next time that time comes around
+    :param day: Optional day of the week the times are on, e.g. Friday
+    :param minutes: Comma separated minutes from now, instead of or as well as times
+    :param name: Optional comma separated parts of garage or stop names to keep
+    :param shuttle: Whether to get the shuttle data
+    :return: One forecast per name and time
+    """
+    logger.info(f'Got API request for forecast from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    if not site.forecaster:
+        return jsonify({"error": "Forecasts need SERIES_ENGINE enabled"}), 503
+    names = [name.strip() for name in request.args.get('name', '').split(',') if name.strip()]
+    try:
+        times = [datetime.strptime(time.strip(), '%H:%M:%S').time()
+                 for time in request.args.get('time', '').split(',') if time.strip()]
+        minutes = [int(minute) for minute in request.args.get('minutes', '').split(',') if minute.strip()]
+    except ValueError:
+        return jsonify({"error": "Give HH:MM:SS times or whole minutes ahead"}), 400
+
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        # Forecasts move with the clock, so the tag also changes every minute
+        etag = await make_etag('forecast', table, shuttle, site.analytics.watermarks.get(table), int(now() // 60), mimetype,
+                               request.args.get('time'), request.args.get('day'), request.args.get('minutes'), *names)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        await site.analytics.ensure(table, shuttle=shuttle)
+        targets = site.forecaster.targets(table, times=times, minutes=minutes, day=request.args.get('day'))
+        result = await flights.run(('forecast', table, shuttle, tuple(targets), tuple(names)),
+                                   lambda: site.forecaster.forecast(table, targets, names=names, shuttle=shuttle))
+    except ValueError as e:
+        logger.error(f'Invalid forecast request: {e}')
+        return jsonify({"error": str(e)}), 400
+    except NotPublished as e:
+        return not_ready(e)
+    except Exception as e:
+        logger.error(f'Error getting forecast: {e}')
+        return jsonify({"error": "Error getting forecast"}), 500
+    if mimetype != JSON:
+        return with_etag(encoded(site.forecaster.columns(result, shuttle=shuttle), mimetype), etag)
+    return with_etag(jsonify(site.forecaster.render(result, shuttle=shuttle)), etag)
+@newrelic.agent.background_task()
+@app.route('/at')
+async def get_at():
+    """
+    This route returns each garage's newest reading at or before one or more instants, and
+    each stop's shuttle ETA, for incident reviews and rebuilding timelines.
+    :param timestamp: Comma separated YYYY-MM-DD HH:MM:SS timestamps, in the scraper's local time
+    :param campus: The campus; both its garages and its shuttles unless table or shuttle is given
+    :param table: Only this table
+    :param name: Optional comma separated parts of garage or stop names to keep
+    :param shuttle: Only the shuttle data
+    :return: One reading per name and timestamp, oldest timestamp first
+    """
+    logger.info(f'Got API request for readings as of {request.args.get("timestamp")} from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    tables = {table: shuttle} if request.args.get('table') or request.args.get('shuttle') else site.campus.tables
+    names = [name.strip() for name in request.args.get('name', '').split(',') if name.strip()]
+    try:
+        instants = parse_instants(request.args.get('timestamp'))
+    except ValueError as e:
+        return jsonify({"error": f"Give YYYY-MM-DD HH:MM:SS timestamps: {e}"}), 400
+
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        # Past readings don't change, but timestamps past the newest scrape pick up new rows
+        tags = [await make_etag('at', t, s, mimetype, *instants, *names) for t, s in tables.items()]
+        etag = hashlib.sha1(''.join(tags).encode()).hexdigest()[:20]
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        rows = await flights.run(('at', tuple(tables), tuple(instants), tuple(names)),
+                                 lambda: site.asof.lookup(tables, instants, names=names))
+    except NotPublished as e:
+        return not_ready(e)
+    except Exception as e:
+        logger.error(f'Error getting readings as of {instants}: {e}')
+        return jsonify({"error": "Error getting readings"}), 500
+    if mimetype != JSON:
+        return with_etag(encoded(site.asof.columns(rows), mimetype), etag)
+    return with_etag(jsonify(site.asof.render(rows)), etag)
+@newrelic.agent.background_task()
+@app.route('/series')
+async def get_series():
+    """
+    This route returns each garage's fullness (or stop's shuttle ETA) over a range as a chart-ready
+    series, downsampled on the server to a fixed number of points however long the range is.
+    :param table: The table to read
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param start: YYYY-MM-DD HH:MM:SS, default a day before end
+    :param end: YYYY-MM-DD HH:MM:SS, default the newest scrape
+    :param points: Most points per name, default 200
+    :param method: lttb (largest-triangle-three-buckets, the default) or minmax (each bucket's extremes)
+    :param name: Optional comma separated parts of garage or stop names to keep
+    :param shuttle: Whether to get the shuttle data
+    :return: One series per name, with how many readings it was cut down from
+    """
+    logger.info(f'Got API request for series from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    names = [name.strip() for name in request.args.get('name', '').split(',') if name.strip()]
+    method = request.args.get('method', 'lttb').lower()
+    try:
+        points = int(request.args.get('points', DEFAULT_POINTS))
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else None
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else None
+    except ValueError:
+        return jsonify({"error": "Give YYYY-MM-DD HH:MM:SS start and end times and a whole number of points"}), 400
+
+    mimetype = negotiate(request.accept_mimetypes)
+    try:
+        etag = await make_etag('series', table, shuttle, mimetype, start, end, points, method, *names)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+        if end is None:
+            # Just past the newest scrape, so it's included
+            end = (await site.snapshots.get(table, shuttle=shuttle)).last_seen + timedelta(seconds=1)
+        start = start or end - timedelta(days=1)
+        result = await flights.run(('series', table, shuttle, start, end, points, method, tuple(names)),
+                                   lambda: site.downsampler.series(table, start, end, points=points, method=method,
+                                                                   names=names, shuttle=shuttle))
+    except ValueError as e:
+        logger.error(f'Invalid series request: {e}')
+        return jsonify({"error": str(e)}), 400
+    except NotPublished as e:
+        return not_ready(e)
+    except Exception as e:
+        logger.error(f'Error getting series: {e}')
+        return jsonify({"error": "Error getting series"}), 500
+    if mimetype != JSON:
+        return with_etag(encoded(site.downsampler.columns(result, shuttle=shuttle), mimetype), etag)
+    return with_etag(jsonify(site.downsampler.render(result, shuttle=shuttle)), etag)
 @newrelic.agent.background_task()
 @app.route('/query')
-def run_query():
+async def run_query():
     """
     This route runs a specified SQL query on the database and returns the results.
     :param query: The SQL query to run
-    :param shuttle: Whether to get the shuttle data
+    :param campus: The campus whose database to run it on (default DEFAULT_CAMPUS)
     :return: The results of the SQL query
     """
     if not valid_api_key(request):
@@ -134,24 +609,181 @@ def run_query():
     logger.info(f'Got API request to run query {request.remote_addr}')
     logger.info(f'Query: {request.args.get("query")}')
     sql_query = request.args.get('query')
-    shuttle = request.args.get('shuttle')
-    # Run query
     try:
-        results = db.run_query(sql_query)
+        site = services[registry.get(request.args.get('campus')).key]
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    # Check and start the query before streaming so bad SQL still gets a proper error
+    try:
+        query = site.db.guarded_query(sql_query)
+    except QueryRejected as e:
+        logger.error(f'Rejected query from {request.remote_addr}: {e}')
+        return jsonify({"error": f"Query rejected: {e}"}), 400
+    try:
+        await query.start()
     except Exception as e:
         logger.error(f'Error running query: {e}')
         return jsonify({"error": f"Error running query"}), 500
 
-    logger.info(f'Found {len(results)} results')
-    return_val = ''
+    # Rows are formatted into one string as they come off the server-side cursor
+    return Response(query.stream_parking_info(), mimetype='application/json')
+@newrelic.agent.background_task()
+@app.route('/export')
+async def export_history():
+    """
+    This route streams raw history from a table as NDJSON, CSV, MessagePack or Arrow IPC.
+    :param table: The table to export from
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param shuttle: Whether it's the shuttle data
+    :param name: Optional comma separated garage or stop names to keep
+    :param start: ISO start time (inclusive), defaults to a day before end
+    :param end: ISO end time (exclusive), defaults to now
+    :param format: ndjson (default), csv, msgpack or arrow
+    :return: The rows, oldest first, streamed with chunked transfer encoding
+    """
+    if not valid_api_key(request):
+        return jsonify({"error": "Invalid API Key"}), 401
+
+    logger.info(f'Got API request to export history from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    fmt = request.args.get('format', 'ndjson')
+    names = [name.strip() for name in request.args.get('name', '').split(',') if name.strip()]
+    try:
+        end = datetime.fromisoformat(request.args['end']) if request.args.get('end') else datetime.now()
+        start = datetime.fromisoformat(request.args['start']) if request.args.get('start') else end - timedelta(days=1)
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO timestamps"}), 400
+    if fmt not in FORMATS or not table:
+        return jsonify({"error": f"Give a table and a format of {', '.join(FORMATS)}"}), 400
 
-    # Format results into a string
-    for item in results:
-        parking_info = item.get('parking_info', '')
-        if parking_info:
-            return_val += parking_info + '\n'
-    logger.info(f'Results: {return_val}')
-    return jsonify(return_val)
+    try:
+        body = await site.exporter.open(table, start, end, names=names, shuttle=shuttle, fmt=fmt)
+    except ExportBusy as e:
+        logger.error(f'Export refused: {e}')
+        return jsonify({"error": "Too many exports running, try again shortly"}), 503
+    response = Response(body, mimetype=FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{table}-{start:%Y%m%d%H%M}-{end:%Y%m%d%H%M}.{fmt}"'
+    # Long ranges can legitimately stream for longer than Quart's default response timeout
+    response.timeout = None
+    return response
+@app.route('/stream')
+async def stream_updates():
+    """
+    This route pushes garage fullness or shuttle ETA changes as server-sent events.
+    The first event is the current state; after that only changed names are sent.
+    :param table: The table to follow
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param shuttle: Whether it's the shuttle data
+    :return: A text/event-stream that stays open
+    """
+    logger.info(f'Got API request to stream updates from {request.remote_addr}')
+    try:
+        site, table, shuttle = resolve(request.args)
+    except UnknownCampus as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        subscription = await site.broadcaster.subscribe(table, shuttle=shuttle)
+    except NotPublished as e:
+        return not_ready(e)
+    except Exception as e:
+        logger.error(f'Error subscribing to updates: {e}')
+        return jsonify({"error": "Error subscribing to updates"}), 500
+
+    async def events():
+        try:
+            async for frame in subscription.sse():
+                yield frame
+        finally:
+            site.broadcaster.unsubscribe(subscription)
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Tell nginx not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.timeout = None
+    return response
+@app.websocket('/ws')
+async def websocket_updates():
+    """
+    The same updates as /stream over a WebSocket, one JSON message per event.
+    :param table: The table to follow
+    :param campus: The campus, instead of a registered table (default DEFAULT_CAMPUS)
+    :param shuttle: Whether it's the shuttle data
+    """
+    try:
+        site, table, shuttle = resolve(websocket.args)
+    except UnknownCampus as e:
+        logger.error(f'Rejected WebSocket subscription: {e}')
+        await websocket.close(1008)
+        return
+    try:
+        subscription = await site.broadcaster.subscribe(table, shuttle=shuttle)
+    except NotPublished as e:
+        logger.error(f'Rejected WebSocket subscription: {e}')
+        # Try again later
+        await websocket.close(1013)
+        return
+    try:
+        async for message in subscription.messages():
+            # WebSocket pings keep the connection alive, so skip the keepalives
+            if message:
+                await websocket.send(message.data)
+    finally:
+        site.broadcaster.unsubscribe(subscription)
+@newrelic.agent.background_task()
+@app.route('/refresh', methods=['POST'])
+async def refresh():
+    """
+    This route lets the scraper push a notification that it wrote new rows,
+    so the latest snapshots refresh now instead of at the next interval.
+    :return: 202 once the refresh has been scheduled
+    """
+    if not valid_api_key(request):
+        return jsonify({"error": "Invalid API Key"}), 401
+    for site in services.values():
+        site.snapshots.invalidate()
+    return jsonify({"scheduled": True}), 202
+@app.route('/health')
+async def health():
+    """
+    This route pings every database and reports the connection pool usage, request coalescing,
+    result cache and, under serve.py, the age of the shared state.
+    :return: 200 if every database is reachable (and under serve.py the refresher is alive and has
+        published), 503 otherwise
+    """
+    checks = {site.campus.key: site.db for site in services.values()}
+    results = {key: await db.health_check() for key, db in checks.items()}
+    pools = {key: db.pool_status() for key, db in checks.items()}
+    healthy = all(results.values())
+    report = {"healthy": healthy, "campuses": results, "pool": pools[registry.default], "pools": pools,
+              "coalescing": flights.stats(), "result_cache": result_cache.stats()}
+    if shared:
+        report["shared_state"] = shared.stats()
+        healthy = healthy and report["shared_state"]["ready"] and not report["shared_state"]["stale"]
+        report["healthy"] = healthy
+    return jsonify(report), 200 if healthy else 503
+@app.route('/campuses')
+async def list_campuses():
+    """
+    This route lists the registered campuses, their timezones, garages and tables.
+    :return: One entry per campus, the default one first
+    """
+    default = registry.get()
+    others = [campus for key, campus in registry.campuses.items() if key != default.key]
+    return jsonify([campus.describe() for campus in [default] + others])
+@app.route('/metrics')
+async def metrics():
+    """
+    This route exposes request and query latency, rows returned, cache hits, pool usage and
+    reconnects in the Prometheus text format, from counters kept in process. Under serve.py
+    they cover every worker and the refresher, whichever worker answers.
+    :return:
+    """
+    collect_pools(databases.values())
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,94 @@
+from datetime import datetime
+from api_log import BotLog
+import newrelic.agent
+
+logger = BotLog('api-asof')
+
+# Most instants per request, e.g. a day at 15-minute steps
+MAX_INSTANTS = 96
+# (name, instant) pairs per statement; SQLite caps a compound select at 500 members
+PAIRS_PER_QUERY = 200
+
+
+def parse_instants(value) -> list:
+    """
+    Comma separated timestamps, as 'YYYY-MM-DD HH:MM:SS' or with a T, in the scraper's local time
+    :param value:
+    :return: datetimes, oldest first, without duplicates
+    """
+    instants = sorted({datetime.fromisoformat(part.strip()).replace(microsecond=0)
+                       for part in (value or '').split(',') if part.strip()})
+    if not instants:
+        raise ValueError('Give at least one timestamp')
+    if len(instants) > MAX_INSTANTS:
+        raise ValueError(f'At most {MAX_INSTANTS} timestamps can be looked up at once')
+    return instants
+
+
+class AsOf:
+    """
+    Point in time lookups: each garage's (or stop's) newest reading at or before an instant,
+    for incident reviews and rebuilding timelines. Reads the database rather than the
+    in-memory series, which only keep recent readings and compacted averages.
+    """
+    def __init__(self, db, snapshots):
+        """
+        :param db: The Storage to query
+        :param snapshots: The SnapshotStore, whose snapshots know every name in a table
+        """
+        self.db = db
+        self.snapshots = snapshots
+
+    @newrelic.agent.background_task()
+    async def lookup(self, tables, instants, names=None) -> list:
+        """
+        The reading of every name in every table as of every instant
+        :param tables: {table: shuttle}
+        :param instants: datetimes from parse_instants()
+        :param names: Optional case insensitive substrings of the names to keep
+        :return: A list of {'at', 'name', 'value', 'time', 'shuttle'} dicts ordered by instant,
+            garages before stops, then name; names with no reading that early are left out
+        """
+        rows = []
+        for table, shuttle in tables.items():
+            snapshot = await self.snapshots.get(table, shuttle=shuttle)
+            kept = [name for name in sorted(snapshot.latest)
+                    if not names or any(n.lower() in name.lower() for n in names)]
+            pairs = [(name, at) for at in instants for name in kept]
+            for start in range(0, len(pairs), PAIRS_PER_QUERY):
+                chunk = pairs[start:start + PAIRS_PER_QUERY]
+                for row in await self.db.get_at_rows(table, chunk, shuttle=shuttle):
+                    rows.append({'at': chunk[row['pair']][1], 'name': row['name'], 'value': row['value'],
+                                 'time': row['time'], 'shuttle': shuttle})
+        rows.sort(key=lambda row: (row['at'], row['shuttle'], row['name']))
+        return rows
+
+    @staticmethod
+    def render(rows) -> list:
+        """
+        Readings as rows in the style of the other endpoints
+        :param rows: From lookup()
+        :return:
+        """
+        results = []
+        for row in rows:
+            key, value, unit = ('stop_name', 'time_to_departure', ' minutes') if row['shuttle'] \
+                else ('name', 'fullness', '%')
+            results.append({'at': str(row['at']), key: row['name'], value: f"{row['value']}{unit}",
+                            'time': str(row['time'])})
+        return results
+
+    @staticmethod
+    def columns(rows) -> tuple:
+        """
+        Readings as typed columns, garages and stops together with a shuttle flag
+        :param rows: From lookup()
+        :return: (columns, meta)
+        """
+        return {
+            'at': [row['at'] for row in rows],
+            'name': [row['name'] for row in rows],
+            'value': [row['value'] for row in rows],
+            'time': [row['time'] for row in rows],
+            'shuttle': [row['shuttle'] for row in rows],
+        }, {}
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the parking-api. Run from src/parking-api with the usual DB_* variables set:
+
+    python -m bench.generate --sizes 7,180,730
+    python -m bench.load --sizes 7,180,730 --output report.json [--baseline previous.json]
+"""
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+from datetime import datetime, timedelta
+import numpy as np
+from api_log import BotLog
+from storage import make_storage
+from migrate import ensure_history, apply
+
+logger = BotLog('api-bench-generate')
+
+# Garages and addresses as the scraper reports them; the scale sets how full each one gets
+GARAGES = {
+    'South Garage': ('377 S. 7th St., San Jose, CA 95112', 1.0),
+    'West Garage': ('350 S. 4th St., San Jose, CA 95112', 0.95),
+    'North Garage': ('65 S. 10th St., San Jose, CA 95112', 0.8),
+    'South Campus Garage': ('1278 S. 10th Street, San Jose, CA 95112', 0.55),
+}
+# Shuttle stops and how many minutes behind the first stop each one is
+STOPS = {
+    'South Campus': 0,
+    'Student Union': 6,
+    'Engineering': 8,
+    'Campus Village': 11,
+}
+# Minutes between shuttles and the hours they run on weekdays
+SHUTTLE_PERIOD = 15
+SHUTTLE_HOURS = (7, 22)
+# Rows per INSERT
+BATCH = 5000
+# Table sizes in days of history
+DEFAULT_SIZES = (7, 180, 730)
+
+
+def in_semester(day) -> bool:
+    """
+    Whether a date falls in the spring (late January to mid May) or fall (late August to
+    early December) semester, when the garages fill up
+    :param day:
+    :return:
+    """
+    spring = (1, 22) <= (day.month, day.day) <= (5, 15)
+    fall = (8, 20) <= (day.month, day.day) <= (12, 10)
+    return spring or fall
+
+
+def daily_curve(weekday) -> np.ndarray:
+    """
+    Typical fullness for each minute of a day: a climb from 7am to a late morning peak,
+    a slow afternoon decline and a smaller bump for evening classes. Weekends stay quiet.
+    :param weekday: 0 for Monday
+    :return: 1440 values between 0 and 100
+    """
+    hours = np.arange(24 * 60) / 60
+    morning = 92 / (1 + np.exp(-(hours - 8.5) * 2.2))
+    afternoon = 1 / (1 + np.exp((hours - 15.5) * 1.1))
+    evening = 25 * np.exp(-((hours - 18.5) ** 2) / 2)
+    curve = 5 + morning * afternoon + evening * afternoon.clip(0.3)
+    if weekday == 4:
+        curve *= 0.75
+    elif weekday >= 5:
+        curve = 5 + 0.15 * (curve - 5)
+    return curve
+
+
+def garage_rows(start, days, rng, end=None):
+    """
+    One reading per garage per minute, with a few seconds of scrape jitter and noise that
+    wanders rather than jumps
+    :param start: Midnight of the first day
+    :param days:
+    :param rng: A numpy Generator
+    :param end: Leave out readings after this time
+    :return: Yields lists of (name, address, fullness, time) tuples
+    """
+    curves = [daily_curve(weekday) for weekday in range(7)]
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        scale = 1.0 if in_semester(day) else 0.35
+        rows = []
+        for name, (address, garage_scale) in GARAGES.items():
+            noise = np.cumsum(rng.normal(0, 0.6, 24 * 60))
+            noise -= np.linspace(0, noise[-1], 24 * 60)
+            fullness = np.clip(np.rint(curves[day.weekday()] * scale * garage_scale + noise), 0, 100).astype(int)
+            jitter = rng.integers(0, 20, 24 * 60)
+            rows.extend((name, address, int(fullness[m]), day + timedelta(minutes=m, seconds=int(jitter[m])))
+                        for m in range(24 * 60))
+        yield [row for row in rows if not end or row[3] <= end]
+
+
+def shuttle_rows(start, days, rng, end=None):
+    """
+    One reading per stop per minute while the shuttles run on weekdays, counting down to
+    the next departure with an occasional delay
+    :param start: Midnight of the first day
+    :param days:
+    :param rng: A numpy Generator
+    :param end: Leave out readings after this time
+    :return: Yields lists of (stop_name, time_to_departure, updated_at, day_of_week, hour_of_day,
+        rounded_time_to_departure) tuples, like the scraper inserts
+    """
+    minutes = np.arange(SHUTTLE_HOURS[0] * 60, SHUTTLE_HOURS[1] * 60)
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        if day.weekday() >= 5:
+            continue
+        rows = []
+        for stop, lag in STOPS.items():
+            eta = SHUTTLE_PERIOD - (minutes - lag) % SHUTTLE_PERIOD
+            eta = eta + rng.poisson(0.4, len(minutes))
+            for minute, value in zip(minutes.tolist(), eta.tolist()):
+                updated_at = day + timedelta(minutes=minute, seconds=int(rng.integers(0, 20)))
+                rows.append((stop, value, updated_at, updated_at.strftime('%A'), updated_at.hour, (value // 5) * 5))
+        yield [row for row in rows if not end or row[2] <= end]
+
+
+def table_names(prefix, days) -> tuple:
+    """
+    The garage and shuttle table names for one size
+    :param prefix:
+    :param days:
+    :return: (garage table, shuttle table)
+    """
+    return f'{prefix}-garages-{days}d', f'{prefix}-shuttles-{days}d'
+
+
+async def create_tables(db, garages, shuttles):
+    """
+    Create empty tables with the scraper's columns and bring them to the current migration
+    :param db:
+    :param garages:
+    :param shuttles:
+    :return:
+    """
+    if db.dialect == 'sqlite':
+        # The local copy's schema already carries what the migrations add
+        for table, shuttle in ((garages, False), (shuttles, True)):
+            await db.execute(f'DROP TABLE IF EXISTS `{table}`')
+            await db.write(db.create_table, table, shuttle)
+        return
+    for table in (garages, shuttles):
+        await db.execute(f'DROP TABLE IF EXISTS `{table}`')
+        await db.execute('DELETE FROM `schema_migrations` WHERE table_name = %s', (table,))
+    await db.execute(f'''
+        CREATE TABLE `{garages}` (
+            `id` INT AUTO_INCREMENT PRIMARY KEY,
+            `name` TEXT NOT NULL,
+            `address` TEXT NOT NULL,
+            `fullness` INT NOT NULL,
+            `time` DATETIME NOT NULL
+        )
+    ''')
+    await db.execute(f'''
+        CREATE TABLE `{shuttles}` (
+            `id` INT AUTO_INCREMENT PRIMARY KEY,
+            `stop_name` TEXT NOT NULL,
+            `time_to_departure` INT NOT NULL,
+            `updated_at` DATETIME NOT NULL,
+            `day_of_week` VARCHAR(16) NOT NULL,
+            `hour_of_day` INT NOT NULL,
+            `rounded_time_to_departure` INT NOT NULL
+        )
+    ''')
+    await apply(db, garages, False)
+    await apply(db, shuttles, True)
+
+
+async def insert(db, table, statement, batches) -> int:
+    """
+    Insert batches of rows BATCH at a time, each in its own transaction
+    :param db:
+    :param table:
+    :param statement: INSERT with %s placeholders for one row
+    :param batches: Iterable of lists of row tuples
+    :return: Rows inserted
+    """
+    count = 0
+    for rows in batches:
+        for i in range(0, len(rows), BATCH):
+            await db.executemany(statement, rows[i:i + BATCH])
+            count += len(rows[i:i + BATCH])
+        logger.info(f'{table}: {count} rows')
+    return count
+
+
+async def seed(db, prefix, days, seed_value):
+    """
+    Create and fill the garage and shuttle tables for one size: `days` full days of history plus today until now
+    :param db:
+    :param prefix:
+    :param days:
+    :param seed_value: Random seed, so every run builds the same history
+    :return: A summary dict
+    """
+    garages, shuttles = table_names(prefix, days)
+    rng = np.random.default_rng(seed_value)
+    end = datetime.now()
+    start = datetime.combine(end.date() - timedelta(days=days), datetime.min.time())
+    await create_tables(db, garages, shuttles)
+    garage_count = await insert(db, garages, f'INSERT INTO `{garages}` (name, address, fullness, time) VALUES (%s, %s, %s, %s)',
+                                garage_rows(start, days + 1, rng, end=end))
+    shuttle_count = await insert(db, shuttles, f'INSERT INTO `{shuttles}` (stop_name, time_to_departure, updated_at, '
+                                               f'day_of_week, hour_of_day, rounded_time_to_departure) VALUES (%s, %s, %s, %s, %s, %s)',
+                                 shuttle_rows(start, days + 1, rng, end=end))
+    return {'days': days, 'garages': garages, 'garage_rows': garage_count,
+            'shuttles': shuttles, 'shuttle_rows': shuttle_count}
+
+
+async def main(args):
+    """
+    Seed every requested size and print a JSON summary of the tables
+    :param args:
+    :return:
+    """
+    db = make_storage()
+    await db.retry_connection()
+    try:
+        if db.dialect == 'mariadb':
+            await ensure_history(db)
+        summary = [await seed(db, args.prefix, days, args.seed) for days in args.sizes]
+    finally:
+        await db.close()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed the STORAGE_BACKEND database with synthetic minute-level garage and shuttle history')
+    parser.add_argument('--sizes', type=lambda value: [int(v) for v in value.split(',')], default=list(DEFAULT_SIZES),
+                        help='Comma separated days of history, one pair of tables per size')
+    parser.add_argument('--prefix', default='bench', help='Table name prefix')
+    parser.add_argument('--seed', type=int, default=2023)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import json
+import platform
+import sys
+from datetime import datetime, time as clock
+from time import perf_counter
+import numpy as np
+from api_log import BotLog
+from bench.generate import DEFAULT_SIZES, table_names
+from campuses import registry, Campus
+
+logger = BotLog('api-bench-load')
+
+# Untimed calls per target first, so lazy loads (snapshots, the series engine) aren't measured
+WARMUP = 3
+# A p99 this much slower than the baseline's counts as a regression
+REGRESSION_RATIO = 1.25
+
+
+def summarize(latencies, wall, errors) -> dict:
+    """
+    Throughput and latency percentiles of one run
+    :param latencies: Seconds per successful call
+    :param wall: Seconds the whole run took
+    :param errors: Failed calls
+    :return:
+    """
+    latencies = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'throughput_rps': round((len(latencies) + errors) / wall, 2) if wall else None,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'mean_ms': round(float(latencies.mean()), 3),
+        'max_ms': round(float(latencies.max()), 3),
+    }
+
+
+async def measure(call, requests, concurrency) -> dict:
+    """
+    Run a call `requests` times from `concurrency` workers and time every call
+    :param call: A coroutine function taking no arguments; raising or returning False counts as an error
+    :param requests:
+    :param concurrency:
+    :return: summarize() of the run
+    """
+    for _ in range(WARMUP):
+        await call()
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = perf_counter()
+            try:
+                ok = await call() is not False
+            except Exception as e:
+                logger.error(f'Benchmark call failed: {e}')
+                ok = False
+            if ok:
+                latencies.append(perf_counter() - start)
+            else:
+                errors += 1
+
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, perf_counter() - start, errors)
+
+
+def config_targets(db, garages, shuttles) -> dict:
+    """
+    The Config queries to time against one size's tables
+    :param db:
+    :param garages:
+    :param shuttles:
+    :return: {name: coroutine function}
+    """
+    return {
+        'Config.get_latest': lambda: db.get_latest(garages),
+        'Config.get_latest_rows': lambda: db.get_latest_rows(garages),
+        'Config.get_newer_rows': lambda: db.get_newer_rows(garages, datetime.now().replace(minute=0, second=0)),
+        'Config.get_yesterday': lambda: db.get_yesterday(garages),
+        'Config.get_last_week': lambda: db.get_last_week(garages),
+        'Config.get_average': lambda: db.get_average(garages, 'Tuesday', clock(10, 0)),
+        'Config.get_average (shuttle)': lambda: db.get_average(shuttles, 'Tuesday', clock(10, 0), shuttle=True),
+    }
+
+
+def route_targets(client, garages, shuttles) -> dict:
+    """
+    The Quart routes to time against one size's tables, called in process
+    :param client: The app's test client
+    :param garages:
+    :param shuttles:
+    :return: {name: coroutine function}
+    """
+    routes = {
+        '/latest': ('/latest', {'table': garages}),
+        '/latest (shuttle)': ('/latest', {'table': shuttles, 'shuttle': 'true'}),
+        '/yesterday': ('/yesterday', {'table': garages}),
+        '/lastweek': ('/lastweek', {'table': garages}),
+        '/average': ('/average', {'table': garages, 'day': 'Tuesday', 'time': '10:00:00'}),
+        '/average/batch': ('/average/batch', {'table': garages, 'days': 'Monday,Wednesday,Friday', 'time': '10:00:00'}),
+        '/forecast': ('/forecast', {'table': garages, 'minutes': '15,30,60,120'}),
+        '/distribution': ('/distribution', {'table': garages, 'day': 'Tuesday', 'time': '10:00:00'}),
+    }
+
+    def get(path, args):
+        async def call():
+            response = await client.get(path, query_string=args)
+            await response.get_data()
+            return response.status_code == 200
+        return call
+
+    return {name: get(path, args) for name, (path, args) in routes.items()}
+
+
+async def row_count(db, table) -> int:
+    """
+    :param db:
+    :param table:
+    :return: Rows in a table
+    """
+    return (await db.fetch_all(f'SELECT COUNT(*) AS count FROM `{table}`'))[0]['count']
+
+
+async def run(args) -> dict:
+    """
+    Time every Config query and route at every size
+    :param args:
+    :return: The report
+    """
+    # Each size's tables are a campus of their own, registered before the app builds its services
+    for days in args.sizes:
+        garages, shuttles = table_names(args.prefix, days)
+        registry.add(Campus(f'{args.prefix}-{days}d', garages, shuttles=shuttles))
+    # Imported here so the app's globals are only built when routes are benchmarked
+    import api
+    results = []
+    async with api.app.test_app() as test_app:
+        client = test_app.test_client()
+        for days in args.sizes:
+            garages, shuttles = table_names(args.prefix, days)
+            db = api.services[f'{args.prefix}-{days}d'].db
+            rows = await row_count(db, garages)
+            targets = {}
+            if 'config' in args.only:
+                targets.update(config_targets(db, garages, shuttles))
+            if 'routes' in args.only:
+                targets.update(route_targets(client, garages, shuttles))
+            for name, call in targets.items():
+                logger.info(f'Benchmarking {name} against {garages}')
+                result = {'target': name, 'days': days, 'table': garages, 'rows': rows, 'concurrency': args.concurrency}
+                result.update(await measure(call, args.requests, args.concurrency))
+                results.append(result)
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'results': results,
+    }
+
+
+def regressions(report, baseline) -> list:
+    """
+    Targets whose p99 got more than REGRESSION_RATIO slower than in a baseline report
+    :param report:
+    :param baseline:
+    :return: Descriptions of each regression
+    """
+    before = {(r['target'], r['days']): r for r in baseline['results']}
+    found = []
+    for result in report['results']:
+        old = before.get((result['target'], result['days']))
+        if old and old['p99_ms'] and result['p99_ms'] > old['p99_ms'] * REGRESSION_RATIO:
+            found.append(f"{result['target']} at {result['days']} days: p99 {old['p99_ms']}ms -> {result['p99_ms']}ms")
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure throughput and latency of the parking-api queries and routes')
+    parser.add_argument('--sizes', type=lambda value: [int(v) for v in value.split(',')], default=list(DEFAULT_SIZES),
+                        help='Comma separated sizes (days) seeded by bench.generate')
+    parser.add_argument('--prefix', default='bench', help='Table name prefix used by bench.generate')
+    parser.add_argument('--requests', type=int, default=200, help='Timed calls per target and size')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--only', choices=['config', 'routes'], nargs='+', default=['config', 'routes'])
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='A previous report; exit 1 if any p99 regressed')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(report, json.load(file))
+        for regression in found:
+            logger.error(f'Regression: {regression}')
+        sys.exit(1 if found else 0)
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import json
+import platform
+import sys
+from datetime import datetime
+from api_log import BotLog
+from bench.generate import DEFAULT_SIZES, table_names
+from bench.load import measure, config_targets, row_count
+from campuses import registry, Campus
+from mariadb import Config
+
+logger = BotLog('api-bench-prepared')
+
+# Server counters compared between the modes: statements received, and SQL-level PREPARE/EXECUTE
+COUNTERS = ['Questions', 'Com_select', 'Com_prepare_sql', 'Com_execute_sql', 'Prepared_stmt_count']
+
+
+async def counters(db) -> dict:
+    """
+    The server's COUNTERS. They're global, so run this against a quiet server.
+    :param db:
+    :return:
+    """
+    rows = await db.fetch_all('SHOW GLOBAL STATUS WHERE Variable_name IN %s', (COUNTERS,))
+    return {row['Variable_name']: int(row['Value']) for row in rows}
+
+
+async def run(args) -> dict:
+    """
+    Time every Config query at every size with plain text queries, then as prepared statements
+    :param args:
+    :return: The report
+    """
+    # Prepared statements are only made for registered tables
+    for days in args.sizes:
+        garages, shuttles = table_names(args.prefix, days)
+        registry.add(Campus(f'{args.prefix}-{days}d', garages, shuttles=shuttles))
+    db = Config()
+    await db.retry_connection()
+    results = []
+    try:
+        for days in args.sizes:
+            garages, shuttles = table_names(args.prefix, days)
+            rows = await row_count(db, garages)
+            for name, call in config_targets(db, garages, shuttles).items():
+                modes = {}
+                for prepare in (False, True):
+                    db.prepare = prepare
+                    before = await counters(db)
+                    result = await measure(call, args.requests, args.concurrency)
+                    after = await counters(db)
+                    # Prepared_stmt_count is a gauge; the rest are totals
+                    result['server'] = {key: after[key] - before[key] if key != 'Prepared_stmt_count' else after[key]
+                                        for key in after}
+                    modes['prepared' if prepare else 'text'] = result
+                    logger.info(f'{name} at {days} days, {"prepared" if prepare else "text"}: p50 {result["p50_ms"]}ms')
+                text, prepared = modes['text'], modes['prepared']
+                results.append({
+                    'target': name,
+                    'days': days,
+                    'table': garages,
+                    'rows': rows,
+                    'text': text,
+                    'prepared': prepared,
+                    'p50_speedup': round(text['p50_ms'] / prepared['p50_ms'], 3) if prepared['p50_ms'] else None,
+                })
+    finally:
+        await db.close()
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'machine': platform.machine(),
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'pool_size': db.pool_size,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the Config queries as plain text and as server-side prepared statements')
+    parser.add_argument('--sizes', type=lambda value: [int(v) for v in value.split(',')], default=list(DEFAULT_SIZES),
+                        help='Comma separated sizes (days) seeded by bench.generate')
+    parser.add_argument('--prefix', default='bench', help='Table name prefix used by bench.generate')
+    parser.add_argument('--requests', type=int, default=200, help='Timed calls per target, size and mode')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
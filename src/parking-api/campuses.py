@@ -0,0 +1,200 @@
+import json
+import re
+from os import getenv, path
+from api_log import BotLog
+
+logger = BotLog('api-campuses')
+
+# The JSON registry of campuses; see campuses.json
+CAMPUSES_FILE = getenv("CAMPUSES_FILE", path.join(path.dirname(path.abspath(__file__)), 'campuses.json'))
+# The campus requests without a campus or table are for
+DEFAULT_CAMPUS = getenv("DEFAULT_CAMPUS", "sjsu")
+# Table names end up in SQL, so only names made of these characters are accepted
+IDENTIFIER = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# Used when there's no registry file: the one campus the API started with
+BUILT_IN = {
+    'sjsu': {
+        'name': 'San José State University',
+        'garages': 'sjsu',
+        'shuttles': 'sjsu-shuttles',
+        'timezone': 'America/Los_Angeles',
+    },
+}
+
+
+class UnknownCampus(ValueError):
+    """
+    Raised when a request names a campus or table that isn't in the registry
+    """
+
+
+def identifier(value, field) -> str:
+    """
+    Check a campus key or table name is safe to put in SQL
+    :param value:
+    :param field: What the value is, for the error
+    :return: The value
+    """
+    if not isinstance(value, str) or not IDENTIFIER.match(value):
+        raise ValueError(f'Invalid {field}: {value!r}')
+    return value
+
+
+class Campus:
+    """
+    One campus (or feed): its garage and shuttle tables, timezone, garages and, optionally,
+    the database it lives in when that isn't the DB_* one.
+    """
+    def __init__(self, key, garages, shuttles=None, name=None, timezone='America/Los_Angeles',
+                 garage_list=None, database=None):
+        """
+        :param key: Short id used in requests, e.g. sjsu
+        :param garages: The garage table
+        :param shuttles: The shuttle table, if the campus has shuttles
+        :param name: Display name
+        :param timezone: IANA timezone the scraper's timestamps are in
+        :param garage_list: The garages the scraper reports, for clients
+        :param database: {'host', 'port', 'name', 'user', 'password'} overriding the DB_* settings
+        """
+        self.key = identifier(key, 'campus')
+        self.garages = identifier(garages, 'garage table')
+        self.shuttles = identifier(shuttles, 'shuttle table') if shuttles else None
+        self.name = name or key
+        self.timezone = timezone
+        self.garage_list = list(garage_list or [])
+        self.database = dict(database or {})
+
+    @property
+    def tables(self) -> dict:
+        """
+        {table: shuttle} for this campus
+        :return:
+        """
+        tables = {self.garages: False}
+        if self.shuttles:
+            tables[self.shuttles] = True
+        return tables
+
+    @property
+    def database_key(self) -> tuple:
+        """
+        Campuses with equal keys share one Storage
+        :return:
+        """
+        return tuple(sorted(self.database.items()))
+
+    def table(self, shuttle=False) -> str:
+        """
+        The garage or shuttle table
+        :param shuttle:
+        :return:
+        """
+        if shuttle and not self.shuttles:
+            raise UnknownCampus(f'{self.key} has no shuttle data')
+        return self.shuttles if shuttle else self.garages
+
+    def describe(self) -> dict:
+        """
+        What /campuses reports; leaves out the database settings
+        :return:
+        """
+        return {
+            'campus': self.key,
+            'name': self.name,
+            'timezone': self.timezone,
+            'garages': self.garage_list,
+            'garage_table': self.garages,
+            'shuttle_table': self.shuttles,
+        }
+
+
+class Registry:
+    """
+    Every campus the API serves, and the only tables it will query
+    """
+    def __init__(self, campuses, default=DEFAULT_CAMPUS):
+        """
+        :param campuses: Campus objects
+        :param default: Key of the campus requests without a campus or table are for
+        """
+        self.campuses = {}
+        self.owners = {}
+        for campus in campuses:
+            self.add(campus)
+        if default not in self.campuses:
+            raise ValueError(f'Default campus {default} is not registered')
+        self.default = default
+
+    def add(self, campus):
+        """
+        Register a campus; its tables can't belong to another one
+        :param campus:
+        :return:
+        """
+        if campus.key in self.campuses:
+            raise ValueError(f'Campus {campus.key} is registered twice')
+        for table in campus.tables:
+            if table in self.owners:
+                raise ValueError(f'Table {table} is registered to both {self.owners[table][0].key} and {campus.key}')
+        self.campuses[campus.key] = campus
+        for table, shuttle in campus.tables.items():
+            self.owners[table] = (campus, shuttle)
+
+    @classmethod
+    def load(cls, file=CAMPUSES_FILE, default=DEFAULT_CAMPUS):
+        """
+        Read the registry file, or use the built-in campus if there isn't one
+        :param file:
+        :param default:
+        :return:
+        """
+        if path.exists(file):
+            with open(file) as handle:
+                entries = json.load(handle)
+            logger.info(f'Loaded {len(entries)} campuses from {file}')
+        else:
+            entries = BUILT_IN
+        return cls([Campus(key, **entry) for key, entry in entries.items()], default=default)
+
+    def get(self, key=None) -> Campus:
+        """
+        A campus by key, or the default one
+        :param key:
+        :return:
+        """
+        campus = self.campuses.get(key or self.default)
+        if campus is None:
+            raise UnknownCampus(f'Unknown campus: {key}')
+        return campus
+
+    def resolve(self, campus=None, table=None, shuttle=False) -> tuple:
+        """
+        The campus, table and shuttle flag a request is for. A table, if given, has to be
+        registered and decides the shuttle flag; otherwise the campus' (or default campus')
+        garage or shuttle table is used.
+        :param campus: Campus key from the request
+        :param table: Table from the request
+        :param shuttle:
+        :return: (Campus, table, shuttle)
+        """
+        if table:
+            if table not in self.owners:
+                raise UnknownCampus(f'Unknown table: {table}')
+            owner, shuttle = self.owners[table]
+            if campus and campus != owner.key:
+                raise UnknownCampus(f'Table {table} does not belong to {campus}')
+            return owner, table, shuttle
+        owner = self.get(campus)
+        return owner, owner.table(shuttle), shuttle
+
+    def tables(self, host=None) -> dict:
+        """
+        {table: shuttle} of every campus in one database
+        :param host: The database host; None for the DB_* one
+        :return:
+        """
+        return {table: shuttle for campus in self.campuses.values()
+                if campus.database.get('host') == host for table, shuttle in campus.tables.items()}
+
+
+registry = Registry.load()
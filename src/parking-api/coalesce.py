@@ -0,0 +1,67 @@
+import asyncio
+from collections import Counter
+from api_log import BotLog
+from metrics import cache_lookup
+import newrelic.agent
+
+logger = BotLog('api-coalesce')
+
+
+class SingleFlight:
+    """
+    Lets identical concurrent calls share one execution. The first caller for a key starts
+    the work; everyone who asks for the same key while it's running awaits the same result
+    (or exception) instead of running their own query. Nothing is kept once the call finishes,
+    so this never serves stale data; it only collapses bursts.
+    """
+    def __init__(self):
+        # key -> the running call's future
+        self.flights = {}
+        # Counted per key[0], the endpoint or kind of call
+        self.calls = Counter()
+        self.coalesced = Counter()
+
+    async def run(self, key, factory):
+        """
+        Await the running call for a key, or start one
+        :param key: A hashable tuple of everything the result depends on, starting with its kind
+        :param factory: A callable returning the coroutine to run when no call is in flight
+        :return: The call's result, shared with every other caller; don't mutate it
+        """
+        kind = key[0]
+        self.calls[kind] += 1
+        flight = self.flights.get(key)
+        cache_lookup('coalesce', flight is not None)
+        if flight is None:
+            flight = asyncio.ensure_future(factory())
+            self.flights[key] = flight
+            flight.add_done_callback(lambda done: self.land(key, done))
+        else:
+            self.coalesced[kind] += 1
+            newrelic.agent.record_custom_metric(f'Custom/Coalesced/{kind}', 1)
+        # Shielded so one caller giving up doesn't cancel the call for the others
+        return await asyncio.shield(flight)
+
+    def land(self, key, flight):
+        """
+        Forget a finished call so the next caller starts a fresh one
+        :param key:
+        :param flight:
+        :return:
+        """
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not flight.cancelled() and flight.exception():
+            # Every waiter sees the exception; log it once here
+            logger.error(f'Coalesced call {key[0]} failed: {flight.exception()}')
+
+    def stats(self) -> dict:
+        """
+        Calls and coalesced calls per kind, plus how many are running now
+        :return:
+        """
+        return {
+            'in_flight': len(self.flights),
+            'calls': dict(self.calls),
+            'coalesced': dict(self.coalesced),
+        }
@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+from datetime import datetime, timedelta
+from os import getenv
+from api_log import BotLog
+from rollup import columns, LAST_WEEK
+import newrelic.agent
+
+logger = BotLog('api-compact')
+
+# Days of one-minute readings kept in the source tables; older readings are rolled into the tier
+RETENTION_DAYS = int(getenv("RETENTION_DAYS", 120))
+# Seconds between compaction runs inside the API; 0 leaves compaction to the CLI (or cron)
+COMPACT_INTERVAL = int(getenv("COMPACT_INTERVAL", 0))
+# Width of each aggregate row in the tier
+TIER_MINUTES = 15
+# /lastweek averages raw readings from a week ago, so those can never be compacted
+MIN_RETENTION_DAYS = LAST_WEEK[0] // (24 * 60) + 1
+
+
+def tier_table(table) -> str:
+    """
+    The companion table holding a source table's compacted readings
+    :param table:
+    :return:
+    """
+    return f'{table}_{TIER_MINUTES}min'
+
+
+async def ensure_tier(db, table):
+    """
+    Create the companion table of a source table if it doesn't exist yet. Rows are keyed
+    like the rollup buckets, so re-compacting a day (a late row) merges into the same rows.
+    :param db:
+    :param table:
+    :return:
+    """
+    await db.execute(f'''
+        CREATE TABLE IF NOT EXISTS `{tier_table(table)}` (
+            `name` VARCHAR(255) NOT NULL,
+            `bucket_start` DATETIME NOT NULL,
+            `weekday` TINYINT NOT NULL,
+            `minute_of_day` SMALLINT NOT NULL,
+            `min_value` INT NOT NULL,
+            `max_value` INT NOT NULL,
+            `total` BIGINT NOT NULL,
+            `samples` INT NOT NULL,
+            `average` DOUBLE AS (`total` / `samples`) VIRTUAL,
+            PRIMARY KEY (`name`, `bucket_start`),
+            KEY `weekday_minute` (`weekday`, `minute_of_day`),
+            KEY `bucket_start` (`bucket_start`)
+        )
+    ''')
+
+
+async def compactable_days(db, table, shuttle=False, retention_days=RETENTION_DAYS) -> list:
+    """
+    The days that still have raw readings older than the retention window, oldest first
+    :param db:
+    :param table:
+    :param shuttle:
+    :param retention_days:
+    :return: Midnights as datetimes
+    """
+    _, _, time = columns(shuttle)
+    state = (await db.fetch_all(f'''
+        SELECT MIN({time}) AS oldest, CURDATE() - INTERVAL %s DAY AS cutoff FROM `{table}`
+    ''', (retention_days,)))[0]
+    if state['oldest'] is None:
+        return []
+    cutoff = datetime.combine(state['cutoff'], datetime.min.time())
+    day = datetime.combine(state['oldest'].date(), datetime.min.time())
+    days = []
+    while day < cutoff:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def compact_statement(table, shuttle=False, partition=None) -> str:
+    """
+    INSERT ... SELECT folding the raw readings in a time range into the tier, merging into
+    buckets that already exist. Takes (start, end, highest id) as arguments.
+    :param table:
+    :param shuttle:
+    :param partition: Read only this partition of the source table
+    :return:
+    """
+    name, value, time = columns(shuttle)
+    source = f'`{table}` PARTITION (`{partition}`)' if partition else f'`{table}`'
+    return f'''
+        INSERT INTO `{tier_table(table)}` (name, bucket_start, weekday, minute_of_day, min_value, max_value, total, samples)
+        SELECT name, bucket_start, WEEKDAY(bucket_start), HOUR(bucket_start) * 60 + MINUTE(bucket_start),
+               MIN(value), MAX(value), SUM(value), COUNT(*)
+        FROM (
+            SELECT {name} AS name, {value} AS value,
+                   {time} - INTERVAL ((MINUTE({time}) MOD {TIER_MINUTES}) * 60 + SECOND({time})) SECOND AS bucket_start
+            FROM {source}
+            WHERE {time} >= %s AND {time} < %s AND id <= %s AND {value} IS NOT NULL
+        ) r
+        GROUP BY name, bucket_start
+        ON DUPLICATE KEY UPDATE min_value = LEAST(min_value, VALUES(min_value)),
+                                max_value = GREATEST(max_value, VALUES(max_value)),
+                                total = total + VALUES(total), samples = samples + VALUES(samples)
+    '''
+
+
+@newrelic.agent.background_task()
+async def compact_day(db, table, day, shuttle=False, limit_id=None) -> int:
+    """
+    Roll one day of raw readings into TIER_MINUTES aggregates and delete them from the source
+    table, in one transaction so a reading is always in exactly one of the two tables.
+    :param db:
+    :param table:
+    :param day: Midnight of the day
+    :param shuttle:
+    :param limit_id: Leave rows with a higher id alone, so readings the analytics haven't
+        loaded yet aren't moved out from under them
+    :return: Raw rows removed
+    """
+    _, _, time = columns(shuttle)
+    args = (day, day + timedelta(days=1), limit_id if limit_id is not None else 2 ** 63 - 1)
+    async with db.transaction() as cursor:
+        await cursor.execute(compact_statement(table, shuttle), args)
+        await cursor.execute(f'DELETE FROM `{table}` WHERE {time} >= %s AND {time} < %s AND id <= %s', args)
+        removed = cursor.rowcount
+    if removed:
+        logger.info(f'Compacted {removed} rows of {table} from {day.date()} into {tier_table(table)}')
+    return removed
+
+
+async def rollup_watermark(db, table):
+    """
+    The last source id folded into a table's rollup (see rollup.py). Rows above it must stay
+    in the source table until the API's catch up reaches them, or the rollup never counts them.
+    :param db:
+    :param table:
+    :return: The id, or None if the table has no rollup yet
+    """
+    if not await db.fetch_all('''
+        SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'rollup_state'
+    '''):
+        return None
+    rows = await db.fetch_all('SELECT last_id FROM `rollup_state` WHERE source_table = %s', (table,))
+    return rows[0]['last_id'] if rows else None
+
+
+async def tier_rows(db, table):
+    """
+    Stream a table's compacted readings as {'name', 'time', 'total', 'samples'} rows
+    :param db:
+    :param table:
+    :return: Yields lists of rows
+    """
+    await ensure_tier(db, table)
+    async for rows in db.stream_chunks(f'''
+        SELECT name, bucket_start AS time, total, samples FROM `{tier_table(table)}`
+    ''', chunk=10000):
+        yield rows
+
+
+class Compactor:
+    """
+    Keeps the source tables to RETENTION_DAYS of raw readings by rolling older days into the
+    TIER_MINUTES companion tables. Runs inside the API so it can hold the analytics' table
+    lock for each day: the rollup or series engine never sees a day half moved, and only
+    rows it has already loaded are compacted.
+    """
+    def __init__(self, db, analytics, tables, retention_days=RETENTION_DAYS):
+        """
+        :param db: The Storage to compact; only MariaDB supports it
+        :param analytics: The Rollup or SeriesEngine reading the tables
+        :param tables: {table: shuttle}
+        :param retention_days:
+        """
+        if retention_days < MIN_RETENTION_DAYS:
+            raise ValueError(f'RETENTION_DAYS must be at least {MIN_RETENTION_DAYS}, got {retention_days}')
+        self.db = db
+        self.analytics = analytics
+        self.tables = tables
+        self.retention_days = retention_days
+        self.task = None
+
+    async def compact(self, table, shuttle=False) -> int:
+        """
+        Compact every day of a table older than the retention window
+        :param table:
+        :param shuttle:
+        :return: Raw rows removed
+        """
+        await self.analytics.ensure(table, shuttle=shuttle)
+        await ensure_tier(self.db, table)
+        removed = 0
+        for day in await compactable_days(self.db, table, shuttle, self.retention_days):
+            # One day per lock hold, so catch ups aren't blocked for a whole backlog
+            async with self.analytics.lock(table):
+                removed += await compact_day(self.db, table, day, shuttle=shuttle,
+                                             limit_id=self.analytics.watermarks.get(table, 0))
+        return removed
+
+    async def compact_all(self) -> int:
+        """
+        Compact every table, logging failures instead of raising
+        :return: Raw rows removed
+        """
+        removed = 0
+        for table, shuttle in self.tables.items():
+            try:
+                removed += await self.compact(table, shuttle=shuttle)
+            except Exception as e:
+                logger.error(f'Could not compact {table}: {e}')
+        return removed
+
+    async def run(self):
+        """
+        Background loop: compact every COMPACT_INTERVAL seconds
+        :return:
+        """
+        while True:
+            await self.compact_all()
+            await asyncio.sleep(COMPACT_INTERVAL)
+
+    def start(self):
+        """
+        Start the background loop when COMPACT_INTERVAL is set and the backend supports it
+        :return:
+        """
+        if not COMPACT_INTERVAL:
+            return
+        if self.db.dialect != 'mariadb':
+            logger.info(f'Not compacting: the {self.db.dialect} backend is a read replica')
+            return
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the background loop
+        :return:
+        """
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+async def status(db, retention_days):
+    """
+    Log each table's raw and compacted extent
+    :param db:
+    :param retention_days:
+    :return:
+    """
+    from migrate import TABLES
+    for table, shuttle in TABLES.items():
+        _, _, time = columns(shuttle)
+        await ensure_tier(db, table)
+        raw = (await db.fetch_all(f'SELECT COUNT(*) AS count, MIN({time}) AS oldest FROM `{table}`'))[0]
+        tier = (await db.fetch_all(f'SELECT COUNT(*) AS count, MIN(bucket_start) AS oldest, MAX(bucket_start) AS newest '
+                                   f'FROM `{tier_table(table)}`'))[0]
+        pending = await compactable_days(db, table, shuttle, retention_days)
+        logger.info(f'{table}: {raw["count"]} raw rows from {raw["oldest"]}, {len(pending)} days to compact')
+        logger.info(f'{tier_table(table)}: {tier["count"]} rows from {tier["oldest"]} to {tier["newest"]}')
+
+
+async def run(db, retention_days):
+    """
+    Compact every table once. Rows newer than the rollup watermark, or each table's MAX(id)
+    at the start when it has no rollup, are left alone so the rollup still counts them.
+    :param db:
+    :param retention_days:
+    :return:
+    """
+    from migrate import TABLES
+    if retention_days < MIN_RETENTION_DAYS:
+        raise ValueError(f'--retention-days must be at least {MIN_RETENTION_DAYS}')
+    for table, shuttle in TABLES.items():
+        await ensure_tier(db, table)
+        limit_id = await rollup_watermark(db, table)
+        if limit_id is None:
+            limit_id = (await db.fetch_all(f'SELECT COALESCE(MAX(id), 0) AS max_id FROM `{table}`'))[0]['max_id']
+        removed = 0
+        for day in await compactable_days(db, table, shuttle, retention_days):
+            removed += await compact_day(db, table, day, shuttle=shuttle, limit_id=limit_id)
+        logger.info(f'{table}: compacted {removed} rows older than {retention_days} days')
+
+
+async def main(args):
+    """
+    Connect, run one command and close the pool
+    :param args:
+    :return:
+    """
+    from mariadb import Config
+    db = Config()
+    await db.retry_connection()
+    try:
+        await {'status': status, 'run': run}[args.command](db, args.retention_days)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f'Roll raw readings older than the retention window into '
+                                                 f'{TIER_MINUTES}-minute aggregates')
+    parser.add_argument('command', choices=['status', 'run'])
+    parser.add_argument('--retention-days', type=int, default=RETENTION_DAYS)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,130 @@
+import numpy as np
+from api_log import BotLog
+from rollup import weekday_index
+from series import HISTOGRAM_BINS
+import newrelic.agent
+
+logger = BotLog('api-distribution')
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+# Width of the bins in a response's histogram; the stored bins are always one value wide
+DEFAULT_BIN_WIDTH = 10
+
+
+def percentiles(histograms, points) -> np.ndarray:
+    """
+    Nearest-rank percentiles of every row of a histogram matrix
+    :param histograms: (names x HISTOGRAM_BINS) counts
+    :param points: Percentiles between 0 and 100
+    :return: (names x points) values, -1 where a name has no samples
+    """
+    cumulative = histograms.cumsum(axis=1)
+    totals = cumulative[:, -1:]
+    ranks = np.ceil(np.asarray(points, dtype=float)[None, :] / 100 * totals).clip(min=1)
+    # The first bin whose running count reaches each rank, for every name and percentile at once
+    values = (cumulative[:, None, :] < ranks[:, :, None]).sum(axis=2)
+    return np.where(totals > 0, values, -1)
+
+
+class Distributions:
+    """
+    Percentiles and histograms for a weekday and time of day, merged from the series
+    engine's per-bucket histograms, so the tail of a garage's fullness costs the same
+    as its mean.
+    """
+    def __init__(self, engine):
+        """
+        :param engine: The SeriesEngine holding the history
+        """
+        self.engine = engine
+
+    @newrelic.agent.background_task()
+    async def distribution(self, table, day, time, minutes=60, points=DEFAULT_PERCENTILES,
+                           bin_width=DEFAULT_BIN_WIDTH, shuttle=False) -> dict:
+        """
+        Every name's distribution over the `minutes` before a time of day on a weekday
+        :param table:
+        :param day: The day name, e.g. Tuesday
+        :param time: A datetime.time, rounded down to the bucket
+        :param minutes: How far back from the time to merge, within the same day
+        :param points: Percentiles to return
+        :param bin_width: Values per histogram bin in the response
+        :param shuttle:
+        :return: {'names', 'points', 'percentiles', 'clipped', 'samples', 'bin_width', 'edges', 'histograms'}
+        """
+        weekday = weekday_index(day)
+        if not 0 < minutes <= 24 * 60:
+            raise ValueError('minutes must be between 1 and 1440')
+        if any(not 0 <= point <= 100 for point in points):
+            raise ValueError('Percentiles must be between 0 and 100')
+        if not 0 < bin_width <= HISTOGRAM_BINS:
+            raise ValueError(f'Bin width must be between 1 and {HISTOGRAM_BINS}')
+        await self.engine.ensure(table, shuttle=shuttle)
+        series = self.engine.tables[table]
+
+        end = time.hour * 60 + time.minute
+        histograms = series.histogram(weekday, max(end - minutes, 0), end)
+        keep = histograms.sum(axis=1) > 0
+        histograms = histograms[keep]
+        edges = np.arange(0, HISTOGRAM_BINS, bin_width)
+        values = percentiles(histograms, points)
+        return {
+            'names': [name for name, kept in zip(series.names, keep) if kept],
+            'points': list(points),
+            'percentiles': values,
+            # ETAs past the top bin are counted in it, so a percentile landing there is only a lower bound
+            'clipped': values == HISTOGRAM_BINS - 1 if shuttle else np.zeros(values.shape, dtype=bool),
+            'samples': histograms.sum(axis=1),
+            'bin_width': bin_width,
+            'edges': edges,
+            'histograms': np.add.reduceat(histograms, edges, axis=1) if len(histograms) else histograms[:, :len(edges)],
+        }
+
+    @staticmethod
+    def render(result, day, time, shuttle=False) -> list:
+        """
+        Distributions as rows in the style of /average, ending with a 'Data above is...' row
+        :param result: From distribution()
+        :param day:
+        :param time:
+        :param shuttle:
+        :return:
+        """
+        key, unit, label = ('stop_name', ' minutes', 'time to departure') if shuttle else ('name', '%', 'fullness')
+        top = HISTOGRAM_BINS - 1
+        labels = []
+        for low in result['edges'].tolist():
+            high = min(low + result['bin_width'] - 1, top)
+            labels.append(f'{low}-{high}{unit}' if high > low else f'{low}{unit}')
+        if shuttle:
+            # The top bin also holds every ETA past it
+            labels[-1] = f"{result['edges'][-1]}+{unit}"
+        results = []
+        for i, name in enumerate(result['names']):
+            row = {key: name}
+            row.update({f'p{point:g}': f"{result['percentiles'][i, j]}{'+' if result['clipped'][i, j] else ''}{unit}"
+                        for j, point in enumerate(result['points'])})
+            row['samples'] = int(result['samples'][i])
+            row['histogram'] = dict(zip(labels, result['histograms'][i].tolist()))
+            results.append(row)
+        results.append({key: f'Data above is the distribution of {label} for {day} at {time}'})
+        return results
+
+    @staticmethod
+    def columns(result, shuttle=False) -> tuple:
+        """
+        Distributions as typed columns, with each histogram as a list of counts. Shuttle
+        percentiles also get a pN_clipped column, true where the value is only a lower bound.
+        :param result: From distribution()
+        :param shuttle:
+        :return: (columns, meta)
+        """
+        key = 'stop_name' if shuttle else 'name'
+        columns = {key: result['names']}
+        for j, point in enumerate(result['points']):
+            columns[f'p{point:g}'] = result['percentiles'][:, j].tolist()
+            if shuttle:
+                columns[f'p{point:g}_clipped'] = result['clipped'][:, j].tolist()
+        columns['samples'] = result['samples'].tolist()
+        columns['histogram'] = result['histograms'].tolist()
+        return columns, {'bin_edges': result['edges'].tolist()}
@@ -0,0 +1,188 @@
+from datetime import timedelta
+import numpy as np
+from api_log import BotLog
+from rollup import columns
+from series import epoch_seconds, SERIES_CHUNK
+import newrelic.agent
+
+logger = BotLog('api-downsample')
+
+# Points per name when a request doesn't say, and the fewest and most it may ask for;
+# minmax needs at least the two ends and one bucket's low and high
+DEFAULT_POINTS = 200
+MIN_POINTS = 4
+MAX_POINTS = 2000
+# Longest range one request may cover
+MAX_RANGE = timedelta(days=31)
+METHODS = ('lttb', 'minmax')
+
+
+def bucket_edges(length, buckets) -> np.ndarray:
+    """
+    Split the points between the first and the last into buckets of (nearly) equal count
+    :param length: Number of points
+    :param buckets:
+    :return: buckets + 1 indexes; bucket i is [edges[i], edges[i + 1])
+    """
+    # Integer division: float steps round some edges down a point, and can leave the last one out
+    return 1 + np.arange(buckets + 1, dtype=np.int64) * (length - 2) // buckets
+
+
+def lttb(times, values, points) -> np.ndarray:
+    """
+    Largest-triangle-three-buckets: keep the first and last points, and from each bucket in
+    between the point forming the largest triangle with the point kept from the previous
+    bucket and the average of the next one. Peaks and dips survive, unlike plain averaging.
+    The areas of a bucket are one array operation and the bucket averages come from cumulative
+    sums, so the Python loop only runs once per output point.
+    :param times: int64 epoch seconds, sorted
+    :param values:
+    :param points: Points to keep, at least 3
+    :return: Indexes of the kept points
+    """
+    length = len(times)
+    if points >= length:
+        return np.arange(length)
+    x = (times - times[0]).astype(float)
+    y = values.astype(float)
+    edges = bucket_edges(length, points - 2)
+    # Average point of every bucket, and the last point standing in for the bucket after the last
+    sums_x, sums_y = np.concatenate([[0], np.cumsum(x)]), np.concatenate([[0], np.cumsum(y)])
+    counts = np.maximum(edges[1:] - edges[:-1], 1)
+    mean_x = np.append((sums_x[edges[1:]] - sums_x[edges[:-1]]) / counts, x[-1])
+    mean_y = np.append((sums_y[edges[1:]] - sums_y[edges[:-1]]) / counts, y[-1])
+    kept = np.empty(points, dtype=np.int64)
+    kept[0], kept[-1] = 0, length - 1
+    previous = 0
+    for bucket in range(points - 2):
+        low, high = edges[bucket], max(edges[bucket + 1], edges[bucket] + 1)
+        # Twice the triangle's area; the factor doesn't change which point is largest
+        areas = np.abs((x[previous] - mean_x[bucket + 1]) * (y[low:high] - y[previous])
+                       - (x[previous] - x[low:high]) * (mean_y[bucket + 1] - y[previous]))
+        previous = low + int(np.argmax(areas))
+        kept[bucket + 1] = previous
+    return kept
+
+
+def minmax(times, values, points) -> np.ndarray:
+    """
+    The lowest and highest point of each of points / 2 buckets, plus the first and last
+    points, found for every bucket at once by sorting on (bucket, value)
+    :param times: int64 epoch seconds, sorted
+    :param values:
+    :param points: Points to keep, at least 4
+    :return: Indexes of the kept points, in time order
+    """
+    length = len(times)
+    if points >= length:
+        return np.arange(length)
+    buckets = (points - 2) // 2
+    edges = bucket_edges(length, buckets)
+    inner = np.arange(1, length - 1)
+    bucket = np.searchsorted(edges, inner, side='right') - 1
+    order = inner[np.lexsort((values[inner], bucket))]
+    starts = np.searchsorted(bucket[order - 1], np.arange(buckets))
+    ends = np.append(starts[1:], len(order)) - 1
+    filled = starts <= ends
+    return np.unique(np.concatenate([[0, length - 1], order[starts[filled]], order[ends[filled]]]))
+
+
+class Downsampler:
+    """
+    A time series of every name over a range, cut down to a fixed number of points per name
+    for charts. The readings stream from the database in time order, so any range the tables
+    still hold works and the response size only depends on the points asked for.
+    """
+    def __init__(self, db):
+        """
+        :param db: The Storage to query
+        """
+        self.db = db
+
+    async def readings(self, table, start, end, names=None, shuttle=False) -> dict:
+        """
+        Every reading in a range, grouped by name
+        :param table:
+        :param start: Inclusive datetime
+        :param end: Exclusive datetime
+        :param names: Optional case insensitive substrings of the names to keep
+        :param shuttle:
+        :return: {name: (times, values)} int64 arrays, sorted by time
+        """
+        name, value, time = columns(shuttle)
+        grouped = {}
+        async for rows in self.db.stream_chunks(f'''
+            SELECT {name} AS name, {value} AS value, {time} AS time
+            FROM `{table}`
+            WHERE {time} >= %s AND {time} < %s
+            ORDER BY {time}
+        ''', (start, end), chunk=SERIES_CHUNK):
+            for row in rows:
+                if row['value'] is None:
+                    continue
+                if names and not any(n.lower() in row['name'].lower() for n in names):
+                    continue
+                times, values = grouped.setdefault(row['name'], ([], []))
+                times.append(row['time'])
+                values.append(int(row['value']))
+        return {name: (epoch_seconds(times), np.array(values, dtype=np.int64))
+                for name, (times, values) in grouped.items()}
+
+    @newrelic.agent.background_task()
+    async def series(self, table, start, end, points=DEFAULT_POINTS, method='lttb', names=None, shuttle=False) -> dict:
+        """
+        The downsampled series of every name
+        :param table:
+        :param start: Inclusive datetime
+        :param end: Exclusive datetime
+        :param points: Most points per name
+        :param method: lttb or minmax
+        :param names: Optional case insensitive substrings of the names to keep
+        :param shuttle:
+        :return: {'start', 'end', 'method', 'series': {name: (times, values, readings in the range)}}
+        """
+        if method not in METHODS:
+            raise ValueError(f'method must be one of {", ".join(METHODS)}')
+        if not MIN_POINTS <= points <= MAX_POINTS:
+            raise ValueError(f'points must be between {MIN_POINTS} and {MAX_POINTS}')
+        if not start < end <= start + MAX_RANGE:
+            raise ValueError(f'The range must end after it starts and span at most {MAX_RANGE.days} days')
+        pick = lttb if method == 'lttb' else minmax
+        series = {}
+        for name, (times, values) in sorted((await self.readings(table, start, end, names, shuttle)).items()):
+            kept = pick(times, values, points)
+            series[name] = (times[kept], values[kept], len(times))
+        return {'start': start, 'end': end, 'method': method, 'series': series}
+
+    @staticmethod
+    def render(result, shuttle=False) -> list:
+        """
+        One entry per name with parallel lists of times and values, ready to plot
+        :param result: From series()
+        :param shuttle:
+        :return:
+        """
+        key, value = ('stop_name', 'time_to_departure') if shuttle else ('name', 'fullness')
+        return [{
+            key: name,
+            'time': [str(time) for time in times.astype('datetime64[s]').tolist()],
+            value: values.tolist(),
+            'readings': readings,
+        } for name, (times, values, readings) in result['series'].items()]
+
+    @staticmethod
+    def columns(result, shuttle=False) -> tuple:
+        """
+        Every kept point as typed columns, one entry per name and time
+        :param result: From series()
+        :param shuttle:
+        :return: (columns, meta)
+        """
+        key, value = ('stop_name', 'time_to_departure') if shuttle else ('name', 'fullness')
+        series = result['series']
+        return {
+            key: [name for name, (times, _, _) in series.items() for _ in range(len(times))],
+            'time': [time for times, _, _ in series.values() for time in times.astype('datetime64[s]').tolist()],
+            value: [value for _, values, _ in series.values() for value in values.tolist()],
+        }, {'start': result['start'], 'end': result['end'], 'method': result['method'],
+            'readings': {name: readings for name, (_, _, readings) in series.items()}}
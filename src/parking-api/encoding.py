@@ -0,0 +1,116 @@
+import io
+import json
+from decimal import Decimal
+import msgpack
+import pyarrow
+import pyarrow.ipc
+from api_log import BotLog
+
+logger = BotLog('api-encoding')
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+
+def available() -> list:
+    """
+    The response encodings this process can produce, JSON first so it stays the default
+    :return:
+    """
+    return [JSON, MSGPACK, ARROW]
+
+
+def negotiate(accept) -> str:
+    """
+    Pick a response encoding from an Accept header. JSON wins ties and wildcards.
+    :param accept: The request's accept_mimetypes
+    :return:
+    """
+    return accept.best_match(available(), default=JSON)
+
+
+def number(value):
+    """
+    Turn Decimal sums from MariaDB into plain ints or floats
+    :param value:
+    :return:
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def plain(value):
+    """
+    MessagePack fallback for values it can't encode. Times are sent as ISO strings
+    because the scraped timestamps carry no timezone.
+    :param value:
+    :return:
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return number(value)
+
+
+def encode_table(columns, meta, mimetype) -> bytes:
+    """
+    Encode typed columns as MessagePack ({'columns': ..., 'meta': ...}) or as an Arrow IPC
+    stream with meta stored in the schema metadata.
+    :param columns: {column name: list of values}
+    :param meta: Extra JSON-able fields, e.g. the data's age
+    :param mimetype: MSGPACK or ARROW
+    :return:
+    """
+    if mimetype == MSGPACK:
+        return msgpack.packb({'columns': columns, 'meta': meta}, default=plain, use_bin_type=True)
+
+    # Arrow keeps datetimes as typed timestamp columns
+    table = pyarrow.table({name: [number(value) for value in values] for name, values in columns.items()})
+    table = table.replace_schema_metadata({'meta': json.dumps(meta, default=plain)})
+    sink = io.BytesIO()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+class ArrowStream:
+    """
+    Incrementally writes rows as Arrow IPC record batches, for streamed responses.
+    The schema comes from the first batch.
+    """
+    def __init__(self):
+        self.sink = io.BytesIO()
+        self.writer = None
+
+    def take(self) -> bytes:
+        """
+        Everything written since the last call
+        :return:
+        """
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+    def write(self, rows) -> bytes:
+        """
+        Encode a chunk of dict rows as one record batch
+        :param rows:
+        :return: The bytes to send
+        """
+        batch = pyarrow.RecordBatch.from_pylist(rows)
+        if self.writer is None:
+            self.writer = pyarrow.ipc.new_stream(self.sink, batch.schema)
+        self.writer.write_batch(batch)
+        return self.take()
+
+    def close(self) -> bytes:
+        """
+        Finish the stream
+        :return: The end-of-stream marker
+        """
+        if self.writer is None:
+            return b''
+        self.writer.close()
+        return self.take()
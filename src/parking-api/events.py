@@ -0,0 +1,153 @@
+import asyncio
+import json
+from os import getenv
+from api_log import BotLog
+
+logger = BotLog('api-events')
+
+# Messages a subscriber may fall behind by before it's dropped
+SUBSCRIBER_QUEUE = int(getenv("SUBSCRIBER_QUEUE", 100))
+# Seconds between SSE keepalive comments so proxies don't close idle streams
+KEEPALIVE_INTERVAL = 15
+
+
+class Message:
+    """
+    One event, serialized once and shared by every subscriber it's sent to
+    """
+    def __init__(self, kind, payload):
+        """
+        :param kind: The SSE event name, snapshot or update
+        :param payload: The JSON-able event body
+        """
+        self.kind = kind
+        self.data = json.dumps(payload, default=str)
+        self.sse = f'event: {kind}\ndata: {self.data}\n\n'
+
+
+class Subscription:
+    """
+    A single client's queue of messages for one table
+    """
+    def __init__(self, topic):
+        """
+        :param topic: (table, shuttle)
+        """
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+
+    def drop(self):
+        """
+        Throw away whatever is queued and tell the consumer to stop
+        :return:
+        """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def messages(self):
+        """
+        Yield messages as they arrive, or None every KEEPALIVE_INTERVAL seconds of silence.
+        Ends when the subscription is dropped.
+        :return:
+        """
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), timeout=KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if message is None:
+                return
+            yield message
+
+    async def sse(self):
+        """
+        The subscription as server-sent event frames
+        :return:
+        """
+        async for message in self.messages():
+            yield message.sse if message else ': keepalive\n\n'
+
+
+class Broadcaster:
+    """
+    Fans latest-snapshot changes out to every subscriber of a table. Each update is
+    serialized once and the same frame is queued for all of them, so the cost of a
+    scrape is one encode plus a queue put per client, all on the one event loop.
+    """
+    def __init__(self, snapshots):
+        """
+        :param snapshots: The SnapshotStore this listens to
+        """
+        self.snapshots = snapshots
+        # (table, shuttle) -> set of Subscriptions
+        self.subscribers = {}
+        # ((table, shuttle), name) -> the last value sent, so time-only refreshes stay quiet
+        self.last_values = {}
+
+    @staticmethod
+    def payload(snapshot, rows) -> dict:
+        """
+        The JSON body of an event for some rows of a snapshot, with typed values
+        :param snapshot:
+        :param rows:
+        :return:
+        """
+        return {
+            'table': snapshot.table,
+            'shuttle': snapshot.shuttle,
+            'current_through': snapshot.last_seen,
+            'rows': [{snapshot.key: row['name'], snapshot.value: row['value'], 'time': row['time']} for row in rows],
+        }
+
+    async def subscribe(self, table, shuttle=False) -> Subscription:
+        """
+        Register a new subscriber and queue the current state as its first message
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        snapshot = await self.snapshots.get(table, shuttle=shuttle)
+        topic = (table, shuttle)
+        for row in snapshot.rows():
+            self.last_values.setdefault((topic, row['name']), row['value'])
+        subscription = Subscription(topic)
+        subscription.queue.put_nowait(Message('snapshot', self.payload(snapshot, snapshot.rows())))
+        self.subscribers.setdefault(topic, set()).add(subscription)
+        logger.info(f'New subscriber to {table}, {len(self.subscribers[topic])} total')
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Forget a subscriber once its client has gone
+        :param subscription:
+        :return:
+        """
+        self.subscribers.get(subscription.topic, set()).discard(subscription)
+
+    async def on_update(self, updates):
+        """
+        SnapshotStore listener: broadcast the names whose fullness or ETA actually changed
+        :param updates: (snapshot, changed rows) pairs from the refresher
+        :return:
+        """
+        for snapshot, changed in updates:
+            topic = (snapshot.table, snapshot.shuttle)
+            rows = [row for row in changed if self.last_values.get((topic, row['name'])) != row['value']]
+            for row in changed:
+                self.last_values[(topic, row['name'])] = row['value']
+            subscribers = self.subscribers.get(topic)
+            if not rows or not subscribers:
+                continue
+
+            message = Message('update', self.payload(snapshot, rows))
+            for subscription in list(subscribers):
+                try:
+                    subscription.queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    # A client this far behind isn't reading; cut it loose instead of buffering
+                    logger.warning(f'Dropping slow subscriber to {snapshot.table}')
+                    subscription.drop()
+                    self.unsubscribe(subscription)
+            logger.info(f'Sent {len(rows)} changes in {snapshot.table} to {len(subscribers)} subscribers')
@@ -0,0 +1,148 @@
+import asyncio
+import csv
+import io
+import json
+import weakref
+from os import getenv
+from api_log import BotLog
+from encoding import ArrowStream, msgpack, plain, MSGPACK, ARROW
+import newrelic.agent
+
+logger = BotLog('api-export')
+
+# Exports allowed to stream at once; each one holds a pooled connection until it finishes
+EXPORT_CONCURRENCY = int(getenv("EXPORT_CONCURRENCY", 2))
+# Worker processes serving requests, set by serve.py
+SERVE_WORKERS = int(getenv("SERVE_WORKERS", 1))
+# Each worker's share of EXPORT_CONCURRENCY, so all of them together stay within it
+EXPORT_SLOTS = max(1, EXPORT_CONCURRENCY // SERVE_WORKERS)
+# Rows fetched from the server-side cursor per round trip
+EXPORT_CHUNK = 1000
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'msgpack': MSGPACK,
+    'arrow': ARROW,
+}
+
+
+class ExportBusy(Exception):
+    """
+    Raised when every export slot is already streaming
+    """
+
+
+class Exporter:
+    """
+    Streams raw garage or shuttle history as NDJSON, CSV, MessagePack or Arrow straight off an unbuffered
+    cursor, one chunk at a time, so an hour and two years of rows cost the same memory.
+    """
+    def __init__(self, db):
+        """
+        :param db: The Storage to query
+        """
+        self.db = db
+        # Created on first use so it belongs to the serving event loop
+        self.slots = None
+
+    @staticmethod
+    def query(table, start, end, names=None, shuttle=False):
+        """
+        The history query for a time range and optional list of names, oldest first
+        :param table:
+        :param start: Inclusive start datetime
+        :param end: Exclusive end datetime
+        :param names: Garage or stop names to keep, or None for all of them
+        :param shuttle:
+        :return: (query, args)
+        """
+        args = [start, end]
+        if not shuttle:
+            query = f'SELECT name, address, fullness, time FROM `{table}` WHERE time >= %s AND time < %s'
+            name_column, time_column = 'name', 'time'
+        else:
+            query = f'SELECT stop_name, time_to_departure, updated_at FROM `{table}` WHERE updated_at >= %s AND updated_at < %s'
+            name_column, time_column = 'stop_name', 'updated_at'
+        if names:
+            query += f' AND {name_column} IN ({", ".join(["%s"] * len(names))})'
+            args.extend(names)
+        query += f' ORDER BY {time_column}'
+        return query, args
+
+    async def open(self, table, start, end, names=None, shuttle=False, fmt='ndjson'):
+        """
+        Claim an export slot and return the body generator for an export. The slot is taken
+        here, before the response starts, so a burst of requests can't all pass the check
+        and then queue on the database; the body gives it back when it ends.
+        :param table:
+        :param start:
+        :param end:
+        :param names:
+        :param shuttle:
+        :param fmt: A key of FORMATS
+        :return: An async generator of response text or bytes
+        """
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(EXPORT_SLOTS)
+        if self.slots.locked():
+            raise ExportBusy(f'{EXPORT_SLOTS} exports are already running')
+        # Doesn't suspend: nothing can take the slot between the check and this
+        await self.slots.acquire()
+        query, args = self.query(table, start, end, names=names, shuttle=shuttle)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.slots.release()
+
+        body = self.stream(query, args, fmt, table, release)
+        # A response that never starts never runs the body's finally; give the slot back when it's collected
+        weakref.finalize(body, release)
+        return body
+
+    @newrelic.agent.background_task()
+    async def stream(self, query, args, fmt, table, release):
+        """
+        Format each chunk of rows as it comes off the cursor
+        :param query:
+        :param args:
+        :param fmt:
+        :param table:
+        :param release: Gives the export slot back; called once the stream ends, however it ends
+        :return:
+        """
+        count = 0
+        try:
+            header_written = False
+            arrow = ArrowStream() if fmt == 'arrow' else None
+            async for rows in self.db.stream_chunks(query, args, chunk=EXPORT_CHUNK):
+                count += len(rows)
+                if arrow:
+                    # One record batch per chunk
+                    yield arrow.write(rows)
+                elif fmt == 'msgpack':
+                    # A sequence of maps, one per row, readable with msgpack.Unpacker
+                    yield b''.join(msgpack.packb(row, default=plain, use_bin_type=True) for row in rows)
+                elif fmt == 'csv':
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    if not header_written:
+                        writer.writerow(rows[0].keys())
+                        header_written = True
+                    writer.writerows([value.isoformat() if hasattr(value, 'isoformat') else value
+                                      for value in row.values()] for row in rows)
+                    yield buffer.getvalue()
+                else:
+                    yield ''.join(json.dumps(row, default=lambda value: value.isoformat()) + '\n' for row in rows)
+            if arrow:
+                yield arrow.close()
+        except Exception as e:
+            # The 200 is already sent; raising aborts the connection so the client sees a failed
+            # transfer rather than a short body that looks complete
+            logger.error(f'Export from {table} failed after {count} rows: {e}')
+            raise
+        finally:
+            release()
+        logger.info(f'Exported {count} rows from {table} as {fmt}')
@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+from os import getenv
+import numpy as np
+from api_log import BotLog
+from rollup import weekday_index
+from series import epoch_seconds, minute_of_week
+from metrics import cache_lookup
+import newrelic.agent
+
+logger = BotLog('api-forecast')
+
+# Minutes on either side of a minute of the week that are averaged into its profile value
+PROFILE_SMOOTHING = int(getenv("PROFILE_SMOOTHING", 10))
+# Minutes for the gap between the current reading and the profile to fade to about a third
+ANOMALY_DECAY = float(getenv("ANOMALY_DECAY", 60))
+# Minutes of recent readings the trend is fitted over, and how far ahead it's extrapolated
+TREND_MINUTES = 30
+# Furthest ahead a forecast can be asked for, and most times per request
+MAX_HORIZON = 7 * 24 * 60
+MAX_TARGETS = 96
+
+
+def circular_sum(slots, radius) -> np.ndarray:
+    """
+    Sum of each minute of the week and the `radius` minutes either side of it,
+    wrapping from Sunday night into Monday morning
+    :param slots: (names x minutes) matrix
+    :param radius:
+    :return: A matrix of the same shape
+    """
+    if radius <= 0:
+        return slots
+    padded = np.concatenate([slots[:, -radius:], slots, slots[:, :radius]], axis=1)
+    sums = np.concatenate([np.zeros((len(slots), 1), dtype=slots.dtype), np.cumsum(padded, axis=1)], axis=1)
+    return sums[:, 2 * radius + 1:] - sums[:, :-(2 * radius + 1)]
+
+
+class Forecaster:
+    """
+    Predicts each name's value at future times from three parts: the smoothed weekday x
+    time-of-day profile, the current reading's gap from that profile and the recent trend.
+    The gap and trend fade out with the horizon, so a forecast for the next few minutes
+    follows the live reading and one for tomorrow is the typical value for that time.
+    Every name and every horizon is computed in one set of array operations.
+    """
+    def __init__(self, engine):
+        """
+        :param engine: The SeriesEngine holding the history
+        """
+        self.engine = engine
+        # table -> (TableSeries version, profile matrix)
+        self.profiles = {}
+
+    def profile(self, table) -> np.ndarray:
+        """
+        The smoothed average for every name and minute of the week, NaN where there's no data.
+        Rebuilt from the engine's running sums only when rows were appended since the last build.
+        :param table:
+        :return: (names x minutes) matrix
+        """
+        series = self.engine.tables[table]
+        cached = self.profiles.get(table)
+        hit = bool(cached) and cached[0] == series.version
+        cache_lookup('forecast_profile', hit)
+        if hit:
+            return cached[1]
+        totals = circular_sum(series.slot_total, PROFILE_SMOOTHING)
+        samples = circular_sum(series.slot_samples, PROFILE_SMOOTHING)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profile = np.where(samples > 0, totals / samples, np.nan)
+        self.profiles[table] = (series.version, profile)
+        return profile
+
+    @staticmethod
+    def trends(series) -> tuple:
+        """
+        The newest reading of every name and its least squares slope over the last TREND_MINUTES
+        :param series: The TableSeries
+        :return: (reading times in epoch seconds, current values, slopes per minute) arrays
+        """
+        anchors, currents, slopes = [], [], []
+        for name_series in series.series:
+            times, values = name_series.recent(TREND_MINUTES * 60)
+            if not len(times):
+                # Only compacted history; forecast() leaves the name out
+                anchors.append(0)
+                currents.append(0.0)
+                slopes.append(0.0)
+                continue
+            anchors.append(times[-1])
+            currents.append(values[-1])
+            minutes = (times - times[-1]) / 60
+            if len(times) > 1 and minutes.min() < 0:
+                slopes.append(np.polyfit(minutes, values, 1)[0])
+            else:
+                slopes.append(0.0)
+        return np.array(anchors, dtype=np.int64), np.array(currents, dtype=float), np.array(slopes)
+
+    def targets(self, table, times=None, minutes=None, day=None) -> list:
+        """
+        Resolve the requested times to datetimes on the database's clock
+        :param table:
+        :param times: datetime.times, each taken as its next occurrence
+        :param minutes: Minutes from now
+        :param day: Optional day name the times fall on, e.g. Friday
+        :return:
+        """
+        now = self.engine.now(table)
+        targets = [now + timedelta(minutes=minute) for minute in minutes or []]
+        for time in times or []:
+            target = datetime.combine(now.date(), time)
+            if day:
+                target += timedelta(days=(weekday_index(day) - now.weekday()) % 7)
+            if target < now:
+                target += timedelta(days=7 if day else 1)
+            targets.append(target)
+        if not targets:
+            raise ValueError('Give at least one time or number of minutes ahead')
+        if len(targets) > MAX_TARGETS:
+            raise ValueError(f'At most {MAX_TARGETS} times can be forecast at once')
+        if any(target < now or target > now + timedelta(minutes=MAX_HORIZON) for target in targets):
+            raise ValueError(f'Forecasts must be between now and {MAX_HORIZON // 1440} days ahead')
+        return targets
+
+    @newrelic.agent.background_task()
+    async def forecast(self, table, targets, names=None, shuttle=False) -> dict:
+        """
+        Forecast every name (or the ones matching `names`) at every target time
+        :param table:
+        :param targets: datetimes from targets()
+        :param names: Optional case insensitive substrings of the names to keep
+        :param shuttle:
+        :return: {'names', 'targets', 'as_of', 'current', 'typical', 'forecast'}, the last two
+            being (names x targets) matrices
+        """
+        await self.engine.ensure(table, shuttle=shuttle)
+        series = self.engine.tables[table]
+        rows = [row for row, name in enumerate(series.names)
+                if series.series[row].length and (not names or any(n.lower() in name.lower() for n in names))]
+        profile = self.profile(table)[rows]
+        anchors, currents, slopes = self.trends(series)
+        anchors, currents, slopes = anchors[rows], currents[rows], slopes[rows]
+
+        # Everything below is (names x targets)
+        target_seconds = epoch_seconds(targets)
+        horizon = np.maximum((target_seconds[None, :] - anchors[:, None]) / 60, 0)
+        index = np.arange(len(rows))[:, None]
+        typical_now = profile[index[:, 0], minute_of_week(anchors)]
+        typical_now = np.where(np.isnan(typical_now), currents, typical_now)
+        typical = profile[index, minute_of_week(target_seconds)[None, :]]
+        typical = np.where(np.isnan(typical), typical_now[:, None], typical)
+
+        weight = np.exp(-horizon / ANOMALY_DECAY)
+        trend = slopes[:, None] * np.minimum(horizon, TREND_MINUTES)
+        forecast = typical + weight * ((currents - typical_now)[:, None] + trend)
+        forecast = np.clip(forecast, 0, None if shuttle else 100)
+        return {
+            'names': [series.names[row] for row in rows],
+            'targets': targets,
+            'as_of': [datetime.utcfromtimestamp(int(anchor)) for anchor in anchors],
+            'current': currents,
+            'typical': typical,
+            'forecast': forecast,
+        }
+
+    @staticmethod
+    def render(result, shuttle=False) -> list:
+        """
+        Forecasts as rows in the style of the other endpoints, ending with a 'Data above is...' row
+        :param result: From forecast()
+        :param shuttle:
+        :return:
+        """
+        key, value, unit = ('stop_name', 'forecast_time_to_departure', ' minutes') if shuttle \
+            else ('name', 'forecast_fullness', '%')
+        results = []
+        for j, target in enumerate(result['targets']):
+            for i, name in enumerate(result['names']):
+                results.append({
+                    key: name,
+                    'time': str(target),
+                    value: f"{round(result['forecast'][i, j])}{unit}",
+                    'typical': f"{round(result['typical'][i, j])}{unit}",
+                    'current': f"{round(result['current'][i])}{unit}",
+                })
+        results.append({key: f"Data above is forecast from readings through {max(result['as_of'], default=None)}",
+                        'time': '', value: '', 'typical': '', 'current': ''})
+        return results
+
+    @staticmethod
+    def columns(result, shuttle=False) -> tuple:
+        """
+        Forecasts as typed columns, one entry per name and time
+        :param result: From forecast()
+        :param shuttle:
+        :return: (columns, meta)
+        """
+        key, value = ('stop_name', 'time_to_departure') if shuttle else ('name', 'fullness')
+        count = len(result['names'])
+        return {
+            key: result['names'] * len(result['targets']),
+            'time': [target for target in result['targets'] for _ in range(count)],
+            value: result['forecast'].T.ravel().tolist(),
+            'typical': result['typical'].T.ravel().tolist(),
+            'current': np.tile(result['current'], len(result['targets'])).tolist(),
+        }, {'as_of': dict(zip(result['names'], result['as_of']))}
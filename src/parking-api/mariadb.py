@@ -1,28 +1,66 @@
-import mysql.connector
+import aiomysql
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
 from os import getenv
 from datetime import timedelta, datetime
 from api_log import BotLog
-from time import sleep
+from rollup import weekday_index, columns, YESTERDAY, LAST_WEEK
+from storage import Storage
+from query_guard import GuardedQuery
+from campuses import registry
+from metrics import timed, RECONNECTS
 import newrelic.agent
 
 logger = BotLog('api-mariadb')
 
-class Config:
+# Run the endpoint queries as server-side prepared statements instead of re-sending their text
+DB_PREPARED = getenv("DB_PREPARED", "true").lower() == "true"
+# MariaDB errors meaning a connection no longer has a statement: unknown handler, needs re-preparing
+STATEMENT_LOST = (1243, 1615)
+
+class Config(Storage):
     """
     Class for storing configuration information for the MariaDB database
     """
-    def __init__(self):
+    dialect = 'mariadb'
+
+    def __init__(self, host=None, port=None, name=None, user=None, password=None, pool_size=None):
         """
-        Initialize the Config class
+        Initialize the Config class. The pool itself is created by retry_connection
+        once an event loop is running (see the before_serving hook in api.py).
+        Settings not given come from the DB_* environment variables.
+        :param host:
+        :param port:
+        :param name: The database name
+        :param user:
+        :param password:
+        :param pool_size: Most pooled connections
         """
-        self.conn = None
-        self.retry_connection()
+        self.host = host or getenv("DB_HOST")
+        self.port = int(port or getenv("DB_PORT", 3306))
+        self.name = name or getenv("DB_NAME")
+        self.user = user or getenv("DB_USER")
+        self.password = password or getenv("DB_PASS")
+        self.pool = None
+        self.pool_size = int(pool_size or getenv("DB_POOL_SIZE", 10))
+        # Recycle pooled connections before the server's wait_timeout kills them
+        self.pool_recycle = int(getenv("DB_POOL_RECYCLE", 3600))
+        self.health_interval = int(getenv("DB_HEALTH_INTERVAL", 30))
+        self.health_task = None
+        self.healthy = False
+        self.prepare = DB_PREPARED
+        # (query, table, shuttle) -> (statement name, SQL with ? placeholders), built once
+        self.statements = {}
+        # connection -> names of the statements prepared on it; prepared statements live as
+        # long as the session, and a connection the pool replaces is simply forgotten
+        self.prepared = weakref.WeakKeyDictionary()
 
     @newrelic.agent.background_task()
-    def retry_connection(self, max_retries=3, delay=5):
+    async def retry_connection(self, max_retries=3, delay=5):
         """
-        Try and get a connection to the MariaDB database
-        and retry as needed. Enables async use of the db.
+        Try and create the connection pool for the MariaDB database
+        and retry as needed. Only runs at startup, never on the request path.
         :param max_retries:
         :param delay:
         :return:
@@ -30,64 +68,345 @@ class Config:
         retries = 0
         while retries < max_retries:
             try:
-                self.conn = mysql.connector.connect(
-                    host=getenv("DB_HOST"),
-                    user=getenv("DB_USER"),
-                    password=getenv("DB_PASS"),
-                    database=getenv("DB_NAME"),
-                    port=getenv("DB_PORT")
+                # autocommit keeps pooled connections from holding a REPEATABLE READ
+                # snapshot open between requests, which is what made results go stale
+                self.pool = await aiomysql.create_pool(
+                    host=self.host,
+                    user=self.user,
+                    password=self.password,
+                    db=self.name,
+                    port=self.port,
+                    minsize=1,
+                    maxsize=self.pool_size,
+                    pool_recycle=self.pool_recycle,
+                    autocommit=True
                 )
-                if self.conn:
-                    logger.info(f'Connected to MariaDB host {getenv("DB_HOST")}')
+                if self.pool:
+                    logger.info(f'Connected to MariaDB host {self.host} with pool size {self.pool_size}')
+                    self.healthy = True
+                    self.health_task = asyncio.create_task(self.health_loop())
                     return
             except Exception as e:
-                logger.error(f'Could not connect to MariaDB host {getenv("DB_HOST")}: {e}')
-                sleep(delay)
+                logger.error(f'Could not connect to MariaDB host {self.host}: {e}')
+                RECONNECTS.inc(self.host or 'default', 'connect_failed')
+                await asyncio.sleep(delay)
                 retries += 1
 
-        logger.error(f'Failed to connect to MariaDB host {getenv("DB_HOST")} after {max_retries} retries')
+        logger.error(f'Failed to connect to MariaDB host {self.host} after {max_retries} retries')
 
         # If we can't connect, we can't do anything, so just kill the app
-        self.__del__()
+        raise ConnectionError(f'Could not connect to MariaDB host {self.host}')
+
+    async def close(self):
+        """
+        Stop the health checks and close every connection in the pool
+        :return:
+        """
+        if self.health_task:
+            self.health_task.cancel()
+            self.health_task = None
+        if self.pool:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+        logger.info(f'Closed MariaDB pool for host {self.host}')
 
+    async def health_check(self) -> bool:
+        """
+        Ping the database with a pooled connection.
+        Used by the health loop and the /health endpoint.
+        :return: True if the database answered
+        """
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.ping(reconnect=True)
+            self.healthy = True
+        except Exception as e:
+            logger.error(f'Health check against {self.host} failed: {e}')
+            RECONNECTS.inc(self.host or 'default', 'health_check_failed')
+            self.healthy = False
+        return self.healthy
 
-    def __del__(self):
+    async def health_loop(self):
         """
-        Close the connection to the MariaDB database
+        Periodically health check the pool so a dead database shows up in the logs
+        (and on /health) before a request runs into it.
         :return:
         """
-        self.conn.close()
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.health_check()
+
+    def pool_status(self) -> dict:
+        """
+        Current pool usage, reported by the /health endpoint
+        :return:
+        """
+        if not self.pool:
+            return {'size': 0, 'free': 0, 'max': self.pool_size}
+        return {'size': self.pool.size, 'free': self.pool.freesize, 'max': self.pool.maxsize}
 
     @newrelic.agent.background_task()
-    def get_cursor(self):
+    @timed
+    async def fetch_all(self, query, args=None) -> list:
         """
-        Get a cursor for the MariaDB database
+        Run a query on a pooled connection and return every row as a dict.
+        A connection the server has dropped is discarded and the query is retried once
+        on a fresh connection instead of reconnecting the whole client.
+        :param query:
+        :param args:
         :return:
         """
+        for attempt in range(2):
+            async with self.pool.acquire() as conn:
+                try:
+                    async with conn.cursor(aiomysql.DictCursor) as cursor:
+                        await cursor.execute(query, args)
+                        return await cursor.fetchall()
+                except (aiomysql.OperationalError, aiomysql.InterfaceError) as e:
+                    # Closed connections are dropped by the pool when released
+                    conn.close()
+                    RECONNECTS.inc(self.host or 'default', 'dropped_connection')
+                    if attempt:
+                        raise
+                    logger.warning(f'Pooled connection to {self.host} failed, retrying: {e}')
+
+    def statement(self, key, build) -> tuple:
+        """
+        The server-side name and SQL of an endpoint query, building it on first use.
+        Only tables in the campus registry get a statement.
+        :param key: (query, table, shuttle)
+        :param build: A callable returning the query with %s placeholders
+        :return: (name, SQL with ? placeholders)
+        """
+        if key not in self.statements:
+            table = key[1]
+            if table not in registry.owners:
+                raise ValueError(f'{table} is not a registered table')
+            sql = build().strip().rstrip(';').replace('%s', '?').replace('%%', '%')
+            self.statements[key] = (f'parking_{len(self.statements) + 1}', sql)
+        return self.statements[key]
+
+    @newrelic.agent.background_task()
+    @timed
+    async def fetch_prepared(self, key, build, args=()) -> list:
+        """
+        Run an endpoint query as a prepared statement: PREPAREd once per pooled connection,
+        then only EXECUTEd with its arguments, so the server parses it once per connection
+        instead of once per request. With DB_PREPARED off it's a plain fetch_all.
+        :param key: (query, table, shuttle), which names the statement
+        :param build: A callable returning the query with %s placeholders; only called once per key
+        :param args: The placeholder values
+        :return: Every row as a dict
+        """
+        name, sql = self.statement(key, build)
+        if not self.prepare:
+            return await self.fetch_all(build(), args or None)
+        execute = f'EXECUTE `{name}`' + (f' USING {", ".join(["%s"] * len(args))}' if args else '')
+        for attempt in range(2):
+            async with self.pool.acquire() as conn:
+                names = self.prepared.setdefault(conn, set())
+                try:
+                    async with conn.cursor(aiomysql.DictCursor) as cursor:
+                        if name not in names:
+                            await cursor.execute(f'PREPARE `{name}` FROM %s', (sql,))
+                            names.add(name)
+                        await cursor.execute(execute, args or None)
+                        return await cursor.fetchall()
+                except aiomysql.OperationalError as e:
+                    if e.args and e.args[0] in STATEMENT_LOST:
+                        # A reconnect or schema change dropped it; prepare it again
+                        names.discard(name)
+                    else:
+                        conn.close()
+                        RECONNECTS.inc(self.host or 'default', 'dropped_connection')
+                    if attempt:
+                        raise
+                    logger.warning(f'Prepared statement {name} failed on {self.host}, retrying: {e}')
+                except aiomysql.InterfaceError as e:
+                    conn.close()
+                    RECONNECTS.inc(self.host or 'default', 'dropped_connection')
+                    if attempt:
+                        raise
+                    logger.warning(f'Pooled connection to {self.host} failed, retrying: {e}')
+
+    @timed
+    async def stream_chunks(self, query, args=None, chunk=500):
+        """
+        Run a query on an unbuffered server-side cursor and yield the rows in lists of
+        up to `chunk`, so memory stays flat however many rows the query returns.
+        If the caller stops early the connection is closed (and dropped by the pool)
+        rather than reading the rest of the result off the wire.
+        :param query:
+        :param args:
+        :param chunk: Rows fetched per round trip
+        :return:
+        """
+        conn = await self.pool.acquire()
+        finished = False
         try:
-            cursor = self.conn.cursor(dictionary=True)
-        except Exception as e:
-            if 'MySQL Connection not available' in str(e):
-                self.retry_connection()
-                cursor = self.conn.cursor(dictionary=True)
-            else:
-                logger.error(f"Could not create cursor for {getenv('DB_HOST')}: {e}")
-                return None
-        return cursor
+            cursor = await conn.cursor(aiomysql.SSDictCursor)
+            await cursor.execute(query, args)
+            while True:
+                rows = await cursor.fetchmany(chunk)
+                if not rows:
+                    break
+                yield rows
+            await cursor.close()
+            finished = True
+        finally:
+            if not finished:
+                conn.close()
+            self.pool.release(conn)
 
     @newrelic.agent.background_task()
-    def get_latest(self, table, shuttle=False):
+    @timed
+    async def execute(self, query, args=None) -> int:
+        """
+        Run a statement that doesn't return rows (DDL, upserts) on a pooled connection
+        :param query:
+        :param args:
+        :return: The number of affected rows
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                return await cursor.execute(query, args)
+
+    @newrelic.agent.background_task()
+    @timed
+    async def executemany(self, query, rows) -> int:
+        """
+        Run one statement for many rows in a single transaction; aiomysql batches INSERT ... VALUES
+        into multi-row statements
+        :param query:
+        :param rows:
+        :return: The number of affected rows
+        """
+        async with self.transaction() as cursor:
+            return await cursor.executemany(query, rows)
+
+    async def now(self) -> datetime:
+        """
+        MariaDB's NOW(), which the scraper's timestamps follow
+        :return:
+        """
+        return (await self.fetch_all('SELECT NOW() AS now'))[0]['now']
+
+    def guarded_query(self, sql):
+        """
+        A /query statement checked and run read-only with a server-side timeout and row cap
+        :param sql:
+        :return:
+        """
+        return GuardedQuery(self, sql)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Hold one pooled connection inside a transaction for the duration of the block.
+        Commits on success and rolls back if the block raises.
+        :return: A dict cursor bound to the transaction
+        """
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    yield cursor
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_latest(self, table, shuttle=False):
         """
         Get the latest entry for each unique name.
-        Used by the /latest endpoint.
+        /latest answers from the SnapshotStore (get_latest_rows); this is kept for bench/load.py.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        try:
+            result = await self.fetch_prepared(('latest', table, shuttle), lambda: self.latest_query(table, shuttle))
+        except Exception as e:
+            logger.error(f'Could not get latest entry in {table}: {e}')
+            return None
+        num_results = len(result) if result else 0
+        logger.info(f'Found {num_results} results for latest entry in {table}')
+        return result
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_latest_rows(self, table, shuttle=False) -> list:
+        """
+        Get the latest typed reading for each unique name.
+        Used to load the /latest snapshot.
+        :param table:
+        :param shuttle:
+        :return: A list of {'name', 'value', 'time'} dicts
+        """
+        results = await self.fetch_prepared(('latest_rows', table, shuttle), lambda: self.latest_rows_query(table, shuttle))
+        logger.info(f'Loaded {len(results)} latest rows from {table}')
+        return results
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_newer_rows(self, table, since, shuttle=False) -> list:
+        """
+        Get the typed readings at or after a timestamp, oldest first.
+        Used to refresh the /latest snapshot incrementally.
         :param table:
+        :param since: The last timestamp the caller has seen
+        :param shuttle:
+        :return: A list of {'name', 'value', 'time'} dicts
+        """
+        return await self.fetch_prepared(('newer_rows', table, shuttle), lambda: self.newer_rows_query(table, shuttle), (since,))
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_at_rows(self, table, pairs, shuttle=False) -> list:
+        """
+        Get the newest typed reading of each name at or before an instant.
+        Every pair is its own ORDER BY ... DESC LIMIT 1 on the (name, time) index, so a lookup
+        reads one row per pair however long the history is; the pairs go in one UNION ALL round trip.
+        Used by the /at endpoint.
+        :param table:
+        :param pairs: (name, datetime) tuples
+        :param shuttle:
+        :return: A list of {'pair', 'name', 'value', 'time'} dicts
+        """
+        return await self.fetch_all(self.at_query(table, len(pairs), shuttle), [arg for pair in pairs for arg in pair])
+
+    @staticmethod
+    def at_query(table, count, shuttle=False) -> str:
+        """
+        One (name, time) index seek per pair, in a UNION ALL.
+        Takes (name, instant) of every pair, in order, as arguments.
+        :param table:
+        :param count: The number of pairs
         :param shuttle:
         :return:
         """
-        cursor = self.get_cursor()
+        name, value, time = columns(shuttle)
+        return ' UNION ALL '.join(f'''(
+            SELECT {index} AS pair, {name} AS name, {value} AS value, {time} AS time
+            FROM `{table}`
+            WHERE {name} = %s AND {time} <= %s
+            ORDER BY {time} DESC
+            LIMIT 1
+        )''' for index in range(count))
 
-        # Determine the query to use based on whether we're looking at the shuttle or not
-        cursor.execute(f'''
+    @staticmethod
+    def latest_query(table, shuttle=False) -> str:
+        """
+        Per-name latest readings as display strings, plus the 'Data above' row.
+        Takes no arguments.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return f'''
             WITH latest_time AS (
                 SELECT name, MAX(time) AS most_recent_time
                 FROM `{table}`
@@ -111,108 +430,138 @@ class Config:
             UNION ALL
             SELECT NULL AS time_to_departure, CONCAT('Data above is current through the most recent time: ', MAX(lt.most_recent_time)) AS stop_name
             FROM latest_time lt;
-            ''')
-        try:
-            result = cursor.fetchall()
-        except Exception as e:
-            logger.error(f'Could not get latest entry in {table}: {e}')
-            return None
-        num_results = len(result) if result else 0
-        self.conn.close()
-        #self.conn = None
-        logger.info(f'Found {num_results} results for latest entry in {table}')
-        return result
+            '''
 
-    @newrelic.agent.background_task()
-    def get_yesterday(self, table, shuttle=False):
+    @staticmethod
+    def latest_rows_query(table, shuttle=False) -> str:
         """
-        Get the average fullness for each unique name for the previous day.
-        Used by the /yesterday endpoint.
+        Per-name latest typed readings. Takes no arguments.
         :param table:
         :param shuttle:
         :return:
         """
-        cursor = self.get_cursor()
-        # Determine the query to use based on whether we're looking at the shuttle or not
-        query = f'''
-            SELECT CONCAT(CEILING(AVG(fullness)), '%') AS avg_fullness, name
+        return f'''
+            SELECT t.name AS name, t.fullness AS value, t.time AS time
+            FROM `{table}` t
+            JOIN (
+                SELECT name, MAX(time) AS most_recent_time
+                FROM `{table}`
+                GROUP BY name
+            ) lt ON lt.name = t.name AND lt.most_recent_time = t.time
+        ''' if not shuttle else f'''
+            SELECT t.stop_name AS name, t.time_to_departure AS value, t.updated_at AS time
+            FROM `{table}` t
+            JOIN (
+                SELECT stop_name, MAX(updated_at) AS most_recent_time
+                FROM `{table}`
+                GROUP BY stop_name
+            ) lt ON lt.stop_name = t.stop_name AND lt.most_recent_time = t.updated_at
+        '''
+
+    @staticmethod
+    def newer_rows_query(table, shuttle=False) -> str:
+        """
+        Typed readings at or after a timestamp, oldest first. Takes (since,) as arguments.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return f'''
+            SELECT name AS name, fullness AS value, time AS time
             FROM `{table}`
-            WHERE time >= DATE_ADD(NOW(), INTERVAL -1 DAY) - INTERVAL 30 MINUTE
-            AND time < DATE_ADD(NOW(), INTERVAL -1 DAY) + INTERVAL 30 MINUTE
-            GROUP BY name
-            UNION ALL
-            
-            SELECT CONCAT('Data above is for ', 
-                  DATE_ADD(NOW(), INTERVAL -1 DAY) - INTERVAL 30 MINUTE,
-                  ' to ', 
-                  DATE_ADD(NOW(), INTERVAL -1 DAY) + INTERVAL 30 MINUTE
-                 ) AS message, '' AS name;
+            WHERE time >= %s
+            ORDER BY time
         ''' if not shuttle else f'''
-            SELECT CONCAT(CEILING(AVG(time_to_departure)), ' minutes') AS avg_time_to_departure, stop_name
+            SELECT stop_name AS name, time_to_departure AS value, updated_at AS time
             FROM `{table}`
-            WHERE updated_at >= DATE_ADD(NOW(), INTERVAL -1 DAY) - INTERVAL 30 MINUTE
-            AND updated_at < DATE_ADD(NOW(), INTERVAL -1 DAY) + INTERVAL 30 MINUTE
-            GROUP BY stop_name
-            UNION ALL
-            
-            SELECT CONCAT('Data above is for ',
-                  DATE_ADD(NOW(), INTERVAL -1 DAY) - INTERVAL 30 MINUTE,
-                  ' to ',
-                  DATE_ADD(NOW(), INTERVAL -1 DAY) + INTERVAL 30 MINUTE
-                 ) AS message, '' AS stop_name;
+            WHERE updated_at >= %s
+            ORDER BY updated_at
         '''
-        cursor.execute(query)
-        try:
-            results = cursor.fetchall()
-        except Exception as e:
-            logger.error(f'Could not get last week\'s entries in {table}: {e}')
-            return None
-        logger.info(f'Found {len(results)} results for last week in {table}')
-        return results
 
-    @newrelic.agent.background_task()
-    def get_last_week(self, table, shuttle=False):
+    @staticmethod
+    def window_query(table, shuttle=False) -> str:
         """
-        Get the average fullness for each unique name for the previous week.
-        Used by the /last_week endpoint.
+        Averages per name between two timestamps, for get_yesterday/get_last_week.
+        The endpoints read the rollup instead (Rollup.window_query); this stays as bench/load.py's reference.
+        The bounds are literals rather than NOW() arithmetic so the optimizer can prune the
+        monthly partitions (see partition.py) as well as seek on the time index.
+        Takes (start, end, start, end) as arguments; see window_bounds.
         :param table:
         :param shuttle:
         :return:
         """
-        cursor = self.get_cursor()
-
-        # Determine the query to use based on whether we're looking at the shuttle or not
-        query = f'''
-            SELECT CONCAT(CEILING(AVG(fullness)), '%') AS avg_fullness, name
+        return f'''
+            SELECT CONCAT(CEILING(AVG(fullness)), '%%') AS avg_fullness, name
             FROM `{table}`
-            WHERE time >= DATE_ADD(NOW(), INTERVAL -168 HOUR) - INTERVAL 30 MINUTE
-            AND time < DATE_ADD(NOW(), INTERVAL -168 HOUR)
+            WHERE time >= %s
+            AND time < %s
             GROUP BY name
             UNION ALL
-            
-            SELECT CONCAT('Data above is for ', 
-                  DATE_ADD(DATE_ADD(NOW(), INTERVAL -168 HOUR), INTERVAL -30 MINUTE),
-                  ' to ', 
-                  DATE_ADD(NOW(), INTERVAL -168 HOUR)
-                 ) AS message, '' AS name;
+
+            SELECT CONCAT('Data above is for ', %s, ' to ', %s) AS message, '' AS name;
         ''' if not shuttle else f'''
             SELECT CONCAT(CEILING(AVG(time_to_departure)), ' minutes') AS avg_time_to_departure, stop_name
             FROM `{table}`
-            WHERE updated_at >= DATE_ADD(NOW(), INTERVAL -168 HOUR) - INTERVAL 30 MINUTE
-            AND updated_at < DATE_ADD(NOW(), INTERVAL -168 HOUR)
+            WHERE updated_at >= %s
+            AND updated_at < %s
             GROUP BY stop_name
             UNION ALL
-            
-            SELECT CONCAT('Data above is for ', 
-                  DATE_ADD(DATE_ADD(NOW(), INTERVAL -168 HOUR), INTERVAL -30 MINUTE),
-                  ' to ', 
-                  DATE_ADD(NOW(), INTERVAL -168 HOUR)
-                 ) AS message, '' AS stop_name;
+
+            SELECT CONCAT('Data above is for ', %s, ' to ', %s) AS message, '' AS stop_name;
         '''
-        cursor.execute(query)
+
+    async def window_bounds(self, start_minutes, end_minutes) -> tuple:
+        """
+        The window_query arguments for a window between two offsets before the database's NOW()
+        :param start_minutes:
+        :param end_minutes:
+        :return: (start, end, start, end)
+        """
+        now = await self.now()
+        start, end = now - timedelta(minutes=start_minutes), now - timedelta(minutes=end_minutes)
+        return start, end, start, end
+
+    @staticmethod
+    def average_query(table, shuttle=False) -> str:
+        """
+        Averages per name for a weekday and minute-of-day range, plus the WITH ROLLUP total, for get_average.
+        The endpoints read the rollup instead (Rollup.average_query); this stays as bench/load.py's reference.
+        Filters on the persisted weekday/minute_of_day columns (see migrate.py) so the
+        weekday_minute index is used instead of evaluating DAYNAME()/TIME() on every row.
+        Takes (weekday, first minute, last minute) as arguments.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return f"""
+            SELECT name, CONCAT(CEILING(AVG(fullness)), '%%') AS fullness
+            FROM `{table}`
+            WHERE weekday = %s
+              AND minute_of_day BETWEEN %s AND %s
+            GROUP BY name
+            WITH ROLLUP
+        """ if not shuttle else f"""
+            SELECT stop_name, CONCAT(CEILING(AVG(time_to_departure)), ' minutes') AS average_time_to_departure
+            FROM `{table}`
+            WHERE weekday = %s
+              AND minute_of_day BETWEEN %s AND %s
+            GROUP BY stop_name
+            WITH ROLLUP
+        """
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_yesterday(self, table, shuttle=False):
+        """
+        Get the average fullness for each unique name for the previous day.
+        site.analytics (Rollup or SeriesEngine) answers /yesterday; this direct query is kept for bench/load.py.
+        :param table:
+        :param shuttle:
+        :return:
+        """
         try:
-            results = cursor.fetchall()
-            print(results)
+            results = await self.fetch_prepared(('window', table, shuttle), lambda: self.window_query(table, shuttle),
+                                                 await self.window_bounds(*YESTERDAY))
         except Exception as e:
             logger.error(f'Could not get yesterday\'s entries in {table}: {e}')
             return None
@@ -220,70 +569,65 @@ class Config:
         return results
 
     @newrelic.agent.background_task()
-    def get_average(self, table, day, time, shuttle=False):
+    @timed
+    async def get_last_week(self, table, shuttle=False):
+        """
+        Get the average fullness for each unique name for the previous week.
+        site.analytics (Rollup or SeriesEngine) answers /last_week; this direct query is kept for bench/load.py.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        try:
+            results = await self.fetch_prepared(('window', table, shuttle), lambda: self.window_query(table, shuttle),
+                                                 await self.window_bounds(*LAST_WEEK))
+        except Exception as e:
+            logger.error(f'Could not get last week\'s entries in {table}: {e}')
+            return None
+        logger.info(f'Found {len(results)} results for last week in {table}')
+        return results
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_average(self, table, day, time, shuttle=False):
         """
         Get the average fullness for each unique name for the given day and time.
-        Used by the /average endpoint.
+        site.analytics (Rollup or SeriesEngine) answers /average; this direct query is kept for bench/load.py.
         :param table:
         :param day:
         :param time:
         :param shuttle:
         :return:
         """
-        cursor = self.get_cursor()
-        # Determine the query to use based on whether we're looking at the shuttle or not
-        query = f"""
-            SELECT name, CONCAT(CEILING(AVG(fullness)), '%') AS fullness
-            FROM `{table}`
-            WHERE DAYNAME(time) = '{day}'
-              AND TIME(time) BETWEEN ADDTIME('{time}', '-01:00:00') AND '{time}'
-            GROUP BY name
-            WITH ROLLUP
-            
-            UNION ALL
-            
-            SELECT CONCAT('Data above is average fullness for ', '{day}', ' at ', '{time}') AS name, CONCAT(CEILING(AVG(fullness)), '%') AS fullness
-            FROM `{table}`
-            WHERE DAYNAME(time) = '{day}'
-              AND TIME(time) BETWEEN ADDTIME('{time}', '-01:00:00') AND '{time}'
-
-        """ if not shuttle else f"""
-            SELECT stop_name, CONCAT(CEILING(AVG(time_to_departure)), ' minutes') AS average_time_to_departure
-            FROM `{table}`
-            WHERE DAYNAME(updated_at) = '{day}'
-            AND TIME(updated_at) BETWEEN ADDTIME('{time}', '-01:00:00') AND '{time}'
-            GROUP BY stop_name
-            WITH ROLLUP
-            
-            UNION ALL
-            
-            SELECT CONCAT('Data above is average time to departure for ', '{day}', ' at ', '{time}') AS stop_name, CONCAT(CEILING(AVG(time_to_departure)), ' minutes') AS average_time_to_departure
-            FROM `{table}`
-            WHERE DAYNAME(updated_at) = '{day}'
-            AND TIME(updated_at) BETWEEN ADDTIME('{time}', '-01:00:00') AND '{time}'
-        """
-        cursor.execute(query)
+        weekday = weekday_index(day)
+        minute = time.hour * 60 + time.minute
         try:
-            results = cursor.fetchall()
-            print(results)
+            results = list(await self.fetch_prepared(('average', table, shuttle), lambda: self.average_query(table, shuttle),
+                                                     (weekday, max(minute - 60, 0), minute)))
         except Exception as e:
             logger.error(f'Could not get average fullness for {table}: {e}')
             return None
+
+        # The WITH ROLLUP row already holds the overall average, so the 'Data above' row
+        # reuses it instead of scanning the table a second time
+        key, value, label = ('stop_name', 'average_time_to_departure', 'average time to departure') \
+            if shuttle else ('name', 'fullness', 'average fullness')
+        overall = results[-1][value] if results else None
+        results.append({key: f'Data above is {label} for {day} at {time}', value: overall})
         logger.info(f'Found {len(results)} results for {day} at {time} in {table}')
         return results
 
     @newrelic.agent.background_task()
-    def run_query(self, sql_query):
+    @timed
+    async def run_query(self, sql_query):
         """
         Run a query on the database.
         Used by the /query endpoint.
         :param sql_query:
         :return:
         """
-        cursor = self.get_cursor()
-        cursor.execute(sql_query)
         try:
-            results = cursor.fetchall()
+            results = await self.fetch_all(sql_query)
         except Exception as e:
             logger.error(f'Could not run query {sql_query}: {e}')
             return None
@@ -0,0 +1,401 @@
+import asyncio
+import inspect
+import os
+import pickle
+from bisect import bisect_left
+from functools import wraps
+from os import getenv
+from time import perf_counter
+from api_log import BotLog
+
+logger = BotLog('api-metrics')
+
+# Directory where every process under serve.py writes its metrics, so any worker's /metrics
+# reports all of them; set by serve.py, unset in single-process mode
+METRICS_DIR = getenv("METRICS_DIR")
+# Seconds between writes of a process' metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = float(getenv("METRICS_FLUSH_INTERVAL", 5))
+
+# Seconds; from a snapshot read to a slow /query
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Rows per query; from a single latest row to a full history load
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+
+def escape(value) -> str:
+    """
+    A label value as the text exposition format wants it
+    :param value:
+    :return:
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def label_text(names, values, extra='') -> str:
+    """
+    {a="1",b="2"}, or nothing without labels
+    :param names:
+    :param values:
+    :param extra: An already formatted label to append, e.g. le="0.5"
+    :return:
+    """
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def number(value) -> str:
+    """
+    A sample value; integers without the trailing .0
+    :param value:
+    :return:
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """
+    One metric family. Samples are kept per tuple of label values in plain dicts: the API runs
+    on one event loop, so an update is a dict lookup and an add, with no locks. Under serve.py
+    each process keeps its own and /metrics merges them (see gather).
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name:
+        :param help: The HELP line
+        :param labels: Label names; every update passes the values in this order
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def samples(self, values=None) -> list:
+        """
+        The family's sample lines
+        :param values: Samples to render instead of this process' own
+        :return:
+        """
+        values = self.values if values is None else values
+        return [f'{self.name}{label_text(self.labels, key)} {number(value)}'
+                for key, value in sorted(values.items())]
+
+    def render(self, values=None) -> str:
+        """
+        HELP, TYPE and sample lines
+        :param values: Samples to render instead of this process' own
+        :return:
+        """
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + self.samples(values))
+
+    def combine(self, merged, values):
+        """
+        Add another process' samples into merged ones; totals add up
+        :param merged: {labels: value}, updated in place
+        :param values: The other process' samples
+        :return:
+        """
+        for key, value in values.items():
+            merged[key] = merged.get(key, 0) + value
+
+
+class Counter(Metric):
+    """
+    A total that only goes up
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """
+        :param labels: Label values
+        :param amount:
+        :return:
+        """
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that is set, typically just before a scrape
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), merge=sum):
+        """
+        :param name:
+        :param help:
+        :param labels:
+        :param merge: How the values of several processes combine, sum or max
+        """
+        super().__init__(name, help, labels)
+        self.merge = merge
+
+    def combine(self, merged, values):
+        for key, value in values.items():
+            merged[key] = self.merge([merged[key], value]) if key in merged else value
+
+    def set(self, *labels, value):
+        """
+        :param labels: Label values
+        :param value:
+        :return:
+        """
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Observations counted into fixed buckets, plus their sum and count. Each observation
+    increments one bucket; they're only made cumulative when rendered.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """
+        :param name:
+        :param help:
+        :param labels:
+        :param buckets: Upper bounds, ascending; +Inf is added
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        """
+        :param labels: Label values
+        :param value:
+        :return:
+        """
+        state = self.values.get(labels)
+        if state is None:
+            # [per-bucket counts (+Inf last), sum]
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self, values=None) -> list:
+        lines = []
+        for key, (counts, total) in sorted((self.values if values is None else values).items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{number(bound)}"'
+                lines.append(f'{self.name}_bucket{label_text(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{label_text(self.labels, key)} {number(total)}')
+            lines.append(f'{self.name}_count{label_text(self.labels, key)} {cumulative}')
+        return lines
+
+    def combine(self, merged, values):
+        for key, (counts, total) in values.items():
+            state = merged.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            state[0] = [mine + theirs for mine, theirs in zip(state[0], counts)]
+            state[1] += total
+
+
+REQUEST_SECONDS = Histogram('parking_api_request_duration_seconds',
+                            'Time from a request arriving to its response being ready, by route',
+                            ('route', 'method', 'status'))
+QUERY_SECONDS = Histogram('parking_api_db_query_duration_seconds',
+                          'Time spent in a Storage method, by backend and method',
+                          ('backend', 'method'))
+QUERY_ROWS = Histogram('parking_api_db_rows_returned',
+                       'Rows returned by a Storage method, by backend and method',
+                       ('backend', 'method'), buckets=ROW_BUCKETS)
+QUERY_ERRORS = Counter('parking_api_db_query_errors_total',
+                       'Storage method calls that raised, by backend and method',
+                       ('backend', 'method'))
+CACHE_LOOKUPS = Counter('parking_api_cache_lookups_total',
+                        'In-process cache lookups by cache and result (hit or miss)',
+                        ('cache', 'result'))
+CACHE_EVICTIONS = Counter('parking_api_cache_evictions_total',
+                          'Entries removed from an in-process cache, by cache and reason (evicted or invalidated)',
+                          ('cache', 'reason'))
+RECONNECTS = Counter('parking_api_db_reconnects_total',
+                     'Database connections replaced, by host and reason',
+                     ('host', 'reason'))
+POOL_CONNECTIONS = Gauge('parking_api_db_pool_connections',
+                         'Connection pool size by host and state (open, in_use, max)',
+                         ('host', 'state'))
+POOL_SATURATION = Gauge('parking_api_db_pool_saturation',
+                        'Connections in use over the pool maximum, by host (the busiest process under serve.py)',
+                        ('host',), merge=max)
+REPLICA_LAG = Gauge('parking_api_replica_lag_seconds',
+                    'Seconds since the local replica last caught up with its source (the most behind process)',
+                    ('backend',), merge=max)
+FAMILIES = [REQUEST_SECONDS, QUERY_SECONDS, QUERY_ROWS, QUERY_ERRORS, CACHE_LOOKUPS, CACHE_EVICTIONS, RECONNECTS,
+            POOL_CONNECTIONS, POOL_SATURATION, REPLICA_LAG]
+
+
+def cache_lookup(cache, hit):
+    """
+    Count a lookup in one of the in-process caches
+    :param cache: e.g. snapshot, etag, coalesce
+    :param hit:
+    :return:
+    """
+    CACHE_LOOKUPS.inc(cache, 'hit' if hit else 'miss')
+
+
+def timed(function):
+    """
+    Record a Storage method's duration, rows returned and errors, labelled with the Storage's
+    dialect and the method's name. Works on coroutines and on async generators yielding lists
+    of rows (stream_chunks), which are timed until exhausted or closed.
+    Methods built on fetch_all are recorded under both names.
+    :param function:
+    :return:
+    """
+    method = function.__name__
+
+    if inspect.isasyncgenfunction(function):
+        @wraps(function)
+        async def stream(self, *args, **kwargs):
+            start = perf_counter()
+            rows = 0
+            chunks = function(self, *args, **kwargs)
+            try:
+                async for chunk in chunks:
+                    rows += len(chunk)
+                    yield chunk
+            except Exception:
+                QUERY_ERRORS.inc(self.dialect, method)
+                raise
+            finally:
+                # A caller stopping early closes this wrapper; close the stream now too so it
+                # gives its connection back instead of waiting for garbage collection
+                await chunks.aclose()
+                QUERY_SECONDS.observe(self.dialect, method, value=perf_counter() - start)
+                QUERY_ROWS.observe(self.dialect, method, value=rows)
+        return stream
+
+    @wraps(function)
+    async def call(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            result = await function(self, *args, **kwargs)
+        except Exception:
+            QUERY_ERRORS.inc(self.dialect, method)
+            raise
+        finally:
+            QUERY_SECONDS.observe(self.dialect, method, value=perf_counter() - start)
+        if isinstance(result, (list, tuple)):
+            QUERY_ROWS.observe(self.dialect, method, value=len(result))
+        return result
+    return call
+
+
+def collect_pools(databases):
+    """
+    Set the pool gauges from each Storage's pool_status, just before a scrape
+    :param databases: The Storages the API holds
+    :return:
+    """
+    for db in databases:
+        status = db.pool_status()
+        if 'seconds_since_sync' in status:
+            if status['seconds_since_sync'] is not None:
+                REPLICA_LAG.set(db.dialect, value=status['seconds_since_sync'])
+            # The MariaDB pool a replica copies from, if it replicates
+            source = getattr(db, 'source', None)
+            if not source:
+                continue
+            db, status = source, status['source']
+        host = db.host or 'default'
+        in_use = status['size'] - status['free']
+        POOL_CONNECTIONS.set(host, 'open', value=status['size'])
+        POOL_CONNECTIONS.set(host, 'in_use', value=in_use)
+        POOL_CONNECTIONS.set(host, 'max', value=status['max'])
+        POOL_SATURATION.set(host, value=in_use / status['max'] if status['max'] else 0)
+
+
+def alive(pid) -> bool:
+    """
+    Whether a process still runs
+    :param pid:
+    :return:
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def dump():
+    """
+    Write this process' samples to METRICS_DIR, replacing its previous file in one step so
+    a scrape never reads half of one
+    :return:
+    """
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.pickle')
+    with open(f'{path}.tmp', 'wb') as file:
+        pickle.dump({family.name: family.values for family in FAMILIES}, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{path}.tmp', path)
+
+
+def gather() -> dict:
+    """
+    The samples of every process under serve.py merged, this one's current and the others'
+    as of their last dump. Counters and histograms include processes that have exited, so
+    totals don't drop when a worker restarts; gauges only come from running ones.
+    :return: {family name: samples}
+    """
+    merged = {family.name: {} for family in FAMILIES}
+    for family in FAMILIES:
+        family.combine(merged[family.name], family.values)
+    for entry in os.scandir(METRICS_DIR):
+        pid, _, extension = entry.name.partition('.')
+        if extension != 'pickle' or int(pid) == os.getpid():
+            continue
+        try:
+            with open(entry.path, 'rb') as file:
+                values = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.warning(f'Skipping the metrics of process {pid}: {e}')
+            continue
+        running = alive(int(pid))
+        for family in FAMILIES:
+            if running or not isinstance(family, Gauge):
+                family.combine(merged[family.name], values.get(family.name, {}))
+    return merged
+
+
+async def flush(databases):
+    """
+    Background loop under serve.py: refresh the pool gauges and dump this process' samples
+    every METRICS_FLUSH_INTERVAL seconds, and once more when cancelled
+    :param databases: The Storages the process holds
+    :return:
+    """
+    try:
+        while True:
+            collect_pools(databases)
+            try:
+                dump()
+            except OSError as e:
+                logger.error(f'Could not write metrics to {METRICS_DIR}: {e}')
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+    finally:
+        try:
+            dump()
+        except OSError:
+            pass
+
+
+def render() -> str:
+    """
+    Every metric family in the Prometheus text exposition format; under serve.py, summed over
+    every process (pool gauges too, except saturation and replica lag, which take the highest)
+    :return:
+    """
+    if METRICS_DIR:
+        merged = gather()
+        return '\n'.join(family.render(merged[family.name]) for family in FAMILIES) + '\n'
+    return '\n'.join(family.render() for family in FAMILIES) + '\n'
@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import re
+from datetime import timedelta
+from mariadb import Config
+from rollup import Rollup, columns, CATCH_UP_BATCH, YESTERDAY
+from export import Exporter
+from campuses import registry
+from api_log import BotLog
+
+logger = BotLog('api-migrate')
+
+# Tables managed by this tool and whether they hold shuttle data: every registered campus
+# in the DB_* database (campuses.json)
+TABLES = registry.tables()
+
+# Versioned migrations per kind of table: (version, description, statements).
+# {table} is filled in with the table name. Every statement is idempotent (IF NOT EXISTS)
+# because MariaDB can't roll back DDL, so a half-applied version can simply be re-run.
+# TEXT names can only be indexed by prefix; 64 characters covers every garage and stop name.
+GARAGE_MIGRATIONS = [
+    (1, 'Persisted weekday and minute-of-day columns', [
+        '''ALTER TABLE `{table}`
+            ADD COLUMN IF NOT EXISTS `weekday` TINYINT AS (WEEKDAY(`time`)) PERSISTENT,
+            ADD COLUMN IF NOT EXISTS `minute_of_day` SMALLINT AS (HOUR(`time`) * 60 + MINUTE(`time`)) PERSISTENT''',
+    ]),
+    (2, 'Indexes for name/time seeks, time ranges and weekday/time-of-day ranges', [
+        'CREATE INDEX IF NOT EXISTS `name_time` ON `{table}` (`name`(64), `time`)',
+        'CREATE INDEX IF NOT EXISTS `time` ON `{table}` (`time`)',
+        'CREATE INDEX IF NOT EXISTS `weekday_minute` ON `{table}` (`weekday`, `minute_of_day`)',
+    ]),
+]
+
+SHUTTLE_MIGRATIONS = [
+    (1, 'Persisted weekday and minute-of-day columns', [
+        '''ALTER TABLE `{table}`
+            ADD COLUMN IF NOT EXISTS `weekday` TINYINT AS (WEEKDAY(`updated_at`)) PERSISTENT,
+            ADD COLUMN IF NOT EXISTS `minute_of_day` SMALLINT AS (HOUR(`updated_at`) * 60 + MINUTE(`updated_at`)) PERSISTENT''',
+    ]),
+    (2, 'Indexes for stop/time seeks, time ranges and weekday/time-of-day ranges', [
+        'CREATE INDEX IF NOT EXISTS `stop_updated_at` ON `{table}` (`stop_name`(64), `updated_at`)',
+        'CREATE INDEX IF NOT EXISTS `updated_at` ON `{table}` (`updated_at`)',
+        'CREATE INDEX IF NOT EXISTS `weekday_minute` ON `{table}` (`weekday`, `minute_of_day`)',
+    ]),
+]
+
+def migrations_for(shuttle):
+    """
+    The migration list for a garage or shuttle table
+    :param shuttle:
+    :return:
+    """
+    return SHUTTLE_MIGRATIONS if shuttle else GARAGE_MIGRATIONS
+
+
+async def ensure_history(db):
+    """
+    Create the table recording which versions have been applied to which table
+    :param db:
+    :return:
+    """
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS `schema_migrations` (
+            `table_name` VARCHAR(64) NOT NULL,
+            `version` INT NOT NULL,
+            `description` VARCHAR(255) NOT NULL,
+            `applied_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (`table_name`, `version`)
+        )
+    ''')
+
+
+async def applied_versions(db, table) -> set:
+    """
+    Versions already applied to a table
+    :param db:
+    :param table:
+    :return:
+    """
+    rows = await db.fetch_all('SELECT version FROM `schema_migrations` WHERE table_name = %s', (table,))
+    return {row['version'] for row in rows}
+
+
+async def status(db):
+    """
+    Log applied and pending migrations for every table
+    :param db:
+    :return:
+    """
+    await ensure_history(db)
+    for table, shuttle in TABLES.items():
+        applied = await applied_versions(db, table)
+        for version, description, _ in migrations_for(shuttle):
+            state = 'applied' if version in applied else 'pending'
+            logger.info(f'{table} v{version} [{state}]: {description}')
+
+
+async def up(db):
+    """
+    Apply every pending migration, in version order, to every table
+    :param db:
+    :return:
+    """
+    await ensure_history(db)
+    for table, shuttle in TABLES.items():
+        await apply(db, table, shuttle)
+
+
+async def apply(db, table, shuttle):
+    """
+    Apply the pending migrations of one table, which needn't be in TABLES
+    :param db:
+    :param table:
+    :param shuttle:
+    :return:
+    """
+    applied = await applied_versions(db, table)
+    for version, description, statements in migrations_for(shuttle):
+        if version in applied:
+            continue
+        logger.info(f'Applying {table} v{version}: {description}')
+        for statement in statements:
+            await db.execute(statement.format(table=table))
+        await db.execute(
+            'INSERT INTO `schema_migrations` (table_name, version, description) VALUES (%s, %s, %s)',
+            (table, version, description)
+        )
+    logger.info(f'{table} is at v{max(v for v, _, _ in migrations_for(shuttle))}')
+
+
+def migration_indexes(shuttle) -> list:
+    """
+    The names of the indexes the migrations create on a garage or shuttle table
+    :param shuttle:
+    :return:
+    """
+    return [name for _, _, statements in migrations_for(shuttle)
+            for statement in statements for name in re.findall(r'CREATE INDEX IF NOT EXISTS `(\w+)`', statement)]
+
+
+def without_indexes(query, table, indexes) -> str:
+    """
+    A query with IGNORE INDEX hints on every reference to a table, to plan it as if the
+    migrations hadn't created those indexes. The hint goes after the alias, if there is one;
+    aliases are lower case, keywords upper case.
+    :param query:
+    :param table:
+    :param indexes:
+    :return:
+    """
+    if not indexes:
+        return query
+    hint = f' IGNORE INDEX ({", ".join(f"`{index}`" for index in indexes)})'
+    return re.sub(rf'((?:FROM|JOIN) `{re.escape(table)}`(?: [a-z]\w*\b)?)', lambda match: match.group(1) + hint, query)
+
+
+async def served_queries(db, table, shuttle) -> list:
+    """
+    The queries the API runs against a source table, with example arguments
+    :param db:
+    :param table:
+    :param shuttle:
+    :return: (label, query, args) tuples
+    """
+    name, _, time = columns(shuttle)
+    state = (await db.fetch_all(f'SELECT COALESCE(MAX(id), 0) AS max_id, NOW() AS now FROM `{table}`'))[0]
+    newest = await db.fetch_all(f'SELECT {name} AS name FROM `{table}` ORDER BY id DESC LIMIT 1')
+    example = newest[0]['name'] if newest else ''
+    now, max_id = state['now'], state['max_id']
+    export, export_args = Exporter.query(table, now - timedelta(days=1), now, shuttle=shuttle)
+    return [
+        ('snapshot load', Config.latest_rows_query(table, shuttle), None),
+        ('snapshot refresh', Config.newer_rows_query(table, shuttle), (now - timedelta(minutes=1),)),
+        ('/at', Config.at_query(table, 1, shuttle), (example, now - timedelta(days=1))),
+        ('rollup catch-up', Rollup.fold_query(table, shuttle), (max(max_id - CATCH_UP_BATCH, 0), max_id)),
+        ('/series and /export, one day', export, export_args),
+    ]
+
+
+async def explain(db):
+    """
+    Print EXPLAIN PARTITIONS for the queries the API runs on every table: each source table
+    query planned with the migrations' indexes ignored (before) and used (after), then the
+    rollup seed and reads, which only touch the tables Rollup creates. Partition pruning
+    (see partition.py) shows in the partitions column.
+    :param db:
+    :return:
+    """
+    for table, shuttle in TABLES.items():
+        keys = {row['Key_name'] for row in await db.fetch_all(f'SHOW INDEX FROM `{table}`')}
+        indexes = [index for index in migration_indexes(shuttle) if index in keys]
+        plans = []
+        for label, query, args in await served_queries(db, table, shuttle):
+            plans.append((f'{label} (before)', without_indexes(query, table, indexes), args))
+            plans.append((f'{label} (after)', query, args))
+        plans += [
+            ('rollup seed', Rollup.seed_query(table), None),
+            ('rollup /average', Rollup.average_query(table), (0, 9 * 60, 10 * 60)),
+            ('rollup /yesterday', Rollup.window_query(table), YESTERDAY * 2),
+        ]
+        for label, query, args in plans:
+            print(f'== {table}: {label}')
+            try:
+                for row in await db.fetch_all(f'EXPLAIN PARTITIONS {query}', args):
+                    print('  ' + ', '.join(f'{k}={v}' for k, v in row.items()))
+            except Exception as e:
+                print(f'  could not explain: {e}')
+
+
+async def main(command):
+    """
+    Connect, run one command and close the pool
+    :param command: status, up or explain
+    :return:
+    """
+    db = Config()
+    await db.retry_connection()
+    try:
+        await {'status': status, 'up': up, 'explain': explain}[command](db)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Versioned schema migrations for the parking tables')
+    parser.add_argument('command', choices=['status', 'up', 'explain'])
+    asyncio.run(main(parser.parse_args().command))
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+from datetime import datetime
+from os import getenv
+from mariadb import Config
+from migrate import TABLES
+from rollup import columns
+from compact import RETENTION_DAYS, MIN_RETENTION_DAYS, ensure_tier, compact_statement, tier_table, rollup_watermark
+from api_log import BotLog
+
+logger = BotLog('api-partition')
+
+# Months of empty partitions kept ready past the current one
+PARTITIONS_AHEAD = int(getenv("PARTITIONS_AHEAD", 3))
+# Catches rows past the last monthly partition so an insert never fails when rolling falls behind
+FUTURE = 'pfuture'
+# The lowest DATETIME, where the first partition starts
+EARLIEST = datetime(1000, 1, 1)
+
+
+def month_start(value) -> datetime:
+    """
+    Midnight on the first of a timestamp's month
+    :param value:
+    :return:
+    """
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(month, count) -> datetime:
+    """
+    The first of the month `count` months after another first of the month
+    :param month:
+    :param count:
+    :return:
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month) -> str:
+    """
+    e.g. p202309 for September 2023
+    :param month:
+    :return:
+    """
+    return f'p{month:%Y%m}'
+
+
+def partition_definitions(months) -> str:
+    """
+    RANGE COLUMNS definitions for one partition per month, plus the catch-all
+    :param months: Firsts of the month, in order
+    :return:
+    """
+    definitions = [f"PARTITION `{partition_name(month)}` VALUES LESS THAN ('{add_months(month, 1):%Y-%m-%d}')"
+                   for month in months]
+    definitions.append(f'PARTITION `{FUTURE}` VALUES LESS THAN (MAXVALUE)')
+    return ',\n'.join(definitions)
+
+
+async def partitions(db, table) -> list:
+    """
+    A table's partitions in order
+    :param db:
+    :param table:
+    :return: {'name', 'bound', 'rows'} dicts; bound is the exclusive upper bound, None for the catch-all.
+        Empty if the table isn't partitioned.
+    """
+    rows = await db.fetch_all('''
+        SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS description, TABLE_ROWS AS table_rows
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+    ''', (table,))
+    return [{
+        'name': row['name'],
+        # RANGE COLUMNS descriptions are quoted literals like '2023-10-01'
+        'bound': None if row['description'] == 'MAXVALUE' else datetime.fromisoformat(row['description'].strip("'")),
+        'rows': row['table_rows'],
+    } for row in rows]
+
+
+async def convert(db, table, shuttle=False):
+    """
+    Partition a table by month on its time column, from its oldest reading to PARTITIONS_AHEAD
+    months past this one. Every unique key has to include the partitioning column, so the
+    primary key becomes (id, time) first; ids stay unique through AUTO_INCREMENT.
+    Rebuilds the table, so run it in a quiet period. Does nothing if the table is already partitioned.
+    :param db:
+    :param table:
+    :param shuttle:
+    :return:
+    """
+    _, _, time = columns(shuttle)
+    if await partitions(db, table):
+        logger.info(f'{table} is already partitioned')
+        return
+    state = (await db.fetch_all(f'SELECT MIN({time}) AS oldest, NOW() AS now FROM `{table}`'))[0]
+    first = month_start(state['oldest'] or state['now'])
+    last = add_months(month_start(state['now']), PARTITIONS_AHEAD)
+    months = [first]
+    while months[-1] < last:
+        months.append(add_months(months[-1], 1))
+    keys = await db.fetch_all(f"SHOW KEYS FROM `{table}` WHERE Key_name = 'PRIMARY'")
+    if time not in [key['Column_name'] for key in keys]:
+        logger.info(f'Changing the primary key of {table} to (id, {time})')
+        await db.execute(f'ALTER TABLE `{table}` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `{time}`)')
+    logger.info(f'Partitioning {table} into {len(months)} months from {first:%Y-%m}')
+    await db.execute(f'ALTER TABLE `{table}` PARTITION BY RANGE COLUMNS(`{time}`) ({partition_definitions(months)})')
+
+
+async def roll(db, table, shuttle=False):
+    """
+    Split empty monthly partitions off the catch-all until there are PARTITIONS_AHEAD past this
+    month. Reorganizing an empty partition only touches metadata, so this is instant.
+    :param db:
+    :param table:
+    :param shuttle:
+    :return: The partitions added
+    """
+    existing = await partitions(db, table)
+    if not existing:
+        logger.error(f'{table} is not partitioned; run convert first')
+        return []
+    bounded = [p['bound'] for p in existing if p['bound']]
+    month = max(bounded) if bounded else month_start(datetime.now())
+    now = (await db.fetch_all('SELECT NOW() AS now'))[0]['now']
+    target = add_months(month_start(now), PARTITIONS_AHEAD)
+    months = []
+    while month <= target:
+        months.append(month)
+        month = add_months(month, 1)
+    if months:
+        await db.execute(f'ALTER TABLE `{table}` REORGANIZE PARTITION `{FUTURE}` INTO ({partition_definitions(months)})')
+        logger.info(f'Added partitions {", ".join(partition_name(m) for m in months)} to {table}')
+    return [partition_name(m) for m in months]
+
+
+async def ensure_expiry_log(db):
+    """
+    Create the table recording which partitions have been compacted, so a run that fails
+    between compacting a partition and dropping it doesn't count its readings twice
+    :param db:
+    :return:
+    """
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS `partition_expiry` (
+            `table_name` VARCHAR(64) NOT NULL,
+            `partition_name` VARCHAR(64) NOT NULL,
+            `compacted_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (`table_name`, `partition_name`)
+        )
+    ''')
+
+
+async def expire(db, table, shuttle=False, retention_days=RETENTION_DAYS, archive=False):
+    """
+    Retire every monthly partition that ends before the retention window: fold its readings
+    into the compacted tier (see compact.py) so averages keep them, then drop the partition,
+    or with `archive` swap it out into a `<table>_<partition>` table first. Either is instant,
+    unlike a DELETE of a month of rows. A partition holding ids the rollup hasn't folded in
+    yet is left for a later run, since dropping it would lose those readings from the averages.
+    :param db:
+    :param table:
+    :param shuttle:
+    :param retention_days:
+    :param archive: Keep the raw rows in a table of their own
+    :return: The partitions retired
+    """
+    if retention_days < MIN_RETENTION_DAYS:
+        raise ValueError(f'Retention must be at least {MIN_RETENTION_DAYS} days')
+    await ensure_tier(db, table)
+    await ensure_expiry_log(db)
+    cutoff = (await db.fetch_all('SELECT CURDATE() - INTERVAL %s DAY AS cutoff', (retention_days,)))[0]['cutoff']
+    cutoff = datetime.combine(cutoff, datetime.min.time())
+    compacted = {row['partition_name'] for row in await db.fetch_all(
+        'SELECT partition_name FROM `partition_expiry` WHERE table_name = %s', (table,))}
+    watermark = await rollup_watermark(db, table)
+    limit_id = watermark if watermark is not None else 2 ** 63 - 1
+    retired = []
+    start = EARLIEST
+    for partition in await partitions(db, table):
+        if partition['bound'] is None or partition['bound'] > cutoff:
+            break
+        name = partition['name']
+        highest = (await db.fetch_all(f'SELECT MAX(id) AS max_id FROM `{table}` PARTITION (`{name}`)'))[0]['max_id']
+        if highest is not None and highest > limit_id:
+            logger.warning(f'Not expiring partition {name} of {table}: it holds ids up to {highest}, '
+                           f'past the rollup watermark {limit_id}')
+            break
+        if name not in compacted:
+            async with db.transaction() as cursor:
+                await cursor.execute(compact_statement(table, shuttle, partition=name),
+                                     (start, partition['bound'], limit_id))
+                await cursor.execute('INSERT INTO `partition_expiry` (table_name, partition_name) VALUES (%s, %s)',
+                                     (table, name))
+            logger.info(f'Compacted partition {name} of {table} into {tier_table(table)}')
+        if archive:
+            archived = f'{table}_{name}'
+            await db.execute(f'CREATE TABLE IF NOT EXISTS `{archived}` LIKE `{table}`')
+            if (await partitions(db, archived)):
+                await db.execute(f'ALTER TABLE `{archived}` REMOVE PARTITIONING')
+            # A non-empty archive means an earlier run already swapped the rows out
+            if not await db.fetch_all(f'SELECT 1 FROM `{archived}` LIMIT 1'):
+                await db.execute(f'ALTER TABLE `{table}` EXCHANGE PARTITION `{name}` WITH TABLE `{archived}`')
+            logger.info(f'Archived partition {name} of {table} to {archived}')
+        await db.execute(f'ALTER TABLE `{table}` DROP PARTITION `{name}`')
+        retired.append(name)
+        start = partition['bound']
+    if retired:
+        logger.info(f'Retired partitions {", ".join(retired)} of {table}')
+    return retired
+
+
+async def status(db, args):
+    """
+    Log each table's partitions and their approximate row counts
+    :param db:
+    :param args:
+    :return:
+    """
+    for table in TABLES:
+        existing = await partitions(db, table)
+        if not existing:
+            logger.info(f'{table}: not partitioned')
+        for partition in existing:
+            logger.info(f'{table} {partition["name"]}: < {partition["bound"] or "MAXVALUE"}, ~{partition["rows"]} rows')
+
+
+async def maintain(db, args):
+    """
+    Roll partitions ahead and retire expired ones on every table; meant for a daily cron job
+    :param db:
+    :param args:
+    :return:
+    """
+    for table, shuttle in TABLES.items():
+        await roll(db, table, shuttle)
+        await expire(db, table, shuttle, retention_days=args.retention_days, archive=args.archive)
+
+
+async def main(args):
+    """
+    Connect, run one command on every table and close the pool
+    :param args:
+    :return:
+    """
+    db = Config()
+    await db.retry_connection()
+    try:
+        if args.command == 'status':
+            await status(db, args)
+        elif args.command == 'maintain':
+            await maintain(db, args)
+        else:
+            for table, shuttle in TABLES.items():
+                if args.command == 'convert':
+                    await convert(db, table, shuttle)
+                elif args.command == 'roll':
+                    await roll(db, table, shuttle)
+                else:
+                    await expire(db, table, shuttle, retention_days=args.retention_days, archive=args.archive)
+    finally:
+        await db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monthly RANGE partitions for the parking tables')
+    parser.add_argument('command', choices=['status', 'convert', 'roll', 'expire', 'maintain'])
+    parser.add_argument('--retention-days', type=int, default=RETENTION_DAYS,
+                        help='Retire partitions that end before this many days ago')
+    parser.add_argument('--archive', action='store_true',
+                        help='Swap retired partitions out into tables of their own instead of dropping them')
+    asyncio.run(main(parser.parse_args()))
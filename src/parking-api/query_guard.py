@@ -0,0 +1,179 @@
+import json
+import re
+import aiomysql
+from os import getenv
+from api_log import BotLog
+import newrelic.agent
+
+logger = BotLog('api-query-guard')
+
+# Seconds a /query statement may run before MariaDB aborts it
+QUERY_TIMEOUT = float(getenv("QUERY_TIMEOUT", 5))
+# Most rows a /query statement may return
+QUERY_ROW_CAP = int(getenv("QUERY_ROW_CAP", 1000))
+# Rows pulled from the server-side cursor at a time
+QUERY_CHUNK = 100
+
+# Words that never belong in a read-only statement. Checked outside of quotes and comments;
+# the read-only transaction the statement runs in is the backstop.
+FORBIDDEN = {
+    'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'MERGE', 'INTO', 'CREATE', 'ALTER', 'DROP',
+    'TRUNCATE', 'RENAME', 'GRANT', 'REVOKE', 'LOCK', 'UNLOCK', 'CALL', 'HANDLER', 'SET',
+    'LOAD_FILE', 'PREPARE', 'EXECUTE', 'DEALLOCATE', 'SHUTDOWN', 'KILL',
+}
+
+
+class QueryRejected(ValueError):
+    """
+    Raised when a /query statement isn't a single read-only SELECT
+    """
+
+
+def check_read_only(sql) -> str:
+    """
+    Make sure a statement is a single SELECT (or WITH ... SELECT) and nothing else.
+    Comments are stripped, MariaDB executable comments (/*! ... */) are rejected and
+    quoted strings and identifiers are blanked out before looking for forbidden words.
+    :param sql: The statement from the request
+    :return: The statement without comments or a trailing semicolon
+    """
+    if not sql or not sql.strip():
+        raise QueryRejected('No query given')
+
+    statement = []
+    words = []
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if char in '\'"`':
+            # Copy quoted text as is, but leave it out of the word check
+            end = i + 1
+            while end < len(sql) and sql[end] != char:
+                end += 2 if sql[end] == '\\' else 1
+            statement.append(sql[i:end + 1])
+            words.append(' ')
+            i = end + 1
+        elif sql.startswith('/*', i):
+            if sql.startswith('/*!', i) or sql.startswith('/*M!', i):
+                raise QueryRejected('Executable comments are not allowed')
+            end = sql.find('*/', i + 2)
+            i = len(sql) if end == -1 else end + 2
+            statement.append(' ')
+            words.append(' ')
+        elif sql.startswith('--', i) or char == '#':
+            end = sql.find('\n', i)
+            i = len(sql) if end == -1 else end
+            statement.append(' ')
+            words.append(' ')
+        else:
+            statement.append(char)
+            words.append(char)
+            i += 1
+
+    statement = ''.join(statement).strip().rstrip(';').strip()
+    words = ''.join(words).strip().rstrip(';')
+    if ';' in words:
+        raise QueryRejected('Only one statement is allowed')
+
+    tokens = re.findall(r'[A-Za-z_]+', words.upper())
+    if not tokens or tokens[0] not in ('SELECT', 'WITH'):
+        raise QueryRejected('Only SELECT statements are allowed')
+    forbidden = FORBIDDEN.intersection(tokens)
+    if forbidden:
+        raise QueryRejected(f'Statement uses {", ".join(sorted(forbidden))}')
+    return statement
+
+
+class GuardedQuery:
+    """
+    Runs one checked statement in a read-only transaction with a statement timeout and a
+    row cap enforced by the server, and streams the rows off an unbuffered cursor.
+    Holds its pooled connection until the rows are consumed or close() is called.
+    """
+    def __init__(self, db, sql):
+        """
+        :param db: The Config whose pool to borrow a connection from
+        :param sql: The statement from the request
+        """
+        self.db = db
+        self.sql = check_read_only(sql)
+        self.conn = None
+        self.cursor = None
+        self.count = 0
+        self.truncated = False
+
+    @newrelic.agent.background_task()
+    async def start(self):
+        """
+        Borrow a connection and execute the statement, so errors surface before
+        any part of the response has been sent.
+        :return:
+        """
+        self.conn = await self.db.pool.acquire()
+        try:
+            async with self.conn.cursor() as cursor:
+                await cursor.execute('START TRANSACTION READ ONLY')
+            self.cursor = await self.conn.cursor(aiomysql.SSDictCursor)
+            # One extra row tells us whether the cap cut the result short
+            await self.cursor.execute(
+                f'SET STATEMENT max_statement_time={QUERY_TIMEOUT}, sql_select_limit={QUERY_ROW_CAP + 1} '
+                f'FOR {self.sql}'
+            )
+        except Exception:
+            await self.close()
+            raise
+
+    async def rows(self):
+        """
+        Yield the result rows, QUERY_CHUNK at a time from the server, up to QUERY_ROW_CAP
+        :return:
+        """
+        try:
+            while self.count < QUERY_ROW_CAP:
+                chunk = await self.cursor.fetchmany(min(QUERY_CHUNK, QUERY_ROW_CAP - self.count))
+                if not chunk:
+                    return
+                for row in chunk:
+                    self.count += 1
+                    yield row
+            self.truncated = bool(await self.cursor.fetchone())
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Finish the result, end the transaction and give the connection back to the pool
+        :return:
+        """
+        if self.conn is None:
+            return
+        try:
+            if self.cursor:
+                await self.cursor.close()
+            await self.conn.rollback()
+        except Exception as e:
+            # Don't hand a connection in an unknown state back to the pool
+            logger.error(f'Could not clean up /query connection: {e}')
+            self.conn.close()
+        self.db.pool.release(self.conn)
+        self.conn = None
+        logger.info(f'Streamed {self.count} rows{" (truncated)" if self.truncated else ""} for query {self.sql}')
+
+    async def stream_parking_info(self):
+        """
+        Stream the /query response: a JSON string of every row's parking_info joined by
+        newlines, written as the rows arrive instead of built up in memory.
+        :return:
+        """
+        yield '"'
+        try:
+            async for row in self.rows():
+                parking_info = row.get('parking_info', '')
+                if parking_info:
+                    yield json.dumps(f'{parking_info}\n')[1:-1]
+            if self.truncated:
+                yield json.dumps(f'Results truncated at {QUERY_ROW_CAP} rows\n')[1:-1]
+        except Exception as e:
+            # Headers are gone already; end the string so the body is still valid JSON
+            logger.error(f'Query failed while streaming: {e}')
+        yield '"'
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from datetime import time as clock
+from os import getenv
+from api_log import BotLog
+from rollup import BUCKET_MINUTES, weekday_index
+from metrics import cache_lookup, CACHE_EVICTIONS
+
+logger = BotLog('api-result-cache')
+
+# Aggregate results kept across every campus; 0 turns the cache off
+RESULT_CACHE_SIZE = int(getenv("RESULT_CACHE_SIZE", 1024))
+
+
+def bucket_time(value) -> clock:
+    """
+    A time of day rounded down to the start of its rollup bucket, so requests for 10:00 and
+    10:03 share a cache entry; the rollup tables can't tell them apart anyway
+    :param value: A datetime.time
+    :return:
+    """
+    return clock(value.hour, value.minute - value.minute % BUCKET_MINUTES)
+
+
+def average_scope(day, time) -> tuple:
+    """
+    The readings an /average result is built from: one weekday over the hour before a time
+    :param day: The day name
+    :param time: The bucketed time
+    :return: (weekday, first minute of day, minute of day after the last)
+    """
+    end = time.hour * 60 + time.minute
+    return weekday_index(day), max(end - 60, 0), end
+
+
+def window_scope(start_minutes, end_minutes) -> tuple:
+    """
+    The readings a sliding window result is built from, as ages before the newest scrape.
+    Widened by a bucket on each side since the rollup reads whole buckets.
+    :param start_minutes:
+    :param end_minutes:
+    :return: (youngest age, oldest age) in minutes
+    """
+    return end_minutes - BUCKET_MINUTES, start_minutes + BUCKET_MINUTES
+
+
+class ResultCache:
+    """
+    A bounded LRU cache of /average, /average/batch, /yesterday and /lastweek results.
+    Every entry records which readings it was built from, and a snapshot refresh only drops
+    the entries whose weekday and minutes (or window) its new rows fall in, so a new scrape
+    doesn't throw away "Monday 10:00" on a Tuesday. Sliding windows also carry the five-minute
+    clock bucket in their key, like their ETags, so they age out as the window moves.
+    """
+    def __init__(self, size=RESULT_CACHE_SIZE):
+        """
+        :param size: Most entries kept; the least recently used one goes first
+        """
+        self.size = size
+        # key -> (table, averages [(weekday, start, end)], windows [(youngest, oldest)], result)
+        self.entries = OrderedDict()
+        # table -> keys, so a refresh only looks at its own table's entries
+        self.keys = {}
+        # table -> refreshes seen, so a result computed across a refresh isn't stored
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def run(self, key, table, factory, averages=(), windows=()):
+        """
+        The cached result for a key, or compute and keep it
+        :param key: A hashable tuple of everything the result depends on, starting with the endpoint
+        :param table: The table the result reads
+        :param factory: A callable returning the coroutine computing the result
+        :param averages: average_scope tuples the result depends on
+        :param windows: window_scope tuples the result depends on
+        :return: The result, shared with every other caller; don't mutate it
+        """
+        entry = self.entries.get(key)
+        cache_lookup('result', entry is not None)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[3]
+        self.misses += 1
+        generation = self.generations.get(table, 0)
+        result = await factory()
+        # New rows landed while computing; they may or may not be in the result
+        if self.size and self.generations.get(table, 0) == generation:
+            self.store(key, (table, tuple(averages), tuple(windows), result))
+        return result
+
+    def store(self, key, entry):
+        """
+        Keep an entry, evicting the least recently used ones past the size
+        :param key:
+        :param entry:
+        :return:
+        """
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.keys.setdefault(entry[0], set()).add(key)
+        while len(self.entries) > self.size:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+            CACHE_EVICTIONS.inc('result', 'evicted')
+
+    def drop(self, key):
+        """
+        Forget an entry
+        :param key:
+        :return:
+        """
+        table = self.entries.pop(key)[0]
+        self.keys[table].discard(key)
+
+    @staticmethod
+    def affected(entry, readings, newest) -> bool:
+        """
+        Whether any new reading falls in what an entry was built from
+        :param entry:
+        :param readings: (weekday, minute of day, time) of each new reading
+        :param newest: The newest reading's time, which the windows are measured back from
+        :return:
+        """
+        _, averages, windows, _ = entry
+        for weekday, minute, time in readings:
+            for average_weekday, start, end in averages:
+                if weekday == average_weekday and start <= minute < end:
+                    return True
+            age = (newest - time).total_seconds() / 60
+            for youngest, oldest in windows:
+                if youngest <= age <= oldest:
+                    return True
+        return False
+
+    async def on_update(self, updates):
+        """
+        SnapshotStore listener: drop the entries the new rows land in. Registered after the
+        aggregate engine's listener, so the rows are already folded in when an entry goes.
+        :param updates: (snapshot, changed rows) pairs from the refresher
+        :return:
+        """
+        for snapshot, changed in updates:
+            table = snapshot.table
+            self.generations[table] = self.generations.get(table, 0) + 1
+            keys = self.keys.get(table)
+            if not keys:
+                continue
+            readings = {(row['time'].weekday(), row['time'].hour * 60 + row['time'].minute, row['time'])
+                        for row in changed}
+            newest = max(time for _, _, time in readings)
+            stale = [key for key in keys if self.affected(self.entries[key], readings, newest)]
+            for key in stale:
+                self.drop(key)
+            if stale:
+                self.invalidations += len(stale)
+                CACHE_EVICTIONS.inc('result', 'invalidated', amount=len(stale))
+                logger.info(f'New rows in {table} invalidated {len(stale)} cached results')
+
+    def stats(self) -> dict:
+        """
+        Size, hits and misses, for sizing RESULT_CACHE_SIZE
+        :return:
+        """
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,484 @@
+import asyncio
+from api_log import BotLog
+import newrelic.agent
+
+logger = BotLog('api-rollup')
+
+# Width of each rollup bucket in minutes
+BUCKET_MINUTES = 5
+# Source rows folded into the rollup per transaction while catching up
+CATCH_UP_BATCH = 100000
+# Index is MariaDB's WEEKDAY() value
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+# (start, end) minutes before now of the /yesterday and /lastweek windows
+YESTERDAY = (24 * 60 + 30, 24 * 60 - 30)
+LAST_WEEK = (168 * 60 + 30, 168 * 60)
+
+
+def columns(shuttle):
+    """
+    The name, value and time columns of a garage or shuttle table
+    :param shuttle:
+    :return:
+    """
+    return ('stop_name', 'time_to_departure', 'updated_at') if shuttle else ('name', 'fullness', 'time')
+
+
+def weekday_index(day) -> int:
+    """
+    MariaDB WEEKDAY() value of a day name, case insensitive
+    :param day: e.g. Monday
+    :return:
+    """
+    try:
+        return [d.lower() for d in DAYS].index(day.strip().lower())
+    except ValueError:
+        raise ValueError(f'Invalid day: {day}')
+
+
+def day_name(day) -> str:
+    """
+    The canonical name of a day, e.g. monday -> Monday
+    :param day:
+    :return:
+    """
+    return DAYS[weekday_index(day)]
+
+
+def ceil_average(total, samples):
+    """
+    Integer CEILING(AVG()) from a rollup sum and count
+    :param total:
+    :param samples:
+    :return: None when there are no samples
+    """
+    if not samples:
+        return None
+    return -(-int(total) // int(samples))
+
+
+class Rollup:
+    """
+    Per-name sums and counts of readings in 5-minute buckets, keyed by bucket start,
+    weekday and minute of day. Kept in a `<table>_rollup` table next to each source table
+    and folded forward incrementally from the last source id it has seen, so the
+    aggregate endpoints read a few hundred bucket rows instead of scanning the history.
+    The API's database user needs write access to the rollup tables.
+    """
+    def __init__(self, db, snapshots):
+        """
+        :param db: The Config used to query MariaDB
+        :param snapshots: The SnapshotStore whose refreshes trigger a catch up
+        """
+        self.db = db
+        self.snapshots = snapshots
+        self.ready = set()
+        self.locks = {}
+        # Last source id folded into each table's rollup, kept in memory for ETags
+        self.watermarks = {}
+
+    def lock(self, table) -> asyncio.Lock:
+        """
+        One lock per source table so catch ups don't overlap
+        :param table:
+        :return:
+        """
+        if table not in self.locks:
+            self.locks[table] = asyncio.Lock()
+        return self.locks[table]
+
+    @newrelic.agent.background_task()
+    async def ensure(self, table, shuttle=False):
+        """
+        Create the rollup tables for a source table on first use and backfill them.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        if (table, shuttle) in self.ready:
+            return
+        await self.db.execute('''
+            CREATE TABLE IF NOT EXISTS `rollup_state` (
+                `source_table` VARCHAR(64) NOT NULL PRIMARY KEY,
+                `last_id` BIGINT NOT NULL
+            )
+        ''')
+        await self.db.execute(f'''
+            CREATE TABLE IF NOT EXISTS `{table}_rollup` (
+                `name` VARCHAR(255) NOT NULL,
+                `bucket_start` DATETIME NOT NULL,
+                `weekday` TINYINT NOT NULL,
+                `minute_of_day` SMALLINT NOT NULL,
+                `total` BIGINT NOT NULL,
+                `samples` INT NOT NULL,
+                PRIMARY KEY (`name`, `bucket_start`),
+                KEY `weekday_minute` (`weekday`, `minute_of_day`),
+                KEY `bucket_start` (`bucket_start`)
+            )
+        ''')
+        await self.seed(table)
+        await self.catch_up(table, shuttle=shuttle)
+        self.ready.add((table, shuttle))
+        # The snapshot refresher tells us when new rows land in this table
+        await self.snapshots.get(table, shuttle=shuttle)
+
+    async def seed(self, table):
+        """
+        Start the watermark of a new rollup at 0, folding in the readings compaction has already
+        moved out of the source table. Both happen in one transaction, so the compacted readings
+        are counted exactly once however many instances start together.
+        :param table:
+        :return:
+        """
+        from compact import ensure_tier, tier_table
+        await ensure_tier(self.db, table)
+        async with self.lock(table):
+            async with self.db.transaction() as cursor:
+                await cursor.execute('INSERT IGNORE INTO `rollup_state` (source_table, last_id) VALUES (%s, 0)', (table,))
+                if not cursor.rowcount:
+                    return
+                # Compacted buckets start on a multiple of BUCKET_MINUTES, so they map onto rollup buckets
+                await cursor.execute(f'''
+                    INSERT INTO `{table}_rollup` (name, bucket_start, weekday, minute_of_day, total, samples)
+                    {self.seed_query(table)}
+                    ON DUPLICATE KEY UPDATE total = total + VALUES(total), samples = samples + VALUES(samples)
+                ''')
+                seeded = cursor.rowcount
+        if seeded:
+            logger.info(f'Seeded {table}_rollup from {tier_table(table)}')
+
+    async def preload(self, tables):
+        """
+        Ensure every table up front so the first requests don't pay for the backfill
+        :param tables: {table: shuttle}
+        :return:
+        """
+        for table, shuttle in tables.items():
+            try:
+                await self.ensure(table, shuttle=shuttle)
+            except Exception as e:
+                # Requests will try again lazily
+                logger.error(f'Could not preload {table}: {e}')
+
+    @newrelic.agent.background_task()
+    async def catch_up(self, table, shuttle=False) -> int:
+        """
+        Fold every source row newer than the stored watermark into the rollup.
+        Each batch updates the buckets and the watermark in one transaction, with the
+        watermark row locked, so two API instances can't fold the same rows twice.
+        :param table:
+        :param shuttle:
+        :return: The number of source rows folded in
+        """
+        folded = 0
+        async with self.lock(table):
+            while True:
+                async with self.db.transaction() as cursor:
+                    await cursor.execute('SELECT last_id FROM `rollup_state` WHERE source_table = %s FOR UPDATE', (table,))
+                    last_id = (await cursor.fetchone())['last_id']
+                    await cursor.execute(f'SELECT COALESCE(MAX(id), 0) AS max_id FROM `{table}`')
+                    max_id = (await cursor.fetchone())['max_id']
+                    if max_id <= last_id:
+                        self.watermarks[table] = last_id
+                        break
+                    upper = min(max_id, last_id + CATCH_UP_BATCH)
+                    await cursor.execute(f'''
+                        INSERT INTO `{table}_rollup` (name, bucket_start, weekday, minute_of_day, total, samples)
+                        {self.fold_query(table, shuttle)}
+                        ON DUPLICATE KEY UPDATE total = total + VALUES(total), samples = samples + VALUES(samples)
+                    ''', (last_id, upper))
+                    await cursor.execute('UPDATE `rollup_state` SET last_id = %s WHERE source_table = %s', (upper, table))
+                folded += upper - last_id
+        if folded:
+            logger.info(f'Folded ids up to {upper} of {table} into {table}_rollup')
+        return folded
+
+    async def on_update(self, updates):
+        """
+        SnapshotStore listener: catch up the rollups of tables that just got new rows
+        :param updates: (snapshot, changed rows) pairs from the refresher
+        :return:
+        """
+        for snapshot, changed in updates:
+            if (snapshot.table, snapshot.shuttle) in self.ready:
+                await self.catch_up(snapshot.table, shuttle=snapshot.shuttle)
+
+    @staticmethod
+    def seed_query(table) -> str:
+        """
+        Every compacted bucket of a table, copied whole into a new rollup. Takes no arguments.
+        :param table: The source table
+        :return:
+        """
+        from compact import tier_table
+        return f'SELECT name, bucket_start, weekday, minute_of_day, total, samples FROM `{tier_table(table)}`'
+
+    @staticmethod
+    def fold_query(table, shuttle=False) -> str:
+        """
+        The source rows with ids in a range, summed into rollup buckets. The range is a primary
+        key seek; the bucket columns are computed from the time once per row, in the select list.
+        Takes (last id folded, highest id to fold) as arguments.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        name, value, time = columns(shuttle)
+        return f'''
+            SELECT name, bucket_start, WEEKDAY(bucket_start), HOUR(bucket_start) * 60 + MINUTE(bucket_start),
+                   SUM(value), COUNT(*)
+            FROM (
+                SELECT {name} AS name, {value} AS value,
+                       {time} - INTERVAL ((MINUTE({time}) MOD {BUCKET_MINUTES}) * 60 + SECOND({time})) SECOND AS bucket_start
+                FROM `{table}`
+                WHERE id > %s AND id <= %s
+            ) r
+            GROUP BY name, bucket_start
+        '''
+
+    @staticmethod
+    def average_query(table) -> str:
+        """
+        Per-name sums over a weekday and minute-of-day range of the rollup, a range on its
+        (weekday, minute_of_day) key. Takes (weekday, first minute, end minute) as arguments.
+        :param table: The source table
+        :return:
+        """
+        return f'''
+            SELECT name, SUM(total) AS total, SUM(samples) AS samples
+            FROM `{table}_rollup`
+            WHERE weekday = %s AND minute_of_day >= %s AND minute_of_day < %s
+            GROUP BY name
+            ORDER BY name
+        '''
+
+    @staticmethod
+    def window_query(table) -> str:
+        """
+        Per-name sums for the buckets between two offsets before NOW(), with the window bounds.
+        The join bounds bucket_start with NOW() arithmetic, which is constant for the statement,
+        rather than with the derived row's columns, so it's a range on the bucket_start key
+        however the optimizer handles the derived table.
+        Takes (start minutes, end minutes, start minutes, end minutes) as arguments.
+        :param table: The source table
+        :return:
+        """
+        return f'''
+            SELECT r.name, SUM(r.total) AS total, SUM(r.samples) AS samples, w.window_start, w.window_end
+            FROM (
+                SELECT NOW() - INTERVAL %s MINUTE AS window_start, NOW() - INTERVAL %s MINUTE AS window_end
+            ) w
+            LEFT JOIN `{table}_rollup` r
+              ON r.bucket_start > NOW() - INTERVAL %s MINUTE - INTERVAL {BUCKET_MINUTES} MINUTE
+             AND r.bucket_start < NOW() - INTERVAL %s MINUTE
+            GROUP BY r.name, w.window_start, w.window_end
+            ORDER BY r.name
+        '''
+
+    @newrelic.agent.background_task()
+    async def average_rows(self, table, day, time, shuttle=False) -> list:
+        """
+        Typed per-name averages for a weekday over the hour before a time of day
+        :param table:
+        :param day: The day name, e.g. Monday
+        :param time: A datetime.time, rounded down to the bucket
+        :param shuttle:
+        :return: A list of {'name', 'total', 'samples'} dicts sorted by name
+        """
+        weekday = weekday_index(day)
+        end = time.hour * 60 + time.minute
+        end -= end % BUCKET_MINUTES
+        await self.ensure(table, shuttle=shuttle)
+        return await self.db.fetch_prepared(('rollup_average', table, shuttle), lambda: self.average_query(table),
+                                            (weekday, max(end - 60, 0), end))
+
+    @newrelic.agent.background_task()
+    async def window_rows(self, table, start_minutes, end_minutes, shuttle=False) -> list:
+        """
+        Typed per-name sums for the buckets between two offsets before NOW().
+        The window is computed by the database so it matches the scraper's clock.
+        :param table:
+        :param start_minutes: How many minutes before now the window starts
+        :param end_minutes: How many minutes before now the window ends
+        :param shuttle:
+        :return: A list of {'name', 'total', 'samples', 'window_start', 'window_end'} dicts;
+            a single row with a NULL name when the window is empty
+        """
+        await self.ensure(table, shuttle=shuttle)
+        return await self.db.fetch_prepared(('rollup_window', table, shuttle), lambda: self.window_query(table),
+                                            (start_minutes, end_minutes) * 2)
+
+    @newrelic.agent.background_task()
+    async def average_batch_rows(self, table, pairs, shuttle=False) -> list:
+        """
+        Typed per-name averages for several (day, time) pairs in one grouped pass.
+        The pairs are joined in as a derived table, so each pair's buckets are read once.
+        :param table:
+        :param pairs: A list of (day name, datetime.time) tuples
+        :param shuttle:
+        :return: A list of {'pair', 'name', 'total', 'samples'} dicts, pair being the index into pairs
+        """
+        args = []
+        selects = []
+        for index, (day, time) in enumerate(pairs):
+            weekday = weekday_index(day)
+            end = time.hour * 60 + time.minute
+            end -= end % BUCKET_MINUTES
+            selects.append('SELECT %s AS pair, %s AS weekday, %s AS start_minute, %s AS end_minute')
+            args.extend([index, weekday, max(end - 60, 0), end])
+        await self.ensure(table, shuttle=shuttle)
+        return await self.db.fetch_all(f'''
+            SELECT p.pair, r.name, SUM(r.total) AS total, SUM(r.samples) AS samples
+            FROM ({' UNION ALL '.join(selects)}) p
+            JOIN `{table}_rollup` r
+              ON r.weekday = p.weekday AND r.minute_of_day >= p.start_minute AND r.minute_of_day < p.end_minute
+            GROUP BY p.pair, r.name
+            ORDER BY p.pair, r.name
+        ''', args)
+
+    @staticmethod
+    def render_average(rows, day, time, shuttle=False) -> list:
+        """
+        Format typed averages in the original /average response shape: one row per name,
+        the WITH ROLLUP total row and the 'Data above is...' row.
+        :param rows: {'name', 'total', 'samples'} dicts
+        :param day:
+        :param time:
+        :param shuttle:
+        :return:
+        """
+        key, value, unit, label = ('stop_name', 'average_time_to_departure', ' minutes', 'average time to departure') \
+            if shuttle else ('name', 'fullness', '%', 'average fullness')
+
+        overall = ceil_average(sum(row['total'] for row in rows), sum(row['samples'] for row in rows))
+        overall = f'{overall}{unit}' if overall is not None else None
+        results = [{key: row['name'], value: f"{ceil_average(row['total'], row['samples'])}{unit}"} for row in rows]
+        results.append({key: None, value: overall})
+        results.append({key: f'Data above is {label} for {day} at {time}', value: overall})
+        return results
+
+    @staticmethod
+    def average_columns(rows, key, value) -> dict:
+        """
+        Typed columns of exact averages and sample counts for the binary encodings
+        :param rows: {'name', 'total', 'samples'} dicts
+        :param key: The name column to use
+        :param value: The average column to use
+        :return:
+        """
+        rows = [row for row in rows if row['name'] is not None]
+        return {
+            key: [row['name'] for row in rows],
+            value: [int(row['total']) / int(row['samples']) for row in rows],
+            'samples': [int(row['samples']) for row in rows],
+        }
+
+    async def typed_average(self, table, day, time, shuttle=False) -> tuple:
+        """
+        /average as typed columns
+        :param table:
+        :param day:
+        :param time:
+        :param shuttle:
+        :return: (columns, meta)
+        """
+        rows = await self.average_rows(table, day, time, shuttle=shuttle)
+        key, value = ('stop_name', 'average_time_to_departure') if shuttle else ('name', 'fullness')
+        total, samples = sum(row['total'] for row in rows), sum(row['samples'] for row in rows)
+        meta = {'day': day, 'time': str(time), 'overall': int(total) / int(samples) if samples else None}
+        return self.average_columns(rows, key, value), meta
+
+    async def typed_average_batch(self, table, pairs, shuttle=False) -> tuple:
+        """
+        /average/batch as typed columns, with a day column instead of a dict per day
+        :param table:
+        :param pairs:
+        :param shuttle:
+        :return: (columns, meta)
+        """
+        rows = await self.average_batch_rows(table, pairs, shuttle=shuttle)
+        key, value = ('stop_name', 'average_time_to_departure') if shuttle else ('name', 'fullness')
+        columns = {'day': [pairs[row['pair']][0] for row in rows], 'time': [str(pairs[row['pair']][1]) for row in rows]}
+        columns.update(self.average_columns(rows, key, value))
+        return columns, {}
+
+    async def typed_window(self, table, start_minutes, end_minutes, shuttle=False) -> tuple:
+        """
+        /yesterday or /lastweek as typed columns
+        :param table:
+        :param start_minutes:
+        :param end_minutes:
+        :param shuttle:
+        :return: (columns, meta)
+        """
+        rows = await self.window_rows(table, start_minutes, end_minutes, shuttle=shuttle)
+        key, value = ('stop_name', 'avg_time_to_departure') if shuttle else ('name', 'avg_fullness')
+        meta = {'window_start': rows[0]['window_start'], 'window_end': rows[0]['window_end']}
+        return self.average_columns(rows, key, value), meta
+
+    async def get_average(self, table, day, time, shuttle=False) -> list:
+        """
+        Drop-in for Config.get_average answered from the rollup
+        :param table:
+        :param day:
+        :param time:
+        :param shuttle:
+        :return:
+        """
+        rows = await self.average_rows(table, day, time, shuttle=shuttle)
+        results = self.render_average(rows, day, time, shuttle=shuttle)
+        logger.info(f'Found {len(results)} rollup results for {day} at {time} in {table}')
+        return results
+
+    async def get_average_batch(self, table, pairs, shuttle=False) -> dict:
+        """
+        /average for several (day, time) pairs at once, keyed by day.
+        Each day may only appear once.
+        :param table:
+        :param pairs: A list of (day name, datetime.time) tuples
+        :param shuttle:
+        :return: {day: rows in the /average response shape}
+        """
+        days = [day for day, _ in pairs]
+        if len(set(d.lower() for d in days)) != len(days):
+            raise ValueError(f'Each day can only be requested once: {days}')
+        grouped = [[] for _ in pairs]
+        for row in await self.average_batch_rows(table, pairs, shuttle=shuttle):
+            grouped[row['pair']].append(row)
+        results = {day: self.render_average(rows, day, time, shuttle=shuttle) for (day, time), rows in zip(pairs, grouped)}
+        logger.info(f'Found rollup averages for {len(pairs)} days in {table}')
+        return results
+
+    async def get_window(self, table, start_minutes, end_minutes, shuttle=False) -> list:
+        """
+        Drop-in for Config.get_yesterday / get_last_week answered from the rollup
+        :param table:
+        :param start_minutes:
+        :param end_minutes:
+        :param shuttle:
+        :return:
+        """
+        rows = await self.window_rows(table, start_minutes, end_minutes, shuttle=shuttle)
+        key, value, unit = ('stop_name', 'avg_time_to_departure', ' minutes') if shuttle else ('name', 'avg_fullness', '%')
+        results = [{value: f"{ceil_average(row['total'], row['samples'])}{unit}", key: row['name']}
+                   for row in rows if row['name'] is not None]
+        results.append({value: f"Data above is for {rows[0]['window_start']} to {rows[0]['window_end']}", key: ''})
+        return results
+
+    async def get_yesterday(self, table, shuttle=False) -> list:
+        """
+        Averages for the hour centered on this time yesterday. Used by the /yesterday endpoint.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return await self.get_window(table, *YESTERDAY, shuttle=shuttle)
+
+    async def get_last_week(self, table, shuttle=False) -> list:
+        """
+        Averages for the half hour before this time last week. Used by the /lastweek endpoint.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return await self.get_window(table, *LAST_WEEK, shuttle=shuttle)
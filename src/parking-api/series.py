@@ -0,0 +1,401 @@
+from datetime import datetime, timedelta
+from os import getenv
+import numpy as np
+from api_log import BotLog
+from rollup import Rollup, BUCKET_MINUTES, columns, weekday_index
+from compact import tier_rows
+import newrelic.agent
+
+logger = BotLog('api-series')
+
+# Answer the aggregate endpoints from in-memory arrays instead of the rollup tables
+SERIES_ENGINE = getenv("SERIES_ENGINE", "true").lower() == "true"
+# Source rows pulled from the server-side cursor at a time while loading
+SERIES_CHUNK = 10000
+# Starting size of a name's arrays; they double when full
+INITIAL_CAPACITY = 4096
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+# 1970-01-01 was a Thursday, WEEKDAY() 3
+EPOCH_WEEKDAY = 3
+# Value histograms are kept per rollup-sized bucket of the week, one bin per whole value.
+# Fullness is 0-100 so the histograms are exact; larger values (shuttle ETAs) share the top bin.
+HISTOGRAM_BINS = 101
+BUCKETS_PER_WEEK = MINUTES_PER_WEEK // BUCKET_MINUTES
+
+
+def epoch_seconds(times) -> np.ndarray:
+    """
+    Naive datetimes as int64 seconds since 1970-01-01, in the scraper's local time
+    :param times: A list of datetimes
+    :return:
+    """
+    return np.array(times, dtype='datetime64[s]').astype(np.int64)
+
+
+def minute_of_week(seconds) -> np.ndarray:
+    """
+    WEEKDAY() * 1440 + minute of day for an array of epoch seconds
+    :param seconds:
+    :return:
+    """
+    minutes = seconds // 60
+    weekday = (minutes // MINUTES_PER_DAY + EPOCH_WEEKDAY) % 7
+    return weekday * MINUTES_PER_DAY + minutes % MINUTES_PER_DAY
+
+
+class NameSeries:
+    """
+    Every reading of one garage or stop as parallel arrays of epoch seconds and values.
+    Appends are amortized O(1); the arrays are re-sorted lazily if a late row arrives.
+    """
+    def __init__(self):
+        self.times = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+        self.values = np.empty(INITIAL_CAPACITY, dtype=np.int64)
+        self.length = 0
+        self.ordered = True
+
+    def append(self, times, values):
+        """
+        Add readings to the end of the series
+        :param times: int64 epoch seconds
+        :param values: int64 values
+        :return:
+        """
+        needed = self.length + len(times)
+        if needed > len(self.times):
+            capacity = max(needed, 2 * len(self.times))
+            for attribute in ('times', 'values'):
+                grown = np.empty(capacity, dtype=np.int64)
+                grown[:self.length] = getattr(self, attribute)[:self.length]
+                setattr(self, attribute, grown)
+        if (self.length and times[0] < self.times[self.length - 1]) or np.any(np.diff(times) < 0):
+            self.ordered = False
+        self.times[self.length:needed] = times
+        self.values[self.length:needed] = values
+        self.length = needed
+
+    def sort(self):
+        """
+        Put the readings back in time order after a late row
+        :return:
+        """
+        if not self.ordered:
+            order = np.argsort(self.times[:self.length], kind='stable')
+            self.times[:self.length] = self.times[:self.length][order]
+            self.values[:self.length] = self.values[:self.length][order]
+            self.ordered = True
+
+    def window(self, start, end) -> tuple:
+        """
+        Sum and count of the readings with start <= time < end
+        :param start: Epoch seconds
+        :param end: Epoch seconds
+        :return: (total, samples)
+        """
+        self.sort()
+        low, high = np.searchsorted(self.times[:self.length], [start, end])
+        return int(self.values[low:high].sum()), int(high - low)
+
+    def recent(self, seconds) -> tuple:
+        """
+        The readings from the last `seconds` before the newest one
+        :param seconds:
+        :return: (times, values) views, empty if there are no readings
+        """
+        self.sort()
+        times = self.times[:self.length]
+        if not self.length:
+            return times, self.values[:0]
+        low = np.searchsorted(times, times[-1] - seconds)
+        return times[low:], self.values[low:self.length]
+
+
+class TableSeries:
+    """
+    The series of every name in a table, plus per-name sums and counts for each of the
+    10080 minutes of the week. A weekday/time-of-day average for all names is then one
+    slice and sum over a (names x minutes) matrix. Each name also has a value histogram per
+    5-minute bucket of the week; histograms add, so any range of buckets merges without
+    touching the readings.
+    """
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.series = []
+        self.slot_total = np.zeros((0, MINUTES_PER_WEEK), dtype=np.int64)
+        self.slot_samples = np.zeros((0, MINUTES_PER_WEEK), dtype=np.int64)
+        self.histograms = np.zeros((0, BUCKETS_PER_WEEK, HISTOGRAM_BINS), dtype=np.int32)
+        # Bumped on every append so anything derived from the slots knows to rebuild
+        self.version = 0
+
+    def row(self, name) -> int:
+        """
+        The matrix row of a name, adding one the first time it's seen
+        :param name:
+        :return:
+        """
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            self.series.append(NameSeries())
+            self.slot_total = np.vstack([self.slot_total, np.zeros((1, MINUTES_PER_WEEK), dtype=np.int64)])
+            self.slot_samples = np.vstack([self.slot_samples, np.zeros((1, MINUTES_PER_WEEK), dtype=np.int64)])
+            self.histograms = np.concatenate(
+                [self.histograms, np.zeros((1, BUCKETS_PER_WEEK, HISTOGRAM_BINS), dtype=np.int32)])
+        return self.index[name]
+
+    def extend(self, rows):
+        """
+        Append a chunk of {'name', 'value', 'time'} rows, skipping NULL readings like AVG() does
+        :param rows:
+        :return:
+        """
+        grouped = {}
+        for row in rows:
+            if row['value'] is None or row['time'] is None:
+                continue
+            times, values = grouped.setdefault(row['name'], ([], []))
+            times.append(row['time'])
+            values.append(int(row['value']))
+        for name, (times, values) in grouped.items():
+            row = self.row(name)
+            times = epoch_seconds(times)
+            values = np.array(values, dtype=np.int64)
+            self.series[row].append(times, values)
+            slots = minute_of_week(times)
+            self.slot_total[row] += np.bincount(slots, weights=values, minlength=MINUTES_PER_WEEK).astype(np.int64)
+            self.slot_samples[row] += np.bincount(slots, minlength=MINUTES_PER_WEEK)
+            cells = (slots // BUCKET_MINUTES) * HISTOGRAM_BINS + np.clip(values, 0, HISTOGRAM_BINS - 1)
+            self.histograms[row] += np.bincount(cells, minlength=BUCKETS_PER_WEEK * HISTOGRAM_BINS).reshape(
+                BUCKETS_PER_WEEK, HISTOGRAM_BINS).astype(np.int32)
+        if grouped:
+            self.version += 1
+
+    def extend_aggregates(self, rows):
+        """
+        Add compacted {'name', 'time', 'total', 'samples'} rows to the weekly slots and histograms.
+        They count with their full weight in averages; each lands in the histogram bin of its
+        mean, so distributions over compacted history are approximate. They aren't kept as
+        readings, since windows and trends only look at recent, uncompacted data.
+        :param rows:
+        :return:
+        """
+        grouped = {}
+        for row in rows:
+            times, totals, samples = grouped.setdefault(row['name'], ([], [], []))
+            times.append(row['time'])
+            totals.append(int(row['total']))
+            samples.append(int(row['samples']))
+        for name, (times, totals, samples) in grouped.items():
+            row = self.row(name)
+            slots = minute_of_week(epoch_seconds(times))
+            totals, samples = np.array(totals, dtype=np.int64), np.array(samples, dtype=np.int64)
+            self.slot_total[row] += np.bincount(slots, weights=totals, minlength=MINUTES_PER_WEEK).astype(np.int64)
+            self.slot_samples[row] += np.bincount(slots, weights=samples, minlength=MINUTES_PER_WEEK).astype(np.int64)
+            means = np.clip(np.rint(totals / samples), 0, HISTOGRAM_BINS - 1).astype(np.int64)
+            cells = (slots // BUCKET_MINUTES) * HISTOGRAM_BINS + means
+            self.histograms[row] += np.bincount(cells, weights=samples, minlength=BUCKETS_PER_WEEK * HISTOGRAM_BINS).reshape(
+                BUCKETS_PER_WEEK, HISTOGRAM_BINS).astype(np.int32)
+        if grouped:
+            self.version += 1
+
+    def average(self, weekday, start_minute, end_minute) -> tuple:
+        """
+        Per-name sums and counts for a weekday between two minutes of the day
+        :param weekday: WEEKDAY() value
+        :param start_minute: Inclusive
+        :param end_minute: Exclusive
+        :return: (totals, samples) arrays in the order of self.names
+        """
+        start, end = weekday * MINUTES_PER_DAY + start_minute, weekday * MINUTES_PER_DAY + end_minute
+        return self.slot_total[:, start:end].sum(axis=1), self.slot_samples[:, start:end].sum(axis=1)
+
+    def histogram(self, weekday, start_minute, end_minute) -> np.ndarray:
+        """
+        Per-name value histograms merged over a weekday's buckets between two minutes of the day,
+        rounded down to the bucket
+        :param weekday: WEEKDAY() value
+        :param start_minute: Inclusive
+        :param end_minute: Exclusive
+        :return: (names x HISTOGRAM_BINS) counts in the order of self.names
+        """
+        offset = weekday * MINUTES_PER_DAY
+        start, end = (offset + start_minute) // BUCKET_MINUTES, (offset + end_minute) // BUCKET_MINUTES
+        return self.histograms[:, start:end].sum(axis=1, dtype=np.int64)
+
+
+class SeriesEngine(Rollup):
+    """
+    Answers the same aggregate queries as Rollup from NumPy arrays held in memory.
+    Every row of a table is loaded once, then new rows are appended after each snapshot
+    refresh, so an average or window is a few array slices instead of a database round trip.
+    MariaDB stays the system of record and the rollup tables aren't needed.
+    """
+    def __init__(self, db, snapshots):
+        """
+        :param db: The Storage to query
+        :param snapshots: The SnapshotStore whose refreshes trigger an append
+        """
+        super().__init__(db, snapshots)
+        self.tables = {}
+        # Database NOW() minus this process's clock, so windows match the scraper's timestamps
+        self.clock_offsets = {}
+
+    @newrelic.agent.background_task()
+    async def ensure(self, table, shuttle=False):
+        """
+        Load a table's history into memory on first use
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        if (table, shuttle) in self.ready:
+            return
+        await self.catch_up(table, shuttle=shuttle)
+        self.ready.add((table, shuttle))
+        # The snapshot refresher tells us when new rows land in this table
+        await self.snapshots.get(table, shuttle=shuttle)
+
+    @newrelic.agent.background_task()
+    async def catch_up(self, table, shuttle=False) -> int:
+        """
+        Append every source row newer than the last id loaded. The watermark moves after
+        each chunk, so a load that fails partway resumes without duplicating rows.
+        :param table:
+        :param shuttle:
+        :return: The number of rows appended
+        """
+        name, value, time = columns(shuttle)
+        appended = 0
+        async with self.lock(table):
+            if table not in self.tables:
+                self.tables[table] = await self.load_compacted(table)
+            series = self.tables[table]
+            last_id = self.watermarks.get(table, 0)
+            state = (await self.db.fetch_prepared(('series_max_id', table, shuttle),
+                                                  lambda: f'SELECT COALESCE(MAX(id), 0) AS max_id FROM `{table}`'))[0]
+            self.clock_offsets[table] = await self.db.now() - datetime.now()
+            if state['max_id'] <= last_id:
+                return 0
+
+            def build():
+                return f'''
+                    SELECT id, {name} AS name, {value} AS value, {time} AS time
+                    FROM `{table}`
+                    WHERE id > %s AND id <= %s
+                    ORDER BY id
+                '''
+
+            args = (last_id, state['max_id'])
+            if state['max_id'] - last_id <= SERIES_CHUNK:
+                # The refresh after each scrape: a few rows, through the prepared statement
+                rows = await self.db.fetch_prepared(('series_rows', table, shuttle), build, args)
+                series.extend(rows)
+                appended += len(rows)
+            else:
+                async for rows in self.db.stream_chunks(build(), args, chunk=SERIES_CHUNK):
+                    series.extend(rows)
+                    appended += len(rows)
+                    self.watermarks[table] = rows[-1]['id']
+            self.watermarks[table] = state['max_id']
+        if appended:
+            logger.info(f'Loaded {appended} rows of {table} into memory through id {state["max_id"]}')
+        return appended
+
+    async def load_compacted(self, table) -> TableSeries:
+        """
+        A new TableSeries holding the readings compaction has moved out of the source table.
+        Only MariaDB has the compacted tier; a replica copies the raw rows it saw.
+        Called under the table lock, before any raw rows are loaded.
+        :param table:
+        :return:
+        """
+        series = TableSeries()
+        if self.db.dialect != 'mariadb':
+            return series
+        loaded = 0
+        async for rows in tier_rows(self.db, table):
+            series.extend_aggregates(rows)
+            loaded += len(rows)
+        if loaded:
+            logger.info(f'Loaded {loaded} compacted rows of {table} into memory')
+        return series
+
+    def now(self, table) -> datetime:
+        """
+        The database's NOW() for a table, to the second
+        :param table:
+        :return:
+        """
+        return (datetime.now() + self.clock_offsets.get(table, timedelta())).replace(microsecond=0)
+
+    @newrelic.agent.background_task()
+    async def average_rows(self, table, day, time, shuttle=False) -> list:
+        """
+        Typed per-name averages for a weekday over the hour before a time of day
+        :param table:
+        :param day: The day name, e.g. Monday
+        :param time: A datetime.time
+        :param shuttle:
+        :return: A list of {'name', 'total', 'samples'} dicts sorted by name
+        """
+        weekday = weekday_index(day)
+        await self.ensure(table, shuttle=shuttle)
+        return self.average_pair(self.tables[table], weekday, time)
+
+    @staticmethod
+    def average_pair(series, weekday, time) -> list:
+        """
+        The rows of one (weekday, time) average from a loaded table
+        :param series: The TableSeries
+        :param weekday:
+        :param time:
+        :return:
+        """
+        end = time.hour * 60 + time.minute
+        totals, samples = series.average(weekday, max(end - 60, 0), end)
+        return [{'name': name, 'total': int(totals[row]), 'samples': int(samples[row])}
+                for name, row in sorted(series.index.items()) if samples[row]]
+
+    @newrelic.agent.background_task()
+    async def window_rows(self, table, start_minutes, end_minutes, shuttle=False) -> list:
+        """
+        Typed per-name sums for the readings between two offsets before the database's NOW()
+        :param table:
+        :param start_minutes: How many minutes before now the window starts
+        :param end_minutes: How many minutes before now the window ends
+        :param shuttle:
+        :return: A list of {'name', 'total', 'samples', 'window_start', 'window_end'} dicts;
+            a single row with a None name when the window is empty
+        """
+        await self.ensure(table, shuttle=shuttle)
+        series = self.tables[table]
+        now = self.now(table)
+        window_start, window_end = now - timedelta(minutes=start_minutes), now - timedelta(minutes=end_minutes)
+        start, end = epoch_seconds([window_start, window_end])
+        rows = []
+        for name, row in sorted(series.index.items()):
+            total, samples = series.series[row].window(start, end)
+            if samples:
+                rows.append({'name': name, 'total': total, 'samples': samples,
+                             'window_start': window_start, 'window_end': window_end})
+        return rows or [{'name': None, 'total': None, 'samples': None,
+                         'window_start': window_start, 'window_end': window_end}]
+
+    @newrelic.agent.background_task()
+    async def average_batch_rows(self, table, pairs, shuttle=False) -> list:
+        """
+        Typed per-name averages for several (day, time) pairs
+        :param table:
+        :param pairs: A list of (day name, datetime.time) tuples
+        :param shuttle:
+        :return: A list of {'pair', 'name', 'total', 'samples'} dicts, pair being the index into pairs
+        """
+        weekdays = [weekday_index(day) for day, _ in pairs]
+        await self.ensure(table, shuttle=shuttle)
+        series = self.tables[table]
+        rows = []
+        for index, (weekday, (_, time)) in enumerate(zip(weekdays, pairs)):
+            rows.extend(dict(row, pair=index) for row in self.average_pair(series, weekday, time))
+        return rows
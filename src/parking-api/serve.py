@@ -0,0 +1,196 @@
+import asyncio
+import os
+import shutil
+import signal
+import tempfile
+import threading
+from multiprocessing import get_context
+from os import getenv
+from time import monotonic
+from api_log import BotLog
+from export import EXPORT_CONCURRENCY
+from shared import SharedState, Publisher, SHARED_POLL_INTERVAL, WORKER_POOL_SIZE
+
+logger = BotLog('api-serve')
+
+# Worker processes accepting requests on PORT; 1 runs api.py's single process instead.
+# Each one opens its own database pool, so this is a small fixed number rather than the core count.
+WORKERS = int(getenv("WORKERS", 2))
+PORT = int(getenv("PORT", 8080))
+# Seconds before restarting a refresher that exited, doubling up to the maximum while it keeps failing
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+
+async def heartbeat(shared):
+    """
+    Tell the workers the refresher is alive, from its start, since loading history takes a while
+    :param shared: The SharedState
+    :return:
+    """
+    while True:
+        shared.beat()
+        await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+
+async def refresh(name):
+    """
+    The refresher: the only process that loads history and refreshes snapshots from the
+    database. It publishes them to the shared segment after every refresh.
+    :param name: The segment's name
+    :return:
+    """
+    from campuses import registry
+    from services import build
+    from coalesce import SingleFlight
+    from result_cache import ResultCache
+    from metrics import flush
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    shared = SharedState.attach(name)
+    beating = asyncio.create_task(heartbeat(shared))
+    # Nothing is served from here, so nothing is cached
+    databases, services = build(registry, SingleFlight(), ResultCache(size=0))
+    # Its queries and pools show up in the workers' /metrics
+    flushing = asyncio.create_task(flush(databases.values()))
+    try:
+        for db in databases.values():
+            await db.retry_connection()
+        for site in services.values():
+            site.start()
+            await site.analytics.preload(site.campus.tables)
+        await Publisher(shared, services).run()
+    finally:
+        beating.cancel()
+        flushing.cancel()
+        await asyncio.gather(flushing, return_exceptions=True)
+        for site in services.values():
+            await site.stop()
+        for db in databases.values():
+            await db.close()
+        shared.close()
+
+
+def refresher(name):
+    """
+    Process entry point for refresh()
+    :param name:
+    :return:
+    """
+    # Ctrl-C goes to the whole group; the server stops this process with SIGTERM when it's done
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(refresh(name))
+    except asyncio.CancelledError:
+        pass
+
+
+class Supervisor:
+    """
+    Keeps one refresher process running: a thread waits on it and starts a new one whenever
+    it exits, after a delay that grows while it keeps failing. Meanwhile the workers keep
+    serving the last published state and report it as stale.
+    """
+    def __init__(self, name):
+        """
+        :param name: The segment's name
+        """
+        self.name = name
+        self.process = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def spawn(self) -> bool:
+        """
+        Start a refresher, unless stop() has begun
+        :return: Whether one started
+        """
+        with self.lock:
+            if self.stopping.is_set():
+                return False
+            self.process = get_context('spawn').Process(target=refresher, args=(self.name,),
+                                                        name='parking-api-refresher', daemon=True)
+            self.process.start()
+        logger.info(f'Started the refresher in process {self.process.pid}')
+        return True
+
+    def run(self):
+        """
+        Thread body: restart the refresher until stop()
+        :return:
+        """
+        delay = RESTART_DELAY
+        while not self.stopping.is_set():
+            started = monotonic()
+            if not self.spawn():
+                break
+            self.process.join()
+            if self.stopping.is_set():
+                break
+            # One that ran a good while failed for a new reason, so start over from the short delay
+            if monotonic() - started > MAX_RESTART_DELAY:
+                delay = RESTART_DELAY
+            logger.error(f'The refresher exited with code {self.process.exitcode}; restarting it in {delay}s')
+            self.stopping.wait(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='parking-api-supervisor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the refresher for good
+        :return:
+        """
+        with self.lock:
+            self.stopping.set()
+            process = self.process
+        if process is not None:
+            process.terminate()
+            process.join(timeout=10)
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+
+
+def main():
+    """
+    Serve api:app from WORKERS processes on PORT, with one refresher feeding them all
+    :return:
+    """
+    if WORKERS <= 1:
+        from api import app
+        app.run(host='0.0.0.0', port=PORT)
+        return
+    from hypercorn.config import Config
+    from hypercorn.run import run
+    name = f'parking-api-{os.getpid()}'
+    shared = SharedState.create(name)
+    # The workers are spawned by hypercorn and read the name, their count and where to share
+    # their metrics from the environment
+    os.environ['SHARED_STATE'] = name
+    os.environ['SERVE_WORKERS'] = str(WORKERS)
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix=f'{name}-metrics-')
+    if EXPORT_CONCURRENCY < WORKERS:
+        logger.warning(f'EXPORT_CONCURRENCY {EXPORT_CONCURRENCY} is below WORKERS {WORKERS}; '
+                       f'every worker still streams one export, so up to {WORKERS} can run at once')
+    if EXPORT_CONCURRENCY // WORKERS >= WORKER_POOL_SIZE:
+        logger.warning(f'Each worker may stream {EXPORT_CONCURRENCY // WORKERS} exports on its {WORKER_POOL_SIZE} '
+                       f'connections (WORKER_POOL_SIZE), leaving none for /query and /health; raise it')
+    supervisor = Supervisor(name)
+    supervisor.start()
+    config = Config()
+    config.application_path = 'api:app'
+    config.bind = [f'0.0.0.0:{PORT}']
+    config.workers = WORKERS
+    logger.info(f'Serving on port {PORT} from {WORKERS} workers')
+    try:
+        run(config)
+    finally:
+        supervisor.stop()
+        shared.unlink()
+        shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
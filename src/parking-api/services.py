@@ -0,0 +1,97 @@
+from api_log import BotLog
+from storage import make_storage
+from snapshot import SnapshotStore
+from rollup import Rollup
+from series import SeriesEngine, SERIES_ENGINE
+from forecast import Forecaster
+from distribution import Distributions
+from compact import Compactor
+from export import Exporter
+from asof import AsOf
+from downsample import Downsampler
+from events import Broadcaster
+from shared import SharedSnapshots, SharedEngine, WORKER_POOL_SIZE
+
+logger = BotLog('api-services')
+
+
+class CampusServices:
+    """
+    Everything the API keeps for one campus: its latest snapshots, aggregate engine,
+    forecaster, distributions, compactor and subscribers. Campuses never share these, so one
+    campus' history never sits in another's arrays or invalidates its caches; they only share
+    a Storage when they live in the same database.
+    """
+    def __init__(self, campus, db, flights, results, shared=None):
+        """
+        :param campus: The Campus from the registry
+        :param db: The Storage holding the campus' tables
+        :param flights: The SingleFlight shared by every campus; keys include the table
+        :param results: The ResultCache shared by every campus; keys include the table
+        :param shared: The SharedState a serve.py worker reads its snapshots and history from
+        """
+        self.campus = campus
+        self.db = db
+        self.shared = shared
+        if shared:
+            # The refresher process loads and catches up; this worker only reads what it publishes
+            self.snapshots = SharedSnapshots(shared, campus.tables)
+            self.analytics = SharedEngine(db, self.snapshots)
+            in_memory = True
+        else:
+            self.snapshots = SnapshotStore(db, flights)
+            # The aggregate endpoints read in-memory arrays, or the rollup tables when SERIES_ENGINE is off.
+            # The rollup tables are MariaDB only, so other backends always keep the history in memory.
+            in_memory = SERIES_ENGINE or db.dialect != 'mariadb'
+            self.analytics = SeriesEngine(db, self.snapshots) if in_memory else Rollup(db, self.snapshots)
+        # Forecasts and distributions need the history in memory
+        self.forecaster = Forecaster(self.analytics) if in_memory else None
+        self.distributions = Distributions(self.analytics) if in_memory else None
+        # Rolls readings older than RETENTION_DAYS into 15-minute aggregates when COMPACT_INTERVAL is set
+        self.compactor = Compactor(db, self.analytics, campus.tables)
+        self.exporter = Exporter(db)
+        self.asof = AsOf(db, self.snapshots)
+        self.downsampler = Downsampler(db)
+        self.broadcaster = Broadcaster(self.snapshots)
+        # Push changes to subscribers before the slower aggregate catch up
+        self.snapshots.add_listener(self.broadcaster.on_update)
+        self.snapshots.add_listener(self.analytics.on_update)
+        # Cached results go once the rows they miss are folded in
+        self.snapshots.add_listener(results.on_update)
+
+    def start(self):
+        """
+        Start the background refreshers once the campus' database is connected
+        :return:
+        """
+        self.snapshots.start()
+        # Only the refresher compacts, so the workers don't race it
+        if not self.shared:
+            self.compactor.start()
+
+    async def stop(self):
+        """
+        Stop the background refreshers
+        :return:
+        """
+        await self.snapshots.stop()
+        await self.compactor.stop()
+
+
+def build(registry, flights, results, shared=None) -> tuple:
+    """
+    One Storage per distinct database and one CampusServices per campus
+    :param registry:
+    :param flights:
+    :param results:
+    :param shared: The SharedState, in a serve.py worker
+    :return: ({database key: Storage}, {campus key: CampusServices})
+    """
+    databases = {}
+    services = {}
+    for key, campus in registry.campuses.items():
+        if campus.database_key not in databases:
+            databases[campus.database_key] = make_storage(campus.database, pool_size=WORKER_POOL_SIZE if shared else None)
+        services[key] = CampusServices(campus, databases[campus.database_key], flights, results, shared=shared)
+    logger.info(f'Serving {len(services)} campuses from {len(databases)} databases')
+    return databases, services
@@ -0,0 +1,565 @@
+import asyncio
+import io
+import pickle
+import struct
+from datetime import datetime
+from multiprocessing import shared_memory
+from os import getenv
+from time import monotonic, time
+import numpy as np
+from api_log import BotLog
+from rollup import LAST_WEEK
+from series import SeriesEngine, TableSeries, NameSeries, epoch_seconds
+from snapshot import LatestSnapshot, SNAPSHOT_INTERVAL
+from forecast import TREND_MINUTES
+
+logger = BotLog('api-shared')
+
+# Name of the segment a worker reads its state from; set by serve.py, unset in single-process mode
+SHARED_STATE = getenv("SHARED_STATE")
+# Size of the segment; it holds two copies of the state, with the arrays uncompressed
+SHARED_STATE_MB = int(getenv("SHARED_STATE_MB", 64))
+# Seconds between a worker's checks for a newer state, and the refresher's for refresh requests
+SHARED_POLL_INTERVAL = float(getenv("SHARED_POLL_INTERVAL", 1))
+# Seconds a replaced state's slot is left alone before it's rewritten, so every worker has moved
+# its views over to the newer state by then
+SHARED_SLOT_HOLD = float(getenv("SHARED_SLOT_HOLD", 5 * SHARED_POLL_INTERVAL))
+# Database connections each worker's pool may open, instead of DB_POOL_SIZE. Workers only query
+# for /query, /export and /health; the refresher, which keeps DB_POOL_SIZE, does the rest.
+WORKER_POOL_SIZE = int(getenv("WORKER_POOL_SIZE", 3))
+# Readings younger than this are copied to the workers: enough for /lastweek's window and the forecast trend
+HISTORY_MINUTES = max(LAST_WEEK[0], TREND_MINUTES) + 60
+# Seconds without a heartbeat from the refresher after which workers report their state as stale
+SHARED_STALE_SECONDS = float(getenv("SHARED_STALE_SECONDS", 3 * SNAPSHOT_INTERVAL))
+# generation, refresh requests, a sequence number and a length per slot, then the refresher's last heartbeat
+HEADER = struct.Struct('<7Q')
+HEADER_SIZE = 64
+# Arrays start on cache line boundaries within a slot
+ALIGNMENT = 64
+
+
+class NotPublished(LookupError):
+    """
+    Raised by a worker asked for a table the refresher hasn't published yet, e.g. while it
+    loads history after a start
+    """
+
+
+class SlotWriter(pickle.Pickler):
+    """
+    Pickles a state into a slot: every NumPy array is copied raw into the slot, front to back,
+    and the pickle only records where it went. The pickle itself goes at the end of the slot.
+    """
+    def __init__(self, file, buffer, start, size):
+        """
+        :param file: Where the pickle goes
+        :param buffer: The segment's buffer
+        :param start: The slot's offset in the buffer
+        :param size: The slot's size
+        """
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffer = buffer
+        self.start = start
+        self.size = size
+        self.used = 0
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject:
+            return None
+        offset = -(-self.used // ALIGNMENT) * ALIGNMENT
+        if offset + obj.nbytes > self.size:
+            raise ValueError(f'State arrays need more than the {self.size} byte slots; raise SHARED_STATE_MB')
+        np.ndarray(obj.shape, dtype=obj.dtype, buffer=self.buffer, offset=self.start + offset)[...] = obj
+        self.used = offset + obj.nbytes
+        return offset, obj.dtype.str, obj.shape
+
+
+class SlotReader(pickle.Unpickler):
+    """
+    Unpickles a state from a slot, mapping its arrays as read-only views of the segment
+    """
+    def __init__(self, file, buffer, start):
+        """
+        :param file: The pickle
+        :param buffer: The segment's buffer
+        :param start: The slot's offset in the buffer
+        """
+        super().__init__(file)
+        self.buffer = buffer
+        self.start = start
+
+    def persistent_load(self, pid):
+        offset, dtype, shape = pid
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.buffer, offset=self.start + offset)
+        array.flags.writeable = False
+        return array
+
+
+class SharedState:
+    """
+    A shared memory segment holding the latest published state, with two slots so the
+    refresher writes one while workers read the other. The slot of generation g is g % 2.
+    Each slot has a sequence number that is odd while it's being written, so a reader that
+    raced a write (the refresher publishing twice during one read) sees it change and retries.
+    The state's arrays stay in the segment: every worker maps the same pages instead of
+    unpacking a copy, and only the small pickle around them is read. A worker's views of a
+    state are valid until its slot is rewritten, which the Publisher holds off for
+    SHARED_SLOT_HOLD after the next publish.
+    """
+    def __init__(self, segment):
+        """
+        :param segment: The SharedMemory
+        """
+        self.segment = segment
+        self.slot_size = (segment.size - HEADER_SIZE) // 2
+        # The last state read, by generation, so each process only unpacks a state once
+        self.generation = 0
+        self.state = None
+
+    @classmethod
+    def create(cls, name, size_mb=SHARED_STATE_MB):
+        """
+        Create the segment; done once, by serve.py
+        :param name:
+        :param size_mb:
+        :return:
+        """
+        segment = shared_memory.SharedMemory(name=name, create=True, size=size_mb * 1024 * 1024)
+        segment.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        shared = cls(segment)
+        # A refresher that never starts goes stale like one that stopped
+        shared.beat()
+        return shared
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Open the segment serve.py created
+        :param name:
+        :return:
+        """
+        # The refresher and the workers are spawned by serve.py and share its resource tracker,
+        # so the segment stays until serve.py exits however the others come and go
+        return cls(shared_memory.SharedMemory(name=name))
+
+    def header(self) -> list:
+        """
+        :return: [generation, refresh requests, sequence 0, sequence 1, length 0, length 1, heartbeat]
+        """
+        return list(HEADER.unpack_from(self.segment.buf, 0))
+
+    def set(self, index, value):
+        """
+        Write one header field
+        :param index:
+        :param value:
+        :return:
+        """
+        struct.pack_into('<Q', self.segment.buf, index * 8, value)
+
+    def write(self, state) -> int:
+        """
+        Publish a new state into the slot readers aren't using
+        :param state: Anything picklable; its NumPy arrays are stored raw
+        :return: The new generation
+        """
+        generation = self.header()[0] + 1
+        slot = generation % 2
+        sequence = self.header()[2 + slot]
+        start = HEADER_SIZE + slot * self.slot_size
+        end = start + self.slot_size
+        self.set(2 + slot, sequence + 1)
+        try:
+            file = io.BytesIO()
+            writer = SlotWriter(file, self.segment.buf, start, self.slot_size)
+            writer.dump(state)
+            payload = file.getvalue()
+            if writer.used + len(payload) > self.slot_size:
+                raise ValueError(f'State is {writer.used + len(payload)} bytes but slots are {self.slot_size}; '
+                                 f'raise SHARED_STATE_MB')
+            self.segment.buf[end - len(payload):end] = payload
+            self.set(4 + slot, len(payload))
+        finally:
+            # A failed write leaves the generation, and so what readers read, where it was
+            self.set(2 + slot, sequence + 2)
+        self.set(0, generation)
+        return generation
+
+    def read(self):
+        """
+        The newest published state, unpickled only when the generation has moved; its arrays
+        are read-only views of the slot
+        :return: The state, or None before the first publish
+        """
+        for _ in range(10):
+            header = self.header()
+            generation = header[0]
+            if generation == self.generation or not generation:
+                return self.state
+            slot = generation % 2
+            sequence, length = header[2 + slot], header[4 + slot]
+            if sequence % 2:
+                continue
+            start = HEADER_SIZE + slot * self.slot_size
+            end = start + self.slot_size
+            state = SlotReader(io.BytesIO(self.segment.buf[end - length:end]), self.segment.buf, start).load()
+            if self.header()[2 + slot] != sequence:
+                continue
+            self.state = state
+            self.generation = generation
+            return self.state
+        logger.warning('Could not read a consistent shared state; keeping the previous one')
+        return self.state
+
+    def request_refresh(self):
+        """
+        Ask the refresher to refresh now, like a push to /refresh in single-process mode
+        :return:
+        """
+        self.set(1, self.header()[1] + 1)
+
+    def beat(self):
+        """
+        Note that the refresher is alive
+        :return:
+        """
+        self.set(6, int(time()))
+
+    def silence(self) -> float:
+        """
+        :return: Seconds since the refresher's last heartbeat
+        """
+        return max(time() - self.header()[6], 0)
+
+    def stale(self) -> bool:
+        """
+        Whether the refresher has stopped; the state is then no longer refreshed
+        :return:
+        """
+        return self.silence() > SHARED_STALE_SECONDS
+
+    def stats(self) -> dict:
+        """
+        Which state this process serves and how old it is, for /health
+        :return:
+        """
+        published_at = self.state['published_at'] if self.state else None
+        return {
+            'generation': self.generation,
+            'published': self.header()[0],
+            'age_seconds': round((datetime.now() - published_at).total_seconds(), 1) if published_at else None,
+            'heartbeat_seconds': round(self.silence(), 1),
+            'stale': self.stale(),
+            # Nothing can be served before the refresher's first publish
+            'ready': self.header()[0] > 0,
+        }
+
+    def close(self):
+        self.state = None
+        try:
+            self.segment.close()
+        except BufferError:
+            # Mounted tables still map it; the mapping goes when the process exits
+            pass
+
+    def unlink(self):
+        self.segment.close()
+        self.segment.unlink()
+
+
+def replica(series, now) -> dict:
+    """
+    What the workers need of a TableSeries: the weekly sums and histograms, and the readings
+    of the last HISTORY_MINUTES for windows and trends (at least the newest one of each name).
+    The arrays are views of the live series, so it has to be written out before anything appends.
+    :param series:
+    :param now: The database's clock, as epoch seconds
+    :return:
+    """
+    recent = []
+    for name_series in series.series:
+        name_series.sort()
+        times, values = name_series.times[:name_series.length], name_series.values[:name_series.length]
+        low = min(np.searchsorted(times, now - HISTORY_MINUTES * 60), max(len(times) - 1, 0))
+        recent.append((times[low:], values[low:]))
+    return {
+        'names': list(series.names),
+        'slot_total': series.slot_total,
+        'slot_samples': series.slot_samples,
+        'histograms': series.histograms,
+        'recent': recent,
+        'version': series.version,
+    }
+
+
+def mount(published) -> TableSeries:
+    """
+    A read-only TableSeries over a published replica, sharing its arrays
+    :param published:
+    :return:
+    """
+    series = TableSeries()
+    series.names = published['names']
+    series.index = {name: row for row, name in enumerate(series.names)}
+    series.slot_total = published['slot_total']
+    series.slot_samples = published['slot_samples']
+    series.histograms = published['histograms']
+    series.version = published['version']
+    for times, values in published['recent']:
+        name_series = NameSeries()
+        # Sorted by replica()
+        name_series.times, name_series.values, name_series.length = times, values, len(times)
+        series.series.append(name_series)
+    return series
+
+
+class Publisher:
+    """
+    Runs in the refresher process: after every snapshot refresh (and the aggregate catch up
+    behind it) it writes every campus' latest snapshots and series replicas to the segment,
+    and it passes the workers' refresh requests on to the snapshot refreshers.
+    """
+    def __init__(self, shared, services):
+        """
+        :param shared: The SharedState
+        :param services: {campus key: CampusServices}, every one with a SeriesEngine
+        """
+        for site in services.values():
+            if not isinstance(site.analytics, SeriesEngine):
+                raise ValueError('Serving from workers needs the in-memory series engine (SERIES_ENGINE=true)')
+        self.shared = shared
+        self.services = services
+        self.changed = asyncio.Event()
+        self.published = float('-inf')
+        for site in services.values():
+            # Registered last, so the aggregates have caught up by the time it runs
+            site.snapshots.add_listener(self.on_update)
+
+    async def on_update(self, updates):
+        """
+        SnapshotStore listener: publish soon
+        :param updates:
+        :return:
+        """
+        self.changed.set()
+
+    def state(self) -> dict:
+        """
+        Everything the workers serve from
+        :return: {'published_at', 'tables': {table: {...}}}
+        """
+        tables = {}
+        for site in self.services.values():
+            engine = site.analytics
+            for table, shuttle in site.campus.tables.items():
+                snapshot = site.snapshots.snapshots.get((table, shuttle))
+                series = engine.tables.get(table)
+                if snapshot is None or series is None or (table, shuttle) not in engine.ready:
+                    continue
+                now = epoch_seconds([engine.now(table)])[0]
+                tables[table] = {
+                    'shuttle': shuttle,
+                    'latest': snapshot.rows(),
+                    'last_seen': snapshot.last_seen,
+                    'watermark': engine.watermarks.get(table),
+                    'clock_offset': engine.clock_offsets.get(table),
+                    'series': replica(series, now),
+                }
+        return {'published_at': datetime.now(), 'tables': tables}
+
+    def publish(self):
+        """
+        Write the current state
+        :return:
+        """
+        started = monotonic()
+        state = self.state()
+        generation = self.shared.write(state)
+        self.published = monotonic()
+        logger.info(f'Published {len(state["tables"])} tables as generation {generation} '
+                    f'in {(monotonic() - started) * 1000:.0f}ms')
+
+    async def run(self):
+        """
+        Publish whenever a snapshot changed, and forward refresh requests, until cancelled
+        :return:
+        """
+        requests = self.shared.header()[1]
+        self.publish()
+        while True:
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=SHARED_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if self.shared.header()[1] != requests:
+                requests = self.shared.header()[1]
+                for site in self.services.values():
+                    site.snapshots.invalidate()
+            if self.changed.is_set():
+                # This publish rewrites the slot workers mapped until the previous one
+                hold = self.published + SHARED_SLOT_HOLD - monotonic()
+                if hold > 0:
+                    await asyncio.sleep(min(hold, SHARED_POLL_INTERVAL))
+                    continue
+                self.changed.clear()
+                try:
+                    self.publish()
+                except Exception as e:
+                    logger.error(f'Could not publish the shared state: {e}')
+
+
+class SharedSnapshots:
+    """
+    A worker's stand-in for SnapshotStore: the latest snapshots come from the shared state
+    instead of the database. A background loop checks for a newer state every
+    SHARED_POLL_INTERVAL seconds and hands the changed readings to the listeners (the
+    broadcaster and the result cache), like a refresh would.
+    """
+    def __init__(self, shared, tables):
+        """
+        :param shared: The SharedState
+        :param tables: {table: shuttle} of the campus
+        """
+        self.shared = shared
+        self.tables = tables
+        self.snapshots = {}
+        self.generation = 0
+        self.listeners = []
+        self.task = None
+
+    def load(self) -> list:
+        """
+        Rebuild the snapshots from the newest state if it moved on
+        :return: (snapshot, changed rows) pairs, like SnapshotStore.refresh_all
+        """
+        state = self.shared.read()
+        if state is None or self.shared.generation == self.generation:
+            return []
+        self.generation = self.shared.generation
+        updates = []
+        for table, shuttle in self.tables.items():
+            published = state['tables'].get(table)
+            if published is None:
+                continue
+            snapshot = LatestSnapshot(None, table, shuttle=shuttle)
+            snapshot.latest = {row['name']: row for row in published['latest']}
+            snapshot.last_seen = published['last_seen']
+            snapshot.refreshed_at = monotonic()
+            previous = self.snapshots.get((table, shuttle))
+            changed = [row for name, row in snapshot.latest.items()
+                       if previous is None or previous.latest.get(name) != row]
+            self.snapshots[(table, shuttle)] = snapshot
+            if previous is not None and changed:
+                updates.append((snapshot, changed))
+        return updates
+
+    async def get(self, table, shuttle=False) -> LatestSnapshot:
+        """
+        The published snapshot of a table
+        :param table:
+        :param shuttle:
+        :return:
+        :raises NotPublished: Before the refresher has published the table
+        """
+        if (table, shuttle) not in self.snapshots:
+            self.load()
+        snapshot = self.snapshots.get((table, shuttle))
+        if snapshot is None:
+            raise NotPublished(f'{table} has not been published yet')
+        return snapshot
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def invalidate(self):
+        """
+        Pass a /refresh push on to the refresher
+        :return:
+        """
+        self.shared.request_refresh()
+
+    async def run(self):
+        """
+        Background loop: pick up new states and notify the listeners
+        :return:
+        """
+        while True:
+            try:
+                updates = self.load()
+            except Exception as e:
+                logger.error(f'Could not read the shared state: {e}')
+                updates = []
+            for listener in self.listeners if updates else []:
+                try:
+                    await listener(updates)
+                except Exception as e:
+                    logger.error(f'Snapshot listener {listener.__qualname__} failed: {e}')
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+
+class SharedEngine(SeriesEngine):
+    """
+    A worker's SeriesEngine: the history isn't loaded from the database but mounted from the
+    replicas the refresher publishes, so averages, windows, forecasts and distributions work
+    the same without every worker holding and catching up its own copy.
+    """
+    def __init__(self, db, snapshots):
+        """
+        :param db: The Storage; not queried for history
+        :param snapshots: The campus' SharedSnapshots
+        """
+        super().__init__(db, snapshots)
+        self.mounted = {}
+
+    async def ensure(self, table, shuttle=False):
+        """
+        Mount the newest published replica of a table
+        :param table:
+        :param shuttle:
+        :return:
+        :raises NotPublished: Before the refresher has published the table
+        """
+        await self.snapshots.get(table, shuttle=shuttle)
+        state = self.snapshots.shared.state
+        published = state['tables'].get(table) if state else None
+        if published is None:
+            raise NotPublished(f'{table} has not been published yet')
+        if self.mounted.get(table) != self.snapshots.shared.generation:
+            self.tables[table] = mount(published['series'])
+            self.watermarks[table] = published['watermark']
+            if published['clock_offset'] is not None:
+                self.clock_offsets[table] = published['clock_offset']
+            self.mounted[table] = self.snapshots.shared.generation
+        self.ready.add((table, shuttle))
+
+    async def catch_up(self, table, shuttle=False) -> int:
+        """
+        Nothing to load; the refresher catches up
+        :return:
+        """
+        return 0
+
+    async def preload(self, tables):
+        """
+        Mounted on first use instead
+        :param tables:
+        :return:
+        """
+
+    async def on_update(self, updates):
+        """
+        SharedSnapshots listener: mount the new replicas now so ETags move with the data
+        :param updates:
+        :return:
+        """
+        for snapshot, _ in updates:
+            if (snapshot.table, snapshot.shuttle) in self.ready:
+                await self.ensure(snapshot.table, shuttle=snapshot.shuttle)
@@ -0,0 +1,231 @@
+import asyncio
+from os import getenv
+from time import monotonic
+from api_log import BotLog
+from coalesce import SingleFlight
+from metrics import cache_lookup
+import newrelic.agent
+
+logger = BotLog('api-snapshot')
+
+# Seconds between background refreshes when the scraper doesn't push a refresh
+SNAPSHOT_INTERVAL = int(getenv("SNAPSHOT_INTERVAL", 15))
+
+
+class LatestSnapshot:
+    """
+    In-memory copy of the latest reading for every garage (or shuttle stop) in a table.
+    Refreshed incrementally from the rows newer than the last timestamp it has seen,
+    so serving /latest never touches the database.
+    """
+    def __init__(self, db, table, shuttle=False):
+        """
+        :param db: The Storage to query
+        :param table: The table to mirror
+        :param shuttle: Whether the table holds shuttle data
+        """
+        self.db = db
+        self.table = table
+        self.shuttle = shuttle
+        self.key = 'stop_name' if shuttle else 'name'
+        self.value = 'time_to_departure' if shuttle else 'fullness'
+        # name -> {'name': str, 'value': int, 'time': datetime}
+        self.latest = {}
+        self.last_seen = None
+        self.refreshed_at = None
+        self.lock = asyncio.Lock()
+
+    def is_stale(self) -> bool:
+        """
+        Whether the snapshot has missed its background refresh (or was never loaded)
+        :return:
+        """
+        return self.refreshed_at is None or monotonic() - self.refreshed_at > SNAPSHOT_INTERVAL * 2
+
+    @newrelic.agent.background_task()
+    async def refresh(self) -> list:
+        """
+        Load the first snapshot, or fold in the rows newer than the last seen timestamp.
+        Rows at exactly the last seen timestamp are read again so a scrape that was only
+        partly committed at the previous refresh isn't missed; re-applying them is harmless.
+        :return: The readings that changed since the previous refresh
+        """
+        async with self.lock:
+            if self.last_seen is None:
+                rows = await self.db.get_latest_rows(self.table, shuttle=self.shuttle)
+            else:
+                rows = await self.db.get_newer_rows(self.table, self.last_seen, shuttle=self.shuttle)
+            self.refreshed_at = monotonic()
+
+            changed = []
+            for row in rows:
+                current = self.latest.get(row['name'])
+                if current and current['time'] > row['time']:
+                    continue
+                if not current or current['value'] != row['value'] or current['time'] != row['time']:
+                    self.latest[row['name']] = row
+                    changed.append(row)
+                if self.last_seen is None or row['time'] > self.last_seen:
+                    self.last_seen = row['time']
+
+            if changed:
+                logger.info(f'Snapshot of {self.table} updated {len(changed)} entries through {self.last_seen}')
+            return changed
+
+    def rows(self) -> list:
+        """
+        The latest typed reading for every name, sorted by name
+        :return:
+        """
+        return [self.latest[name] for name in sorted(self.latest)]
+
+    def columns(self) -> tuple:
+        """
+        The snapshot as typed columns for the binary encodings
+        :return: (columns, meta)
+        """
+        rows = self.rows()
+        columns = {
+            self.key: [row['name'] for row in rows],
+            self.value: [row['value'] for row in rows],
+            'time': [row['time'] for row in rows],
+        }
+        return columns, {'current_through': self.last_seen}
+
+    def render(self) -> list:
+        """
+        Format the snapshot exactly like the original /latest SQL did:
+        one formatted row per name followed by a row describing the data's age.
+        :return:
+        """
+        unit = ' minutes' if self.shuttle else '%'
+        result = [{self.value: f"{row['value']}{unit}", self.key: row['name']} for row in self.rows()]
+        result.append({self.value: None, self.key: f'Data above is current through the most recent time: {self.last_seen}'})
+        return result
+
+
+class SnapshotStore:
+    """
+    Holds one LatestSnapshot per (table, shuttle) pair and keeps them all refreshed
+    """
+    def __init__(self, db, flights=None):
+        """
+        :param db: The Storage to query
+        :param flights: The SingleFlight that concurrent loads share
+        """
+        self.db = db
+        self.flights = flights or SingleFlight()
+        self.snapshots = {}
+        # Created in start() so it belongs to the serving event loop
+        self.refresh_event = None
+        self.task = None
+        # Coroutines called with the (snapshot, changed rows) pairs after every refresh
+        self.listeners = []
+
+    async def get(self, table, shuttle=False) -> LatestSnapshot:
+        """
+        Get the snapshot for a table, loading it on first use.
+        Falls back to an inline refresh if the background refresher has fallen behind.
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        snapshot = self.snapshots.get((table, shuttle))
+        fresh = snapshot is not None and not snapshot.is_stale()
+        cache_lookup('snapshot', fresh)
+        if not fresh:
+            # A burst of requests for a table that needs loading shares one query
+            return await self.flights.run(('snapshot', table, shuttle), lambda: self.load(table, shuttle=shuttle))
+        return snapshot
+
+    async def load(self, table, shuttle=False) -> LatestSnapshot:
+        """
+        Load a snapshot, or refresh it inline if it's stale
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        snapshot = self.snapshots.get((table, shuttle))
+        if snapshot is None:
+            snapshot = LatestSnapshot(self.db, table, shuttle=shuttle)
+            await snapshot.refresh()
+            # Only keep snapshots for tables that actually loaded
+            self.snapshots[(table, shuttle)] = snapshot
+        elif snapshot.is_stale():
+            await snapshot.refresh()
+        return snapshot
+
+    def add_listener(self, listener):
+        """
+        Register a coroutine to be awaited with the updates from every background refresh
+        :param listener:
+        :return:
+        """
+        self.listeners.append(listener)
+
+    def invalidate(self):
+        """
+        Wake the refresher now instead of waiting for the next interval.
+        Called when the scraper pushes a notification that it wrote new rows.
+        :return:
+        """
+        if self.refresh_event:
+            self.refresh_event.set()
+
+    async def refresh_all(self) -> list:
+        """
+        Refresh every loaded snapshot
+        :return: (snapshot, changed rows) pairs for the snapshots that changed
+        """
+        try:
+            # A local copy has to catch up before its snapshots can see anything new
+            await self.db.sync()
+        except Exception as e:
+            logger.error(f'Could not sync the local copy: {e}')
+        updates = []
+        for snapshot in list(self.snapshots.values()):
+            try:
+                changed = await snapshot.refresh()
+            except Exception as e:
+                logger.error(f'Could not refresh snapshot of {snapshot.table}: {e}')
+                continue
+            if changed:
+                updates.append((snapshot, changed))
+        return updates
+
+    async def run(self):
+        """
+        Background loop: refresh on every push invalidation or every SNAPSHOT_INTERVAL seconds
+        :return:
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self.refresh_event.wait(), timeout=SNAPSHOT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.refresh_event.clear()
+            updates = await self.refresh_all()
+            if not updates:
+                continue
+            for listener in self.listeners:
+                try:
+                    await listener(updates)
+                except Exception as e:
+                    logger.error(f'Snapshot listener {listener.__qualname__} failed: {e}')
+
+    def start(self):
+        """
+        Start the background refresher
+        :return:
+        """
+        self.refresh_event = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the background refresher
+        :return:
+        """
+        if self.task:
+            self.task.cancel()
+            self.task = None
@@ -0,0 +1,582 @@
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from os import getenv, path, makedirs
+from time import monotonic
+from api_log import BotLog
+from storage import Storage
+from rollup import weekday_index, ceil_average, columns, YESTERDAY, LAST_WEEK
+from query_guard import GuardedQuery, QUERY_TIMEOUT, QUERY_ROW_CAP, QUERY_CHUNK
+from metrics import timed
+import newrelic.agent
+
+logger = BotLog('api-sqlite')
+
+# The local database file
+SQLITE_PATH = getenv("SQLITE_PATH", "data/parking.sqlite3")
+# Copy new rows from MariaDB into the file; turn off to serve a file seeded some other way
+SQLITE_REPLICATE = getenv("SQLITE_REPLICATE", "true").lower() == "true"
+# Threads running read queries, each with its own connection
+SQLITE_READERS = int(getenv("SQLITE_READERS", 4))
+# Source rows copied per round trip while replicating
+REPLICA_CHUNK = 10000
+
+# The scraper's columns for each kind of table, copied as is. The weekday and minute_of_day
+# columns mirror the MariaDB migrations.
+SCHEMAS = {
+    False: {
+        'columns': ['id', 'name', 'address', 'fullness', 'time'],
+        'create': '''
+            CREATE TABLE IF NOT EXISTS `{table}` (
+                `id` INTEGER PRIMARY KEY,
+                `name` TEXT NOT NULL,
+                `address` TEXT NOT NULL,
+                `fullness` INTEGER NOT NULL,
+                `time` DATETIME NOT NULL,
+                `weekday` INTEGER GENERATED ALWAYS AS ((CAST(strftime('%w', `time`) AS INTEGER) + 6) % 7) STORED,
+                `minute_of_day` INTEGER GENERATED ALWAYS AS (CAST(strftime('%H', `time`) AS INTEGER) * 60 + CAST(strftime('%M', `time`) AS INTEGER)) STORED
+            )''',
+    },
+    True: {
+        'columns': ['id', 'stop_name', 'time_to_departure', 'updated_at', 'day_of_week', 'hour_of_day', 'rounded_time_to_departure'],
+        'create': '''
+            CREATE TABLE IF NOT EXISTS `{table}` (
+                `id` INTEGER PRIMARY KEY,
+                `stop_name` TEXT NOT NULL,
+                `time_to_departure` INTEGER NOT NULL,
+                `updated_at` DATETIME NOT NULL,
+                `day_of_week` TEXT,
+                `hour_of_day` INTEGER,
+                `rounded_time_to_departure` INTEGER,
+                `weekday` INTEGER GENERATED ALWAYS AS ((CAST(strftime('%w', `updated_at`) AS INTEGER) + 6) % 7) STORED,
+                `minute_of_day` INTEGER GENERATED ALWAYS AS (CAST(strftime('%H', `updated_at`) AS INTEGER) * 60 + CAST(strftime('%M', `updated_at`) AS INTEGER)) STORED
+            )''',
+    },
+}
+
+# Scraped timestamps are stored as 'YYYY-MM-DD HH:MM:SS' text, which sorts and compares like time
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+
+def dict_row(cursor, row) -> dict:
+    """
+    sqlite3 row factory returning dicts, like aiomysql's DictCursor
+    :param cursor:
+    :param row:
+    :return:
+    """
+    return {description[0]: value for description, value in zip(cursor.description, row)}
+
+
+def translate(query, args) -> str:
+    """
+    Swap the %s placeholders the rest of the API writes for sqlite3's ?, and %% for %.
+    Like aiomysql, a query without arguments is left as is.
+    :param query:
+    :param args:
+    :return:
+    """
+    if args is None:
+        return query
+    return query.replace('%s', '?').replace('%%', '%')
+
+
+class SqliteStorage(Storage):
+    """
+    Serves the parking-api from a local SQLite file that copies the scraper's MariaDB tables
+    forward by id. Reads never touch the MariaDB the scraper writes to, and with
+    SQLITE_REPLICATE off the API runs against a file with no database server at all.
+    Reads run on a small thread pool with one connection per thread; writes (the copy)
+    go through a single writer thread, and WAL mode keeps them from blocking readers.
+    """
+    dialect = 'sqlite'
+
+    def __init__(self, file=SQLITE_PATH, replicate=SQLITE_REPLICATE):
+        """
+        :param file: The SQLite file
+        :param replicate: Whether to copy new rows from MariaDB
+        """
+        self.file = file
+        self.source = None
+        if replicate:
+            from mariadb import Config
+            self.source = Config()
+        self.readers = ThreadPoolExecutor(SQLITE_READERS, thread_name_prefix='sqlite-read')
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='sqlite-write')
+        self.local = threading.local()
+        self.sync_lock = None
+        self.sync_task = None
+        self.synced_at = None
+        self.healthy = False
+
+    def connect(self, read_only=False) -> sqlite3.Connection:
+        """
+        Open a connection to the file
+        :param read_only: Open it so that nothing can be written, for /query
+        :return:
+        """
+        target = f'file:{self.file}?mode=ro' if read_only else self.file
+        conn = sqlite3.connect(target, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                               uri=read_only, isolation_level=None)
+        conn.row_factory = dict_row
+        conn.execute('PRAGMA busy_timeout = 5000')
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        This thread's connection, opened on first use
+        :return:
+        """
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = self.connect()
+        return self.local.conn
+
+    async def read(self, function, *args):
+        """
+        Run a blocking function on a reader thread
+        :param function:
+        :param args:
+        :return:
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.readers, function, *args)
+
+    async def write(self, function, *args):
+        """
+        Run a blocking function on the writer thread
+        :param function:
+        :param args:
+        :return:
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.writer, function, *args)
+
+    def create_tables(self):
+        """
+        Create the replicated tables and their indexes if they don't exist yet
+        :return:
+        """
+        from migrate import TABLES
+        conn = self.connection()
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        for table, shuttle in TABLES.items():
+            self.create_table(table, shuttle)
+
+    def create_table(self, table, shuttle=False):
+        """
+        Create one table with the scraper's columns, the derived weekday/minute columns and
+        the same indexes as the MariaDB migrations
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        name, _, time = columns(shuttle)
+        conn = self.connection()
+        conn.execute(SCHEMAS[shuttle]['create'].format(table=table))
+        conn.execute(f'CREATE INDEX IF NOT EXISTS `{table}_name_time` ON `{table}` (`{name}`, `{time}`)')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS `{table}_time` ON `{table}` (`{time}`)')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS `{table}_weekday_minute` ON `{table}` (`weekday`, `minute_of_day`)')
+
+    @newrelic.agent.background_task()
+    async def retry_connection(self, max_retries=3, delay=5):
+        """
+        Open the file, create missing tables and, when replicating, connect to MariaDB and
+        start the first copy in the background
+        :param max_retries:
+        :param delay:
+        :return:
+        """
+        directory = path.dirname(self.file)
+        if directory:
+            makedirs(directory, exist_ok=True)
+        await self.write(self.create_tables)
+        self.sync_lock = asyncio.Lock()
+        self.healthy = True
+        logger.info(f'Opened SQLite file {self.file}')
+        if self.source:
+            await self.source.retry_connection(max_retries=max_retries, delay=delay)
+            self.sync_task = asyncio.ensure_future(self.sync())
+
+    async def close(self):
+        """
+        Stop replicating and close the source pool; the reader threads exit with the process
+        :return:
+        """
+        if self.sync_task:
+            self.sync_task.cancel()
+        if self.source:
+            await self.source.close()
+        self.readers.shutdown(wait=False)
+        self.writer.shutdown(wait=False)
+
+    async def health_check(self) -> bool:
+        """
+        Check the file can be read, and the source reached when replicating
+        :return:
+        """
+        try:
+            await self.read(lambda: self.connection().execute('SELECT 1').fetchall())
+            self.healthy = True
+        except Exception as e:
+            logger.error(f'Health check of {self.file} failed: {e}')
+            self.healthy = False
+        if self.source:
+            return self.healthy and await self.source.health_check()
+        return self.healthy
+
+    def pool_status(self) -> dict:
+        """
+        The reader threads, the source pool and how long ago the copy last caught up
+        :return:
+        """
+        return {
+            'backend': self.dialect,
+            'readers': SQLITE_READERS,
+            'seconds_since_sync': round(monotonic() - self.synced_at, 1) if self.synced_at else None,
+            'source': self.source.pool_status() if self.source else None,
+        }
+
+    @newrelic.agent.background_task()
+    @timed
+    async def fetch_all(self, query, args=None) -> list:
+        """
+        Run a query on a reader thread and return every row as a dict
+        :param query:
+        :param args:
+        :return:
+        """
+        return await self.read(lambda: self.connection().execute(translate(query, args), args or ()).fetchall())
+
+    @timed
+    async def stream_chunks(self, query, args=None, chunk=500):
+        """
+        Yield the rows of a query in lists of up to `chunk` from a connection of its own
+        :param query:
+        :param args:
+        :param chunk:
+        :return:
+        """
+        conn = await self.read(self.connect)
+        try:
+            cursor = await self.read(conn.execute, translate(query, args), args or ())
+            while True:
+                rows = await self.read(cursor.fetchmany, chunk)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await self.read(conn.close)
+
+    @newrelic.agent.background_task()
+    @timed
+    async def execute(self, query, args=None) -> int:
+        """
+        Run a statement on the writer thread
+        :param query:
+        :param args:
+        :return: The number of affected rows
+        """
+        return await self.write(lambda: self.connection().execute(translate(query, args), args or ()).rowcount)
+
+    @newrelic.agent.background_task()
+    @timed
+    async def executemany(self, query, rows) -> int:
+        """
+        Run one statement for many rows in a single transaction on the writer thread
+        :param query:
+        :param rows:
+        :return: The number of affected rows
+        """
+        def run():
+            conn = self.connection()
+            conn.execute('BEGIN')
+            try:
+                count = conn.executemany(translate(query, rows), rows).rowcount
+                conn.execute('COMMIT')
+                return count
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return await self.write(run)
+
+    async def sync(self) -> int:
+        """
+        Copy every source row newer than the newest local id, table by table.
+        Called before each snapshot refresh, so the local copy is as fresh as /latest.
+        :return: Rows copied
+        """
+        if not self.source or not self.source.pool:
+            return 0
+        from migrate import TABLES
+        copied = 0
+        async with self.sync_lock:
+            for table, shuttle in TABLES.items():
+                copied += await self.replicate(table, shuttle)
+            self.synced_at = monotonic()
+        return copied
+
+    @newrelic.agent.background_task()
+    @timed
+    async def replicate(self, table, shuttle=False) -> int:
+        """
+        Copy one table's new rows from MariaDB, REPLICA_CHUNK at a time, each chunk in its own
+        transaction. The local MAX(id) is the watermark, so an interrupted copy resumes cleanly.
+        :param table:
+        :param shuttle:
+        :return: Rows copied
+        """
+        names = SCHEMAS[shuttle]['columns']
+        last_id = (await self.fetch_all(f'SELECT COALESCE(MAX(id), 0) AS last_id FROM `{table}`'))[0]['last_id']
+        select = f'SELECT {", ".join(names)} FROM `{table}` WHERE id > %s ORDER BY id'
+        insert = f'INSERT OR IGNORE INTO `{table}` ({", ".join(names)}) VALUES ({", ".join(["%s"] * len(names))})'
+        copied = 0
+        async for rows in self.source.stream_chunks(select, (last_id,), chunk=REPLICA_CHUNK):
+            await self.executemany(insert, [tuple(row[name] for name in names) for row in rows])
+            copied += len(rows)
+        if copied:
+            logger.info(f'Copied {copied} rows of {table} from MariaDB into {self.file}')
+        return copied
+
+    def guarded_query(self, sql):
+        """
+        A /query statement checked and run on a read-only connection with a timeout and row cap
+        :param sql:
+        :return:
+        """
+        return SqliteGuardedQuery(self, sql)
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_latest_rows(self, table, shuttle=False) -> list:
+        """
+        Get the latest typed reading for each unique name.
+        Used to load the /latest snapshot.
+        :param table:
+        :param shuttle:
+        :return: A list of {'name', 'value', 'time'} dicts
+        """
+        name, value, time = columns(shuttle)
+        results = await self.fetch_all(f'''
+            SELECT t.{name} AS name, t.{value} AS value, t.{time} AS time
+            FROM `{table}` t
+            JOIN (
+                SELECT {name}, MAX({time}) AS most_recent_time
+                FROM `{table}`
+                GROUP BY {name}
+            ) lt ON lt.{name} = t.{name} AND lt.most_recent_time = t.{time}
+        ''')
+        logger.info(f'Loaded {len(results)} latest rows from {table}')
+        return results
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_newer_rows(self, table, since, shuttle=False) -> list:
+        """
+        Get the typed readings at or after a timestamp, oldest first.
+        Used to refresh the /latest snapshot incrementally.
+        :param table:
+        :param since: The last timestamp the caller has seen
+        :param shuttle:
+        :return: A list of {'name', 'value', 'time'} dicts
+        """
+        name, value, time = columns(shuttle)
+        return await self.fetch_all(f'''
+            SELECT {name} AS name, {value} AS value, {time} AS time
+            FROM `{table}`
+            WHERE {time} >= %s
+            ORDER BY {time}
+        ''', (since,))
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_at_rows(self, table, pairs, shuttle=False) -> list:
+        """
+        Get the newest typed reading of each name at or before an instant, one seek on the
+        (name, time) index per pair. Like Config.get_at_rows; SQLite only takes ORDER BY and
+        LIMIT in a compound select's members as subqueries.
+        :param table:
+        :param pairs: (name, datetime) tuples
+        :param shuttle:
+        :return: A list of {'pair', 'name', 'value', 'time'} dicts
+        """
+        name, value, time = columns(shuttle)
+        query = ' UNION ALL '.join(f'''SELECT * FROM (
+            SELECT {index} AS pair, {name} AS name, {value} AS value, {time} AS time
+            FROM `{table}`
+            WHERE {name} = %s AND {time} <= %s
+            ORDER BY {time} DESC
+            LIMIT 1
+        )''' for index in range(len(pairs)))
+        return await self.fetch_all(query, [arg for pair in pairs for arg in pair])
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_latest(self, table, shuttle=False):
+        """
+        Get the latest entry for each unique name, formatted like Config.get_latest
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        key, value, unit = ('stop_name', 'time_to_departure', ' minutes') if shuttle else ('name', 'fullness', '%')
+        try:
+            rows = await self.get_latest_rows(table, shuttle=shuttle)
+        except Exception as e:
+            logger.error(f'Could not get latest entry in {table}: {e}')
+            return None
+        results = [{value: f"{row['value']}{unit}", key: row['name']} for row in rows]
+        newest = max((row['time'] for row in rows), default=None)
+        results.append({value: None, key: f'Data above is current through the most recent time: {newest}'})
+        return results
+
+    async def window(self, table, start_minutes, end_minutes, shuttle=False):
+        """
+        Averages per name between two offsets before now, formatted like Config.window_query
+        :param table:
+        :param start_minutes:
+        :param end_minutes:
+        :param shuttle:
+        :return:
+        """
+        name, value, time = columns(shuttle)
+        key, label, unit = ('stop_name', 'avg_time_to_departure', ' minutes') if shuttle else ('name', 'avg_fullness', '%')
+        now = (await self.now()).replace(microsecond=0)
+        start, end = now - timedelta(minutes=start_minutes), now - timedelta(minutes=end_minutes)
+        try:
+            rows = await self.fetch_all(f'''
+                SELECT {name} AS name, SUM({value}) AS total, COUNT({value}) AS samples
+                FROM `{table}`
+                WHERE {time} >= %s AND {time} < %s
+                GROUP BY {name}
+            ''', (start, end))
+        except Exception as e:
+            logger.error(f'Could not get entries between {start} and {end} in {table}: {e}')
+            return None
+        results = [{label: f"{ceil_average(row['total'], row['samples'])}{unit}", key: row['name']} for row in rows]
+        results.append({label: f'Data above is for {start} to {end}', key: ''})
+        return results
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_yesterday(self, table, shuttle=False):
+        """
+        Get the average for each unique name for the hour around this time yesterday
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return await self.window(table, *YESTERDAY, shuttle=shuttle)
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_last_week(self, table, shuttle=False):
+        """
+        Get the average for each unique name for the half hour before this time last week
+        :param table:
+        :param shuttle:
+        :return:
+        """
+        return await self.window(table, *LAST_WEEK, shuttle=shuttle)
+
+    @newrelic.agent.background_task()
+    @timed
+    async def get_average(self, table, day, time, shuttle=False):
+        """
+        Get the average for each unique name for the given day and time, formatted like
+        Config.get_average with its WITH ROLLUP total row
+        :param table:
+        :param day:
+        :param time:
+        :param shuttle:
+        :return:
+        """
+        name, value, _ = columns(shuttle)
+        key, label, unit, text = ('stop_name', 'average_time_to_departure', ' minutes', 'average time to departure') \
+            if shuttle else ('name', 'fullness', '%', 'average fullness')
+        weekday = weekday_index(day)
+        minute = time.hour * 60 + time.minute
+        try:
+            rows = await self.fetch_all(f'''
+                SELECT {name} AS name, SUM({value}) AS total, COUNT({value}) AS samples
+                FROM `{table}`
+                WHERE weekday = %s AND minute_of_day BETWEEN %s AND %s
+                GROUP BY {name}
+                ORDER BY {name}
+            ''', (weekday, max(minute - 60, 0), minute))
+        except Exception as e:
+            logger.error(f'Could not get average fullness for {table}: {e}')
+            return None
+        overall = ceil_average(sum(row['total'] for row in rows), sum(row['samples'] for row in rows))
+        overall = f'{overall}{unit}' if overall is not None else None
+        results = [{key: row['name'], label: f"{ceil_average(row['total'], row['samples'])}{unit}"} for row in rows]
+        results.append({key: None, label: overall})
+        results.append({key: f'Data above is {text} for {day} at {time}', label: overall})
+        logger.info(f'Found {len(results)} results for {day} at {time} in {table}')
+        return results
+
+    @newrelic.agent.background_task()
+    @timed
+    async def run_query(self, sql_query):
+        """
+        Run a query on the local copy
+        :param sql_query:
+        :return:
+        """
+        try:
+            results = await self.fetch_all(sql_query)
+        except Exception as e:
+            logger.error(f'Could not run query {sql_query}: {e}')
+            return None
+        logger.info(f'Found {len(results)} results for query {sql_query}')
+        return results
+
+
+class SqliteGuardedQuery(GuardedQuery):
+    """
+    GuardedQuery for the SQLite copy: the statement runs on a read-only connection, a
+    progress handler aborts it after QUERY_TIMEOUT seconds and rows stop at QUERY_ROW_CAP.
+    """
+    async def start(self):
+        """
+        Open a read-only connection and execute the statement, so errors surface before
+        any part of the response has been sent
+        :return:
+        """
+        deadline = monotonic() + QUERY_TIMEOUT
+        self.conn = await self.db.read(self.db.connect, True)
+        self.conn.set_progress_handler(lambda: monotonic() > deadline, 10000)
+        try:
+            self.cursor = await self.db.read(self.conn.execute, self.sql)
+        except Exception:
+            await self.close()
+            raise
+
+    async def rows(self):
+        """
+        Yield the result rows, QUERY_CHUNK at a time, up to QUERY_ROW_CAP
+        :return:
+        """
+        try:
+            while self.count < QUERY_ROW_CAP:
+                chunk = await self.db.read(self.cursor.fetchmany, min(QUERY_CHUNK, QUERY_ROW_CAP - self.count))
+                if not chunk:
+                    return
+                for row in chunk:
+                    self.count += 1
+                    yield row
+            self.truncated = bool(await self.db.read(self.cursor.fetchone))
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Close the read-only connection
+        :return:
+        """
+        if self.conn is None:
+            return
+        await self.db.read(self.conn.close)
+        self.conn = None
+        logger.info(f'Streamed {self.count} rows{" (truncated)" if self.truncated else ""} for query {self.sql}')
@@ -0,0 +1,160 @@
+from datetime import datetime
+from os import getenv
+
+# Which Storage the API reads from: mariadb, or sqlite for a local replica
+STORAGE_BACKEND = getenv("STORAGE_BACKEND", "mariadb").lower()
+
+
+class Storage:
+    """
+    What the parking-api needs from a database. Config is the MariaDB implementation and
+    SqliteStorage an embedded one; api.py picks one with STORAGE_BACKEND.
+    Queries use %s placeholders and backtick-quoted table names, which both backends accept.
+    """
+    # The SQL dialect, for the few callers (the rollup tables) that only work on one
+    dialect = None
+
+    async def retry_connection(self, max_retries=3, delay=5):
+        """
+        Connect once the event loop is running
+        :param max_retries:
+        :param delay:
+        :return:
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def health_check(self) -> bool:
+        raise NotImplementedError
+
+    def pool_status(self) -> dict:
+        raise NotImplementedError
+
+    async def fetch_all(self, query, args=None) -> list:
+        """
+        :param query:
+        :param args:
+        :return: Every row as a dict
+        """
+        raise NotImplementedError
+
+    async def fetch_prepared(self, key, build, args=()) -> list:
+        """
+        Run a recurring query that only ever changes in its arguments. Backends that can
+        prepare statements do; the rest run it as a plain fetch_all.
+        :param key: (query, table, shuttle), which names the statement
+        :param build: A callable returning the query with %s placeholders
+        :param args: The placeholder values
+        :return: Every row as a dict
+        """
+        return await self.fetch_all(build(), args or None)
+
+    async def stream_chunks(self, query, args=None, chunk=500):
+        """
+        Yield the rows of a query in lists of up to `chunk` without holding the whole result
+        :param query:
+        :param args:
+        :param chunk:
+        :return:
+        """
+        raise NotImplementedError
+        yield
+
+    async def execute(self, query, args=None) -> int:
+        """
+        :param query:
+        :param args:
+        :return: The number of affected rows
+        """
+        raise NotImplementedError
+
+    async def executemany(self, query, rows) -> int:
+        """
+        Run one statement for many rows in a single transaction
+        :param query:
+        :param rows: A list of argument tuples
+        :return: The number of affected rows
+        """
+        raise NotImplementedError
+
+    def transaction(self):
+        """
+        An async context manager yielding a dict cursor inside a transaction
+        :return:
+        """
+        raise NotImplementedError(f'Transactions need MariaDB, not {self.dialect}')
+
+    async def now(self) -> datetime:
+        """
+        The database's clock, which the scraped timestamps follow
+        :return:
+        """
+        return datetime.now()
+
+    async def sync(self) -> int:
+        """
+        Bring a local copy of the tables up to date. Nothing to do when reading the source directly.
+        :return: Rows copied
+        """
+        return 0
+
+    def guarded_query(self, sql):
+        """
+        A read-only, time and row limited runner for a /query statement
+        :param sql:
+        :return: An object with start() and stream_parking_info(), like GuardedQuery
+        """
+        raise NotImplementedError
+
+    async def get_latest_rows(self, table, shuttle=False) -> list:
+        raise NotImplementedError
+
+    async def get_newer_rows(self, table, since, shuttle=False) -> list:
+        raise NotImplementedError
+
+    async def get_at_rows(self, table, pairs, shuttle=False) -> list:
+        """
+        The newest typed reading of each name at or before an instant, one (name, time) index
+        seek per pair
+        :param table:
+        :param pairs: (name, datetime) tuples
+        :param shuttle:
+        :return: A list of {'pair', 'name', 'value', 'time'} dicts, pair being the index into
+            pairs; pairs with no reading that early are left out
+        """
+        raise NotImplementedError
+
+    async def get_latest(self, table, shuttle=False):
+        raise NotImplementedError
+
+    async def get_yesterday(self, table, shuttle=False):
+        raise NotImplementedError
+
+    async def get_last_week(self, table, shuttle=False):
+        raise NotImplementedError
+
+    async def get_average(self, table, day, time, shuttle=False):
+        raise NotImplementedError
+
+    async def run_query(self, sql_query):
+        raise NotImplementedError
+
+
+def make_storage(database=None, pool_size=None) -> Storage:
+    """
+    The Storage selected by STORAGE_BACKEND
+    :param database: Connection settings overriding the DB_* ones, from a campus in the registry
+    :param pool_size: Most pooled connections, instead of DB_POOL_SIZE; SQLite has no pool
+    :return:
+    """
+    if STORAGE_BACKEND == 'sqlite':
+        if database:
+            raise ValueError('The sqlite backend only replicates the DB_* database')
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage()
+    if STORAGE_BACKEND != 'mariadb':
+        raise ValueError(f'Unknown STORAGE_BACKEND: {STORAGE_BACKEND}')
+    from mariadb import Config
+    return Config(**(database or {}), pool_size=pool_size)
@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+from coalesce import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ['row']
+
+        async def burst():
+            return await asyncio.gather(*(flights.run(('latest', 'sjsu'), query) for _ in range(5)))
+
+        results = asyncio.run(burst())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['row']] * 5)
+        # Every caller got the very same object
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flights.stats(), {'in_flight': 0, 'calls': {'latest': 5}, 'coalesced': {'latest': 4}})
+
+    def test_every_caller_sees_the_exception(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise RuntimeError('server has gone away')
+
+        async def burst():
+            return await asyncio.gather(*(flights.run(('average', 'sjsu'), query) for _ in range(3)),
+                                        return_exceptions=True)
+
+        results = asyncio.run(burst())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, RuntimeError)
+            self.assertEqual(str(result), 'server has gone away')
+
+    def test_different_keys_and_later_calls_run_again(self):
+        flights = SingleFlight()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            number = len(calls)
+            await asyncio.sleep(0)
+            return number
+
+        async def run():
+            together = await asyncio.gather(flights.run(('latest', 'a'), query), flights.run(('latest', 'b'), query))
+            # Nothing is kept once a call lands
+            later = await flights.run(('latest', 'a'), query)
+            return together, later
+
+        together, later = asyncio.run(run())
+        self.assertEqual(sorted(together), [1, 2])
+        self.assertEqual(later, 3)
+
+    def test_one_caller_giving_up_does_not_cancel_the_others(self):
+        flights = SingleFlight()
+
+        async def query():
+            await asyncio.sleep(0.02)
+            return 'done'
+
+        async def run():
+            impatient = asyncio.ensure_future(flights.run(('export', 't'), query))
+            patient = asyncio.ensure_future(flights.run(('export', 't'), query))
+            await asyncio.sleep(0.005)
+            impatient.cancel()
+            return await patient
+
+        self.assertEqual(asyncio.run(run()), 'done')
+
+
+if __name__ == "__main__":
+    unittest.main()
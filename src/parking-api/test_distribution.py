@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+from datetime import time
+import numpy as np
+from distribution import percentiles, Distributions
+from series import HISTOGRAM_BINS
+
+
+def histogram(*values) -> np.ndarray:
+    """
+    One row of counts with a sample at each value
+    """
+    counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    for value in values:
+        counts[value] += 1
+    return counts
+
+
+class TestPercentiles(unittest.TestCase):
+    def test_known_histogram(self):
+        # 1..100, one sample each: the nearest-rank p-th percentile is p itself
+        counts = histogram(*range(1, 101))
+        result = percentiles(counts[None, :], [1, 25, 50, 90, 99, 100])
+        self.assertEqual(result.tolist(), [[1, 25, 50, 90, 99, 100]])
+
+    def test_nearest_rank_rounds_up(self):
+        # Ranks are ceil(p / 100 * n): with 4 samples p50 is the 2nd, p51 the 3rd
+        counts = histogram(10, 20, 30, 40)
+        result = percentiles(counts[None, :], [0, 25, 50, 51, 75, 100])
+        self.assertEqual(result.tolist(), [[10, 10, 20, 30, 30, 40]])
+
+    def test_repeated_values(self):
+        counts = histogram(*[5] * 9, 95)
+        result = percentiles(counts[None, :], [50, 90, 91, 100])
+        self.assertEqual(result.tolist(), [[5, 5, 95, 95]])
+
+    def test_empty_histogram(self):
+        counts = np.zeros((1, HISTOGRAM_BINS), dtype=np.int64)
+        self.assertEqual(percentiles(counts, [0, 50, 100]).tolist(), [[-1, -1, -1]])
+
+    def test_single_sample(self):
+        counts = histogram(42)
+        self.assertEqual(percentiles(counts[None, :], [0, 1, 50, 99, 100]).tolist(), [[42] * 5])
+
+    def test_rows_are_independent(self):
+        counts = np.stack([histogram(0, 100), np.zeros(HISTOGRAM_BINS, dtype=np.int64), histogram(7)])
+        self.assertEqual(percentiles(counts, [50, 100]).tolist(), [[0, 100], [-1, -1], [7, 7]])
+
+
+class FakeSeries:
+    """
+    One merged histogram per name, whatever the weekday and minutes
+    """
+    def __init__(self, names, histograms):
+        self.names = names
+        self.histograms = histograms
+
+    def histogram(self, weekday, start_minute, end_minute):
+        return self.histograms
+
+
+class FakeEngine:
+    def __init__(self, series):
+        self.tables = {'shuttles': series}
+
+    async def ensure(self, table, shuttle=False):
+        pass
+
+
+class TestClippedPercentiles(unittest.TestCase):
+    def distribution(self, shuttle):
+        # One stop whose ETAs are mostly past the top bin, and one well inside it
+        series = FakeSeries(['North', 'South'], np.stack([histogram(10, *[HISTOGRAM_BINS - 1] * 9),
+                                                          histogram(*range(1, 11))]))
+        distributions = Distributions(FakeEngine(series))
+        return asyncio.run(distributions.distribution('shuttles', 'Monday', time(10), points=[50, 99], shuttle=shuttle))
+
+    def test_shuttle_tail_in_the_top_bin_is_a_lower_bound(self):
+        result = self.distribution(shuttle=True)
+        self.assertEqual(result['clipped'].tolist(), [[True, True], [False, False]])
+        rows = Distributions.render(result, 'Monday', time(10), shuttle=True)
+        self.assertEqual((rows[0]['p50'], rows[0]['p99']), ('100+ minutes', '100+ minutes'))
+        self.assertEqual((rows[1]['p50'], rows[1]['p99']), ('5 minutes', '10 minutes'))
+        columns, _ = Distributions.columns(result, shuttle=True)
+        self.assertEqual(columns['p99'], [100, 10])
+        self.assertEqual(columns['p99_clipped'], [True, False])
+
+    def test_full_garage_is_exact(self):
+        result = self.distribution(shuttle=False)
+        self.assertFalse(result['clipped'].any())
+        self.assertEqual(Distributions.render(result, 'Monday', time(10))[0]['p99'], '100%')
+        self.assertNotIn('p99_clipped', Distributions.columns(result)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
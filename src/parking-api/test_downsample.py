@@ -0,0 +1,96 @@
+import unittest
+import numpy as np
+from downsample import lttb, minmax, MIN_POINTS
+
+
+def reference_lttb(times, values, points) -> list:
+    """
+    Largest-triangle-three-buckets as Steinarsson describes it, one point at a time
+    """
+    length = len(times)
+    if points >= length:
+        return list(range(length))
+    x, y = (times - times[0]).astype(float), values.astype(float)
+    buckets = points - 2
+    kept, previous = [0], 0
+    for bucket in range(buckets):
+        low, high = bucket * (length - 2) // buckets + 1, (bucket + 1) * (length - 2) // buckets + 1
+        if bucket == buckets - 1:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            following = slice(high, (bucket + 2) * (length - 2) // buckets + 1)
+            next_x, next_y = x[following].mean(), y[following].mean()
+        largest = -1
+        for index in range(low, high):
+            area = abs((x[previous] - next_x) * (y[index] - y[previous])
+                       - (x[previous] - x[index]) * (next_y - y[previous]))
+            if area > largest:
+                largest, chosen = area, index
+        kept.append(chosen)
+        previous = chosen
+    return kept + [length - 1]
+
+
+def series(length, seed=1) -> tuple:
+    """
+    Readings about a minute apart with noisy values
+    """
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.integers(50, 70, length)).astype(np.int64), rng.integers(0, 100, length)
+
+
+class TestLttb(unittest.TestCase):
+    def test_matches_reference(self):
+        for length, points in [(10, 3), (10, 4), (11, 5), (37, 10), (101, 100), (1000, 100), (5000, 200)]:
+            times, values = series(length, seed=length)
+            self.assertEqual(lttb(times, values, points).tolist(), reference_lttb(times, values, points),
+                             msg=f'{length} readings, {points} points')
+
+    def test_keeps_a_lone_spike(self):
+        times = np.arange(100, dtype=np.int64) * 60
+        values = np.full(100, 50)
+        values[41] = 100
+        self.assertIn(41, lttb(times, values, 10).tolist())
+
+    def test_short_series_kept_whole(self):
+        times, values = series(20)
+        self.assertEqual(lttb(times, values, 20).tolist(), list(range(20)))
+        self.assertEqual(lttb(times, values, 50).tolist(), list(range(20)))
+
+
+class TestMinmax(unittest.TestCase):
+    def assertKeepsExtremes(self, times, values, points):
+        length = len(times)
+        kept = minmax(times, values, points)
+        message = f'{length} readings, {points} points'
+        self.assertLessEqual(len(kept), points, msg=message)
+        self.assertTrue(np.all(np.diff(kept) > 0), msg=message)
+        self.assertEqual((kept[0], kept[-1]), (0, length - 1), msg=message)
+        buckets = (points - 2) // 2
+        for bucket in range(buckets):
+            low, high = bucket * (length - 2) // buckets + 1, (bucket + 1) * (length - 2) // buckets + 1
+            if low == high:
+                continue
+            inside = kept[(kept >= low) & (kept < high)]
+            self.assertEqual(values[inside].min(), values[low:high].min(), msg=f'{message}, bucket {bucket}')
+            self.assertEqual(values[inside].max(), values[low:high].max(), msg=f'{message}, bucket {bucket}')
+
+    def test_extremes_of_every_bucket(self):
+        for length in [10, 37, 1000]:
+            times, values = series(length, seed=length)
+            for points in [MIN_POINTS, MIN_POINTS + 1, 20, length - 2, length - 1]:
+                if points < length:
+                    self.assertKeepsExtremes(times, values, points)
+
+    def test_flat_series(self):
+        times = np.arange(50, dtype=np.int64) * 60
+        self.assertKeepsExtremes(times, np.full(50, 7), 10)
+
+    def test_short_series_kept_whole(self):
+        times, values = series(20)
+        self.assertEqual(minmax(times, values, 20).tolist(), list(range(20)))
+        self.assertEqual(minmax(times, values, 21).tolist(), list(range(20)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import gc
+import unittest
+from datetime import datetime
+from export import Exporter, ExportBusy, EXPORT_SLOTS
+
+
+class FakeStorage:
+    """
+    Streams two chunks of rows, optionally failing after the first
+    """
+    def __init__(self, fail=False):
+        self.fail = fail
+
+    async def stream_chunks(self, query, args=None, chunk=500):
+        yield [{'name': 'South Garage', 'fullness': 40, 'time': datetime(2024, 1, 1, 8)}]
+        await asyncio.sleep(0)
+        if self.fail:
+            raise ConnectionError('lost connection to server')
+        yield [{'name': 'South Garage', 'fullness': 41, 'time': datetime(2024, 1, 1, 8, 1)}]
+
+
+async def drain(body) -> str:
+    return ''.join([part async for part in body])
+
+
+class TestExporter(unittest.TestCase):
+    def open(self, exporter):
+        return exporter.open('sjsu', datetime(2024, 1, 1), datetime(2024, 1, 2))
+
+    def test_burst_past_the_limit_is_refused_up_front(self):
+        async def burst():
+            exporter = Exporter(FakeStorage())
+            return await asyncio.gather(*(self.open(exporter) for _ in range(EXPORT_SLOTS + 3)),
+                                        return_exceptions=True)
+
+        results = asyncio.run(burst())
+        self.assertEqual(sum(isinstance(result, ExportBusy) for result in results), 3)
+
+    def test_slot_comes_back_when_the_stream_ends(self):
+        async def run():
+            exporter = Exporter(FakeStorage())
+            bodies = [await self.open(exporter) for _ in range(EXPORT_SLOTS)]
+            with self.assertRaises(ExportBusy):
+                await self.open(exporter)
+            text = await drain(bodies[0])
+            await self.open(exporter)
+            return text
+
+        self.assertEqual(asyncio.run(run()).count('\n'), 2)
+
+    def test_slot_comes_back_when_the_body_never_starts(self):
+        async def run():
+            exporter = Exporter(FakeStorage())
+            for _ in range(EXPORT_SLOTS):
+                await self.open(exporter)
+            gc.collect()
+            # The unstarted bodies were dropped, as when a client disconnects before the response starts
+            await self.open(exporter)
+
+        asyncio.run(run())
+
+    def test_failure_mid_stream_raises(self):
+        async def run():
+            exporter = Exporter(FakeStorage(fail=True))
+            body = await self.open(exporter)
+            received = []
+            with self.assertRaises(ConnectionError):
+                async for part in body:
+                    received.append(part)
+            self.assertEqual(len(received), 1)
+            # And the slot is free again
+            for _ in range(EXPORT_SLOTS):
+                await self.open(exporter)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
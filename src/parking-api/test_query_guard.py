@@ -0,0 +1,78 @@
+import unittest
+from query_guard import check_read_only, QueryRejected
+
+
+class TestCheckReadOnly(unittest.TestCase):
+    def assertRejected(self, sql):
+        with self.assertRaises(QueryRejected, msg=sql):
+            check_read_only(sql)
+
+    def test_plain_selects_pass(self):
+        self.assertEqual(check_read_only('SELECT name, fullness FROM sjsu'), 'SELECT name, fullness FROM sjsu')
+        self.assertEqual(check_read_only('  select * from sjsu;  '), 'select * from sjsu')
+        self.assertEqual(check_read_only('WITH t AS (SELECT 1 AS x) SELECT x FROM t'),
+                         'WITH t AS (SELECT 1 AS x) SELECT x FROM t')
+
+    def test_empty(self):
+        self.assertRejected('')
+        self.assertRejected('   ')
+        self.assertRejected(None)
+
+    def test_other_statements(self):
+        for sql in ['DELETE FROM sjsu', 'UPDATE sjsu SET fullness = 0', 'DROP TABLE sjsu', 'SHOW TABLES',
+                    'INSERT INTO sjsu VALUES (1)', 'SET @a = 1', 'CALL p()', 'DO SLEEP(10)']:
+            self.assertRejected(sql)
+
+    def test_stacked_statements(self):
+        self.assertRejected('SELECT 1; DROP TABLE sjsu')
+        self.assertRejected('SELECT 1;DELETE FROM sjsu;')
+        self.assertRejected('SELECT 1; SELECT 2')
+
+    def test_semicolons_in_string_literals(self):
+        self.assertEqual(check_read_only("SELECT ';' AS a, \"x;y\" AS b FROM sjsu WHERE name = 'a; DROP TABLE sjsu'"),
+                         "SELECT ';' AS a, \"x;y\" AS b FROM sjsu WHERE name = 'a; DROP TABLE sjsu'")
+        # Escaped quotes don't end the literal early
+        self.assertEqual(check_read_only("SELECT 'it\\'s; fine' FROM sjsu"), "SELECT 'it\\'s; fine' FROM sjsu")
+        # Forbidden words inside literals and quoted identifiers are only data
+        check_read_only("SELECT `update`, 'DELETE' FROM sjsu")
+
+    def test_comments_hiding_keywords(self):
+        # Comments are stripped from what runs, so text inside them can't execute
+        self.assertEqual(check_read_only('SELECT 1 /* ; DROP TABLE sjsu */ FROM sjsu'), 'SELECT 1   FROM sjsu')
+        self.assertEqual(check_read_only('SELECT 1 -- ; DROP TABLE sjsu'), 'SELECT 1')
+        self.assertEqual(check_read_only('SELECT 1 # ; DROP TABLE sjsu'), 'SELECT 1')
+        # But a statement after a comment is still a second statement
+        self.assertRejected('SELECT 1 /* x */; DROP TABLE sjsu')
+        self.assertRejected('SELECT 1 -- x\n; DROP TABLE sjsu')
+        # Comments can't split or disguise the leading keyword
+        self.assertRejected('/* SELECT */ DELETE FROM sjsu')
+        self.assertRejected('SEL/**/ECT 1')
+        self.assertRejected('DELETE/* SELECT */FROM sjsu')
+        # MariaDB runs the body of executable comments
+        self.assertRejected('SELECT 1 /*! INTO OUTFILE "/tmp/x" */')
+        self.assertRejected('SELECT 1 /*!50000 , SLEEP(10) */')
+        self.assertRejected('SELECT 1 /*M!100000 FOR UPDATE */')
+
+    def test_unterminated_comment_and_quote(self):
+        self.assertEqual(check_read_only('SELECT 1 /* DROP TABLE sjsu'), 'SELECT 1')
+        check_read_only("SELECT 'unterminated; DROP TABLE sjsu")
+
+    def test_into_outfile(self):
+        self.assertRejected("SELECT * FROM sjsu INTO OUTFILE '/tmp/sjsu.csv'")
+        self.assertRejected("SELECT * INTO DUMPFILE '/tmp/x' FROM sjsu")
+        self.assertRejected('SELECT fullness INTO @f FROM sjsu LIMIT 1')
+        self.assertRejected("select * from sjsu into\noutfile '/tmp/x'")
+
+    def test_locking_reads(self):
+        self.assertRejected('SELECT * FROM sjsu FOR UPDATE')
+        self.assertRejected('SELECT * FROM sjsu for update nowait')
+        self.assertRejected('SELECT * FROM sjsu LOCK IN SHARE MODE')
+        self.assertRejected('WITH t AS (SELECT * FROM sjsu) SELECT * FROM t FOR UPDATE')
+
+    def test_forbidden_functions(self):
+        self.assertRejected("SELECT LOAD_FILE('/etc/passwd')")
+        self.assertRejected('SELECT 1 FROM sjsu WHERE (SELECT 1 FROM sjsu FOR UPDATE)')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import unittest
+from datetime import datetime, time, timedelta
+from types import SimpleNamespace
+from result_cache import ResultCache, average_scope, window_scope
+from rollup import YESTERDAY, LAST_WEEK
+
+# A Monday
+MONDAY = datetime(2024, 1, 1)
+
+
+def update(table, *times) -> list:
+    """
+    One refresh of a table, as the SnapshotStore hands it to its listeners
+    """
+    return [(SimpleNamespace(table=table), [{'name': 'South Garage', 'fullness': 40, 'time': t} for t in times])]
+
+
+class TestResultCache(unittest.TestCase):
+    def fill(self, cache, entries):
+        """
+        Cache one result per key; each key's factory returns the key itself
+        :param entries: {key: (table, averages, windows)}
+        """
+        async def run():
+            for key, (table, averages, windows) in entries.items():
+                async def factory(key=key):
+                    return key
+                await cache.run(key, table, factory, averages=averages, windows=windows)
+        asyncio.run(run())
+
+    def test_update_evicts_the_averages_covering_its_bucket(self):
+        cache = ResultCache(size=16)
+        self.fill(cache, {
+            'monday 10:00': ('sjsu', [average_scope('Monday', time(10, 0))], []),
+            'monday 10:30': ('sjsu', [average_scope('Monday', time(10, 30))], []),
+            'monday 11:00': ('sjsu', [average_scope('Monday', time(11, 0))], []),
+            'tuesday 10:00': ('sjsu', [average_scope('Tuesday', time(10, 0))], []),
+            'other table': ('other', [average_scope('Monday', time(10, 0))], []),
+            'batch': ('sjsu', [average_scope('Friday', time(8, 0)), average_scope('Monday', time(9, 50))], []),
+        })
+        # Monday 09:45 is in the hour before 10:00 and 10:30, and before 09:50 of the batch
+        asyncio.run(cache.on_update(update('sjsu', MONDAY + timedelta(hours=9, minutes=45))))
+        self.assertEqual(set(cache.entries), {'monday 11:00', 'tuesday 10:00', 'other table'})
+        self.assertEqual(cache.stats()['invalidations'], 3)
+
+    def test_bucket_boundaries(self):
+        cache = ResultCache(size=16)
+        self.fill(cache, {
+            'monday 10:00': ('sjsu', [average_scope('Monday', time(10, 0))], []),
+            'monday 11:00': ('sjsu', [average_scope('Monday', time(11, 0))], []),
+        })
+        # The hour before 10:00 ends just before 10:00; the one before 11:00 starts at it
+        asyncio.run(cache.on_update(update('sjsu', MONDAY + timedelta(hours=10))))
+        self.assertEqual(set(cache.entries), {'monday 10:00'})
+
+    def test_update_evicts_the_windows_covering_its_age(self):
+        cache = ResultCache(size=16)
+        self.fill(cache, {
+            'yesterday': ('sjsu', [], [window_scope(*YESTERDAY)]),
+            'lastweek': ('sjsu', [], [window_scope(*LAST_WEEK)]),
+        })
+        newest = MONDAY + timedelta(days=8, hours=10)
+        # Measured back from the newest row, the other one is a day old
+        asyncio.run(cache.on_update(update('sjsu', newest, newest - timedelta(days=1))))
+        self.assertEqual(set(cache.entries), {'lastweek'})
+        asyncio.run(cache.on_update(update('sjsu', newest, newest - timedelta(days=7, minutes=10))))
+        self.assertEqual(set(cache.entries), set())
+
+    def test_update_outside_every_scope_keeps_everything(self):
+        cache = ResultCache(size=16)
+        self.fill(cache, {
+            'monday 10:00': ('sjsu', [average_scope('Monday', time(10, 0))], []),
+            'yesterday': ('sjsu', [], [window_scope(*YESTERDAY)]),
+        })
+        newest = MONDAY + timedelta(days=2, hours=3)
+        asyncio.run(cache.on_update(update('sjsu', newest, newest - timedelta(hours=5))))
+        self.assertEqual(set(cache.entries), {'monday 10:00', 'yesterday'})
+
+    def test_result_computed_across_an_update_is_not_stored(self):
+        cache = ResultCache(size=16)
+        calls = []
+
+        async def run():
+            async def factory():
+                calls.append(1)
+                # New rows land while the query runs
+                await cache.on_update(update('sjsu', MONDAY + timedelta(days=3)))
+                return 'result'
+
+            first = await cache.run('key', 'sjsu', factory, averages=[average_scope('Monday', time(10, 0))])
+            self.assertNotIn('key', cache.entries)
+
+            async def quiet():
+                calls.append(1)
+                return 'result'
+
+            second = await cache.run('key', 'sjsu', quiet, averages=[average_scope('Monday', time(10, 0))])
+            third = await cache.run('key', 'sjsu', quiet, averages=[average_scope('Monday', time(10, 0))])
+            return first, second, third
+
+        self.assertEqual(asyncio.run(run()), ('result',) * 3)
+        # The result from across the update wasn't kept; the next one was
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_update_of_another_table_does_not_block_storing(self):
+        cache = ResultCache(size=16)
+
+        async def factory():
+            await cache.on_update(update('other', MONDAY))
+            return 'result'
+
+        asyncio.run(cache.run('key', 'sjsu', factory))
+        self.assertIn('key', cache.entries)
+
+    def test_least_recently_used_goes_first(self):
+        cache = ResultCache(size=2)
+        self.fill(cache, {'a': ('sjsu', [], []), 'b': ('sjsu', [], [])})
+        self.fill(cache, {'a': ('sjsu', [], []), 'c': ('sjsu', [], [])})
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+        self.assertEqual(cache.keys['sjsu'], {'a', 'c'})
+
+
+if __name__ == "__main__":
+    unittest.main()
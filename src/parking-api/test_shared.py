@@ -0,0 +1,57 @@
+import os
+import unittest
+from datetime import datetime
+import numpy as np
+from series import TableSeries
+from shared import SharedState, replica, mount, epoch_seconds
+
+
+def table_series() -> TableSeries:
+    series = TableSeries()
+    series.extend([
+        {'name': 'South Garage', 'value': 40, 'time': datetime(2024, 1, 1, 9, 10)},
+        {'name': 'North Garage', 'value': 90, 'time': datetime(2024, 1, 1, 9, 55)},
+        {'name': 'South Garage', 'value': 61, 'time': datetime(2024, 1, 1, 9, 40)},
+    ])
+    return series
+
+
+class TestSharedState(unittest.TestCase):
+    def setUp(self):
+        self.shared = SharedState.create(f'parking-api-test-{os.getpid()}', size_mb=8)
+        self.addCleanup(self.shared.unlink)
+        self.reader = SharedState.attach(self.shared.segment.name)
+        self.addCleanup(self.reader.close)
+
+    def test_arrays_are_read_only_views_of_the_segment(self):
+        series = table_series()
+        now = epoch_seconds([datetime(2024, 1, 1, 10)])[0]
+        self.shared.write({'series': replica(series, now)})
+        published = self.reader.read()['series']
+        for key in ('slot_total', 'slot_samples', 'histograms'):
+            np.testing.assert_array_equal(published[key], getattr(series, key))
+            self.assertFalse(published[key].flags.writeable)
+            self.assertFalse(published[key].flags.owndata)
+
+        mounted = mount(published)
+        self.assertEqual(mounted.names, series.names)
+        self.assertEqual(mounted.series[mounted.index['South Garage']].window(0, now), (101, 2))
+        self.assertEqual(mounted.average(0, 9 * 60, 10 * 60)[0].tolist(), series.average(0, 9 * 60, 10 * 60)[0].tolist())
+
+    def test_newer_generation_replaces_the_state(self):
+        self.shared.write({'value': np.arange(3)})
+        self.assertEqual(self.reader.read()['value'].tolist(), [0, 1, 2])
+        self.shared.write({'value': np.arange(5)})
+        self.assertEqual(self.reader.read()['value'].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(self.reader.generation, 2)
+
+    def test_state_too_large_keeps_the_previous_one(self):
+        self.shared.write({'value': np.arange(3)})
+        with self.assertRaises(ValueError):
+            self.shared.write({'value': np.zeros(8 * 1024 * 1024, dtype=np.int64)})
+        self.assertEqual(self.shared.header()[0], 1)
+        self.assertEqual(self.reader.read()['value'].tolist(), [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
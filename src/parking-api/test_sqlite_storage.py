@@ -0,0 +1,149 @@
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, time
+from os import path
+from unittest import mock
+from sqlite_storage import SqliteStorage, translate
+import sqlite_storage
+
+# A Monday
+MONDAY = datetime(2024, 1, 1)
+
+GARAGE_ROWS = [
+    (1, 'South Garage', '377 S 7th St', 40, MONDAY.replace(hour=9, minute=10)),
+    (2, 'South Garage', '377 S 7th St', 61, MONDAY.replace(hour=9, minute=40)),
+    (3, 'North Garage', '65 S 10th St', 90, MONDAY.replace(hour=9, minute=55)),
+    (4, 'South Garage', '377 S 7th St', 70, MONDAY.replace(hour=10, minute=30)),
+    # Tuesday, outside every Monday window
+    (5, 'South Garage', '377 S 7th St', 5, MONDAY.replace(day=2, hour=9, minute=30)),
+]
+
+
+class TestTranslate(unittest.TestCase):
+    def test_placeholders_and_percent_signs(self):
+        self.assertEqual(translate("SELECT strftime('%%H', time) FROM t WHERE name = %s AND id > %s", ('a', 1)),
+                         "SELECT strftime('%H', time) FROM t WHERE name = ? AND id > ?")
+
+    def test_query_without_arguments_is_left_alone(self):
+        # Like aiomysql, which only interpolates when given arguments
+        self.assertEqual(translate("SELECT '%%' AS a, '%s' AS b", None), "SELECT '%%' AS a, '%s' AS b")
+
+
+class TestSqliteStorage(unittest.TestCase):
+    """
+    The embedded backend against a file in a temporary directory, with no database server
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def run_with_storage(self, test):
+        """
+        Run test(db) on a storage holding GARAGE_ROWS in `garages`
+        """
+        async def run():
+            db = SqliteStorage(file=path.join(self.directory.name, 'parking.sqlite3'), replicate=False)
+            try:
+                await db.write(db.create_table, 'garages')
+                await db.executemany('INSERT INTO `garages` (id, name, address, fullness, time) '
+                                     'VALUES (%s, %s, %s, %s, %s)', GARAGE_ROWS)
+                return await test(db)
+            finally:
+                await db.close()
+        return asyncio.run(run())
+
+    def test_percent_signs_reach_sqlite(self):
+        async def test(db):
+            return await db.fetch_all("SELECT strftime('%%H:%%M', time) AS clock FROM `garages` WHERE id = %s", (1,))
+        self.assertEqual(self.run_with_storage(test), [{'clock': '09:10'}])
+
+    def test_generated_columns(self):
+        async def test(db):
+            return await db.fetch_all('SELECT weekday, minute_of_day FROM `garages` ORDER BY id')
+        rows = self.run_with_storage(test)
+        self.assertEqual(rows[0], {'weekday': 0, 'minute_of_day': 9 * 60 + 10})
+        self.assertEqual(rows[-1], {'weekday': 1, 'minute_of_day': 9 * 60 + 30})
+
+    def test_get_latest_rows(self):
+        async def test(db):
+            return await db.get_latest_rows('garages')
+        rows = sorted(self.run_with_storage(test), key=lambda row: row['name'])
+        self.assertEqual(rows, [
+            {'name': 'North Garage', 'value': 90, 'time': MONDAY.replace(hour=9, minute=55)},
+            {'name': 'South Garage', 'value': 5, 'time': MONDAY.replace(day=2, hour=9, minute=30)},
+        ])
+
+    def test_get_at_rows(self):
+        async def test(db):
+            return await db.get_at_rows('garages', [
+                ('South Garage', MONDAY.replace(hour=10)),
+                # Before the first reading
+                ('South Garage', MONDAY.replace(hour=8)),
+                ('North Garage', MONDAY.replace(hour=12)),
+                # Exactly at a reading
+                ('South Garage', MONDAY.replace(hour=10, minute=30)),
+            ])
+        rows = self.run_with_storage(test)
+        self.assertEqual([(row['pair'], row['value'], row['time']) for row in rows], [
+            (0, 61, MONDAY.replace(hour=9, minute=40)),
+            (2, 90, MONDAY.replace(hour=9, minute=55)),
+            (3, 70, MONDAY.replace(hour=10, minute=30)),
+        ])
+
+    def test_get_average(self):
+        async def test(db):
+            return await db.get_average('garages', 'Monday', time(10, 0))
+        rows = self.run_with_storage(test)
+        # The hour before 10:00 on Mondays: South 40 and 61 average to 51 rounded up, North 90
+        self.assertEqual(rows[:2], [{'name': 'North Garage', 'fullness': '90%'},
+                                    {'name': 'South Garage', 'fullness': '51%'}])
+        # The total row averages every reading in the window
+        self.assertEqual(rows[2], {'name': None, 'fullness': '64%'})
+
+    def test_guarded_query_row_cap(self):
+        async def test(db):
+            query = db.guarded_query('SELECT id FROM `garages` ORDER BY id')
+            await query.start()
+            rows = [row async for row in query.rows()]
+            return rows, query.truncated
+
+        with mock.patch.object(sqlite_storage, 'QUERY_ROW_CAP', 3):
+            rows, truncated = self.run_with_storage(test)
+        self.assertEqual(rows, [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.assertTrue(truncated)
+
+    def test_guarded_query_under_the_cap(self):
+        async def test(db):
+            query = db.guarded_query('SELECT id FROM `garages` WHERE id > 3')
+            await query.start()
+            return [row async for row in query.rows()], query.truncated
+        self.assertEqual(self.run_with_storage(test), ([{'id': 4}, {'id': 5}], False))
+
+    def test_guarded_query_timeout(self):
+        async def test(db):
+            query = db.guarded_query('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) '
+                                     'SELECT COUNT(*) FROM c')
+            with self.assertRaises(sqlite3.OperationalError):
+                await query.start()
+            self.assertIsNone(query.conn)
+
+        with mock.patch.object(sqlite_storage, 'QUERY_TIMEOUT', 0.05):
+            self.run_with_storage(test)
+
+    def test_guarded_query_cannot_write(self):
+        async def test(db):
+            query = db.guarded_query('WITH t AS (SELECT 1) SELECT * FROM `garages`')
+            await query.start()
+            await query.close()
+            # The guard rejects writes up front; the read-only connection is the second line
+            conn = await db.read(db.connect, True)
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute('DELETE FROM `garages`')
+            conn.close()
+        self.run_with_storage(test)
+
+
+if __name__ == "__main__":
+    unittest.main()
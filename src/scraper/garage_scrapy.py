@@ -3,7 +3,7 @@ from bs4 import BeautifulSoup
 from datetime import datetime
 from agent_picker import random_ua
 from garage import Garage
-from mariadb import garage_db, shuttles_db
+from mariadb import garage_db, shuttles_db, notify_parking_api
 from time import sleep
 from scraper_log import BotLog
 from threading import Thread
@@ -91,6 +91,8 @@ if __name__ == '__main__':
             added_new = garage_db.new(garage)
             number_new += 1 if added_new else 0
         logger.info(f'Scraped {number_new} new garages.')
+        if number_new:
+            notify_parking_api()
         # Wait for 5 minutes before running again
         logger.info('Waiting 1 minute before running again...')
 
@@ -1,4 +1,5 @@
 import mysql.connector
+import requests
 from os import getenv
 from garage import Garage
 from shuttle_scrapy import ShuttleStatus
@@ -8,6 +9,19 @@ import newrelic.agent
 # Instantiating a new logger object with the name 'mariadb'
 logger = BotLog('mariadb')
 
+def notify_parking_api() -> None:
+    """
+    Push a refresh to the parking-api so its /latest snapshot picks up new rows right away.
+    Does nothing unless PARKING_API_URL is set; the api also refreshes on its own interval.
+    """
+    url = getenv("PARKING_API_URL")
+    if not url:
+        return
+    try:
+        requests.post(f"{url}/refresh", params={"api_key": getenv("PARKING_API_KEY")}, timeout=2)
+    except Exception as e:
+        logger.warning(f"Could not notify the parking-api of new data: {e}")
+
 class Parking:
     """
     This class handles the configuration for the MySQL database. It has methods to create a table, load the latest data
@@ -141,6 +155,7 @@ class Shuttles:
         self.conn.commit()
 
         cursor.close()
+        notify_parking_api()
 
     def get_latest_shuttle_statuses(self):
         """